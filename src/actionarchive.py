@@ -8,60 +8,360 @@ import argparse
 import os
 import sys
 import json
+import hashlib
 import zipfile
 import tarfile
+import tempfile
+import shutil
+import zlib
+import lzma
+import struct
+import collections
+import sqlite3
 import threading
+import queue
+import multiprocessing.connection
+import asyncio
+import atexit
+import contextlib
 import concurrent.futures
 import time
-from datetime import datetime
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+import xml.etree.ElementTree as ET
 
 import keyring
 import keyring.backends
 import bigfixREST
+import runmetrics
+import runtrace
 from bigfixREST import BigfixConnectionError, BigfixAuthenticationError, BigfixAPIError
 
 VERSION = "1.2.0"
 
+# Starting request concurrency for --threads auto
+ADAPTIVE_INITIAL_THREADS = 4
+
+# MAGs per bulk member-action relevance query
+MAG_QUERY_CHUNK = 500
+
+# Work items queued ahead of each worker when --max-pending is not given
+PENDING_PER_WORKER = 4
+
+# Actions per relevance query for their result counts (--schedule largest-first)
+COST_QUERY_CHUNK = 1000
+
+# Per-action result and member counts, for scheduling and --estimate
+COST_PROPERTIES = """(id of it, number of results of it, number of member actions of it,
+    number of results of member actions of it)"""
+
+# Checkpoint journal kept in the output directory (see --resume)
+JOURNAL_NAME = "archive_journal.jsonl"
+# Journal records written (and forced to disk, with the files they cover) at a time
+JOURNAL_SYNC_EVERY = 100
+
+# Content-addressed store for --dedup: blobs/<sha256[:2]>/<sha256>, plus a
+# manifest mapping every deduplicated file path to its blob
+DEDUP_BLOB_DIR = "blobs"
+DEDUP_MANIFEST_NAME = "dedup_manifest.jsonl"
+
+# Sidecar index written next to archive output: <archive>.index.sqlite
+INDEX_SUFFIX = ".index.sqlite"
+INDEX_INSERT_BATCH = 1000
+
+# Shards written by --processes workers, per output type; tar shards are
+# left uncompressed, as the merge compresses them anyway
+SHARD_SUFFIXES = {"directory": "", "zip": ".zip", "tar": ".tar", "tar.gz": ".tar", "tar.xz": ".tar"}
+SHARD_DIR_SUFFIX = ".shards"
+
+# Options a --config server entry may set for itself; the others come from
+# the command line
+SERVER_OPTIONS = ("bfserver", "bfport", "bfuser", "bfpass", "keycreds", "whose", "older",
+                  "threads", "max_threads", "delete_threads", "processes", "engine",
+                  "query_chunk", "query_timeout", "retries", "retry_backoff", "schedule")
+# Shorter names a --config entry may use for the connection options
+SERVER_ALIASES = {"server": "bfserver", "port": "bfport", "user": "bfuser", "password": "bfpass"}
+SERVER_DIR_SUFFIX = ".servers"
+
+# Archive suffixes, before which the segment number goes: a.part0001.tar.gz
+SEGMENT_SUFFIXES = (".zip", ".tar", ".tar.gz", ".tgz", ".tar.xz", ".txz")
+
+# Per-endpoint results table written with --results, by format
+RESULTS_NAMES = {"jsonl": "action_results.jsonl", "sqlite": "action_results.sqlite"}
+RESULT_COLUMNS = ("action_id", "parent_id", "computer_id", "computer_name", "status",
+                  "state", "is_error", "apply_count", "start_time", "end_time")
+RESULT_INSERT_BATCH = 1000
+
+# Seconds between --metrics-file updates while the run is going
+METRICS_INTERVAL = 30
+
+# --estimate: actions fetched to measure sizes and latency, sampled content
+# kept to measure compression, and the thread counts reported
+ESTIMATE_SAMPLE = 20
+ESTIMATE_SAMPLE_BYTES = 16 * 1024 * 1024
+ESTIMATE_THREADS = (1, 4, 8, 16, 32)
+# Approximate per-file overhead of the archive formats, and META file size
+ZIP_FILE_OVERHEAD = 160
+TAR_FILE_OVERHEAD = 768
+META_FILE_BYTES = 200
+
+# Streamed archive members are spooled to a temp file once they exceed this
+SPOOL_MAX_BYTES = 8 * 1024 * 1024
+# Rows per chunk when a whole (unchunked) selection is read back from its spool
+SELECTION_SPOOL_ROWS = 1000
+COPY_CHUNK_SIZE = 1024 * 1024
+
+# Compressed tar output is compressed in independent blocks of this size
+COMPRESS_BLOCK_SIZE = 4 * 1024 * 1024
+GZIP_LEVEL = 9
+XZ_PRESET = 6
+
+
+def iter_file_chunks(fileobj, chunk_size=COPY_CHUNK_SIZE):
+    """Yield the remaining content of a binary file object in chunks"""
+    return iter(lambda: fileobj.read(chunk_size), b"")
+
+
+def archive_type_of(path):
+    """Archive type for an output path: zip, tar, tar.gz, tar.xz or directory"""
+    lower_path = path.lower()
+    if lower_path.endswith(".zip"):
+        return "zip"
+    elif lower_path.endswith(".tar.gz") or lower_path.endswith(".tgz"):
+        return "tar.gz"
+    elif lower_path.endswith(".tar.xz") or lower_path.endswith(".txz"):
+        return "tar.xz"
+    elif lower_path.endswith(".tar"):
+        return "tar"
+    else:
+        return "directory"
+
+
+def zip_raw_append_supported(zf):
+    """True if already compressed members can be appended to the ZipFile zf
+
+    ArchiveWriter._append_zip_member() relies on private ZipFile internals
+    (_writecheck(), _didModify, start_dir and ZipInfo.FileHeader()), which
+    every CPython 3 release so far has, but which are not a public API.
+    Where any is missing, members are written through ZipFile.open(zinfo,
+    "w") instead, which compresses them (again) under the writer lock."""
+    return (all(hasattr(zf, name) for name in ("_writecheck", "_didModify", "start_dir"))
+            and hasattr(zipfile.ZipInfo, "FileHeader"))
+
+
+def compress_block(codec, block):
+    """Compress one block as a complete gzip member or xz stream
+
+    Module level so that it can run in a process pool."""
+    if codec == "gzip":
+        compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return compressor.compress(block) + compressor.flush()
+    return lzma.compress(block, format=lzma.FORMAT_XZ, preset=XZ_PRESET)
+
+
+class BlockCompressor:
+    """File-like writer that compresses a byte stream block by block
+
+    The stream is cut into block_size blocks, each compressed on its own in
+    a process pool, and the results are written to fileobj in order. A
+    concatenation of gzip members (or xz streams) is a valid .gz (or .xz)
+    file, so gzip, xz and tar read the output as a single stream. At most
+    two blocks per worker are in flight. With workers=0 blocks are
+    compressed in the calling thread.
+
+    blocks lists (raw_offset, raw_size, offset, size) for every block
+    written, which makes the output seekable (see ArchiveIndex). Time spent
+    waiting for the pool is reported to metrics, if given.
+    """
+
+    def __init__(self, fileobj, codec, workers, block_size=COMPRESS_BLOCK_SIZE, metrics=None):
+        self.fileobj = fileobj
+        self.metrics = metrics
+        self.codec = codec
+        self.workers = workers
+        self.block_size = block_size
+        self.blocks = []
+        self._buffer = bytearray()
+        self._raw_offset = 0  # Uncompressed offset of the next block
+        self._raw_written = 0  # Uncompressed bytes of the blocks written so far
+        self._offset = 0  # Compressed bytes written so far
+        self._pending = collections.deque()  # (raw_offset, raw_size, future) not yet written
+        self._executor = None
+
+    def write(self, data):
+        self._buffer += data
+        while len(self._buffer) >= self.block_size:
+            block = bytes(self._buffer[:self.block_size])
+            del self._buffer[:self.block_size]
+            self._submit(block)
+        return len(data)
+
+    def _submit(self, block):
+        raw_offset = self._raw_offset
+        self._raw_offset += len(block)
+        if self.workers == 0:
+            self._write_block(raw_offset, len(block), compress_block(self.codec, block))
+            return
+
+        if self._executor is None:
+            self._executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.workers)
+        future = self._executor.submit(compress_block, self.codec, block)
+        self._pending.append((raw_offset, len(block), future))
+        while len(self._pending) > 2 * self.workers:
+            self._write_oldest()
+
+    def _write_oldest(self):
+        raw_offset, raw_size, future = self._pending.popleft()
+        start = time.monotonic()
+        data = future.result()
+        if self.metrics is not None:
+            self.metrics.inc("compress_wait_seconds_total", time.monotonic() - start)
+        self._write_block(raw_offset, raw_size, data)
+
+    def _write_block(self, raw_offset, raw_size, data):
+        self.fileobj.write(data)
+        self.blocks.append((raw_offset, raw_size, self._offset, len(data)))
+        self._offset += len(data)
+        self._raw_written = raw_offset + raw_size
+
+    @property
+    def size(self):
+        """Compressed bytes written so far, plus an estimate for the data not yet written
+
+        That data is counted at the compression ratio of the blocks written
+        so far, or at its raw size before the first block is written."""
+        unwritten = self._raw_offset - self._raw_written + len(self._buffer)
+        if self._raw_written:
+            unwritten = unwritten * self._offset // self._raw_written
+        return self._offset + unwritten
+
+    def close(self):
+        """Compress the last partial block and write everything out"""
+        try:
+            if self._buffer:
+                self._submit(bytes(self._buffer))
+                self._buffer = bytearray()
+            while self._pending:
+                self._write_oldest()
+        finally:
+            if self._executor is not None:
+                self._executor.shutdown(cancel_futures=True)
+                self._executor = None
+
 
 class ArchiveWriter:
-    """Abstraction for writing files to either a directory or archive format"""
+    """Abstraction for writing files to either a directory or archive format
+
+    For archive output, each member is fully encoded (compressed, with its
+    header) by the calling worker thread, and only the append of the
+    finished bytes to the archive file is serialized by self.lock. zlib
+    releases the GIL while compressing, so zip compression scales with the
+    number of worker threads. TAR.GZ and TAR.XZ output is compressed in
+    independent blocks by a BlockCompressor on compress_workers processes
+    (default: one per CPU).
+
+    With dedup=True, files written with write_file(..., dedup=True) are
+    stored once per distinct content under blobs/ (named by SHA-256), and
+    dedup_manifest.jsonl maps each file path to its blob. Directory output
+    appends to the manifest as files are written (and picks up an existing
+    one, for --resume); archive output adds it as the last member.
+    ArchiveReader and expand_archive() rebuild the plain layout.
 
-    def __init__(self, path, verbose=False):
+    With metrics (a runmetrics.RunMetrics), content bytes, encode time and
+    the time spent waiting for and holding the lock are recorded.
+    """
+
+    def __init__(self, path, verbose=False, dedup=False, compress_workers=None, index=False,
+                 metrics=None):
         self.path = path
         self.verbose = verbose
         self.archive_type = self._detect_archive_type()
         self.archive_handle = None
+        self.compressor = None  # BlockCompressor for tar.gz and tar.xz
+        self.metrics = metrics
+        if compress_workers is None:
+            compress_workers = os.cpu_count() or 1
         self.lock = threading.Lock()  # Thread-safe access to archive handles
+        self._tar_offset = 0  # Uncompressed size of the tar stream so far
+        self.dedup = dedup
+        self._blobs = set()  # Digests of the blobs written so far
+        self._pending_blobs = {}  # Digest -> Event while a blob is being written
+        self._manifest = []  # Manifest entries, for archive output
+        self._manifest_handle = None  # Manifest file, for directory output
+        self._sync_lock = threading.Lock()
+        self._unsynced_dirs = set()  # Directories with new entries, for sync_written()
+        self.dedup_files = 0
+        self.dedup_bytes = 0  # Size of the deduplicated files
+        self.dedup_stored_bytes = 0  # Size of their blobs
+        self.results = None  # ResultsTable fed from status files (--results)
+        self.index = None  # ArchiveIndex sidecar, for archive output
 
         if self.archive_type == "zip":
             self.archive_handle = zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED)
+            self._zip_raw_append = zip_raw_append_supported(self.archive_handle)
             if self.verbose:
                 print(f"Creating ZIP archive: {path}")
         elif self.archive_type == "tar":
-            self.archive_handle = tarfile.open(path, "w")
+            self.archive_handle = open(path, "wb")
             if self.verbose:
                 print(f"Creating TAR archive: {path}")
-        elif self.archive_type == "tar.gz":
-            self.archive_handle = tarfile.open(path, "w:gz")
+        elif self.archive_type in ("tar.gz", "tar.xz"):
+            self.archive_handle = open(path, "wb")
+            codec = "gzip" if self.archive_type == "tar.gz" else "xz"
+            self.compressor = BlockCompressor(self.archive_handle, codec, compress_workers,
+                                              metrics=metrics)
             if self.verbose:
-                print(f"Creating TAR.GZ archive: {path}")
+                print(f"Creating {self.archive_type.upper()} archive: {path}")
         else:
             # Directory mode
             os.makedirs(path, exist_ok=True)
+            self._unsynced_dirs.add(os.path.dirname(os.path.abspath(path)))
             if self.verbose:
                 print(f"Creating directory structure: {path}")
+            if dedup:
+                self._open_manifest()
+
+        if index and self.archive_type != "directory":
+            self.index = ArchiveIndex(path, self.archive_type)
 
     def _detect_archive_type(self):
         """Detect archive type based on file extension"""
-        lower_path = self.path.lower()
-        if lower_path.endswith(".zip"):
-            return "zip"
-        elif lower_path.endswith(".tar.gz") or lower_path.endswith(".tgz"):
-            return "tar.gz"
-        elif lower_path.endswith(".tar"):
-            return "tar"
-        else:
-            return "directory"
+        return archive_type_of(self.path)
+
+    def _open_manifest(self):
+        """Open the directory's dedup manifest for appending
+
+        Blobs listed by an existing manifest (from an interrupted run) are
+        reused rather than written again."""
+        manifest_path = self.get_path(DEDUP_MANIFEST_NAME)
+        if os.path.exists(manifest_path):
+            with open(manifest_path, "rb") as f:
+                for entry in read_manifest_lines(f):
+                    digest = entry["sha256"]
+                    if os.path.exists(self.get_path(DEDUP_BLOB_DIR, digest[:2], digest)):
+                        self._blobs.add(digest)
+        self._manifest_handle = open(manifest_path, "a", encoding="utf-8")
+
+    @property
+    def size(self):
+        """Approximate size of the archive file so far (0 for directory output)
+
+        Compressed tar output estimates the data still being compressed (see
+        BlockCompressor.size), and zip output does not count the central
+        directory."""
+        with self.lock:
+            if self.archive_type == "zip":
+                return self.archive_handle.fp.tell()
+            if self.compressor is not None:
+                return self.compressor.size
+            return self._tar_offset
+
+    def action_files(self, action_id=None):
+        """Context for writing the files of one action (see SegmentedArchiveWriter)"""
+        return contextlib.nullcontext()
+
+    def action_done(self, action_id):
+        """Called once all files of a top-level action are written (see SegmentedArchiveWriter)"""
 
     def makedirs(self, dir_path, exist_ok=True):
         """Create directory - no-op for archives, actual mkdir for directories (thread-safe)"""
@@ -69,27 +369,338 @@ class ArchiveWriter:
             if self.archive_type == "directory":
                 os.makedirs(dir_path, exist_ok=exist_ok)
 
-    def write_file(self, file_path, content):
-        """Write a file to either directory or archive (thread-safe)"""
-        with self.lock:
-            if self.archive_type == "zip":
-                # For ZIP archives, add the content as bytes
-                if isinstance(content, str):
-                    content = content.encode("utf-8")
-                self.archive_handle.writestr(file_path, content)
-            elif self.archive_type in ("tar", "tar.gz"):
-                # For TAR archives, create a TarInfo object
-                if isinstance(content, str):
-                    content = content.encode("utf-8")
-                tarinfo = tarfile.TarInfo(name=file_path)
-                tarinfo.size = len(content)
-                tarinfo.mtime = datetime.now().timestamp()
-                import io
-                self.archive_handle.addfile(tarinfo, io.BytesIO(content))
-            else:
+    def write_file(self, file_path, content, dedup=False):
+        """Write a file to either directory or archive (thread-safe)
+
+        With dedup=True and a deduplicating writer, the content is stored
+        as a blob instead (see the class docstring)."""
+        if dedup and self.dedup:
+            self._write_dedup(file_path, content)
+            return
+
+        if self.archive_type == "directory":
+            with self.lock:
                 # Directory mode - write actual file
                 with open(file_path, "w", encoding="utf-8") as f:
                     f.write(content)
+                    self._synced(f, file_path)
+            return
+
+        if isinstance(content, str):
+            content = content.encode("utf-8")
+        self.write_stream(file_path, [content])
+
+    def write_stream(self, file_path, chunks):
+        """Write a file from an iterable of bytes chunks (thread-safe)
+
+        Peak memory stays bounded however large the content is. Directory
+        output writes each chunk as it arrives. Archive members are encoded
+        outside the lock into a spool file (in memory up to SPOOL_MAX_BYTES,
+        on disk beyond that) and then appended under the lock.
+        """
+        if self.archive_type == "directory":
+            # Every file path is distinct, so no lock is needed here
+            size = 0
+            with open(file_path, "wb") as f:
+                for chunk in chunks:
+                    f.write(chunk)
+                    size += len(chunk)
+                self._synced(f, file_path)
+            if self.metrics is not None:
+                self.metrics.inc("writer_content_bytes_total", size)
+            return
+
+        with tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_BYTES) as encoded:
+            if self.archive_type == "zip" and not self._zip_raw_append:
+                for chunk in chunks:
+                    encoded.write(chunk)
+                encoded.seek(0)
+                start = time.monotonic()
+                with self._append_lock():
+                    data_offset, zipinfo = self._write_zip_member(file_path, encoded)
+                self._record_encode(zipinfo.file_size, start)
+                if self.index is not None:
+                    self.index.add_member(file_path, data_offset, zipinfo.file_size,
+                                          zipinfo.compress_size, zipinfo.compress_type)
+            elif self.archive_type == "zip":
+                start = time.monotonic()
+                zipinfo = self._encode_zip_member(file_path, chunks, encoded)
+                self._record_encode(zipinfo.file_size, start)
+                encoded.seek(0)
+                with self._append_lock():
+                    data_offset = self._append_zip_member(zipinfo, encoded)
+                if self.index is not None:
+                    self.index.add_member(file_path, data_offset, zipinfo.file_size,
+                                          zipinfo.compress_size, zipinfo.compress_type)
+            else:
+                start = time.monotonic()
+                header_size, size, tar_size = self._encode_tar_member(file_path, chunks, encoded)
+                self._record_encode(size, start)
+                encoded.seek(0)
+                with self._append_lock():
+                    data_offset = self._tar_offset + header_size
+                    shutil.copyfileobj(encoded, self.compressor or self.archive_handle,
+                                       COPY_CHUNK_SIZE)
+                    self._tar_offset += tar_size
+                if self.index is not None:
+                    self.index.add_member(file_path, data_offset, size)
+
+    def _synced(self, f, file_path):
+        """Force a file written in directory mode to disk, and note the
+        directories whose new entries sync_written() must make durable"""
+        f.flush()
+        os.fsync(f.fileno())
+        root = os.path.abspath(self.path)
+        directory = os.path.dirname(os.path.abspath(file_path))
+        with self._sync_lock:
+            while directory not in self._unsynced_dirs:
+                self._unsynced_dirs.add(directory)
+                if len(directory) <= len(root):
+                    break
+                directory = os.path.dirname(directory)
+
+    def sync_written(self):
+        """Make the files written in directory mode so far durable
+
+        Every file is already synced as it is written; this syncs the
+        directories that got new entries, the dedup manifest and the
+        results table. Called before the journal records the actions."""
+        with self._sync_lock:
+            directories, self._unsynced_dirs = self._unsynced_dirs, set()
+        if os.name == "posix":
+            for directory in sorted(directories, key=len, reverse=True):
+                fd = os.open(directory, os.O_RDONLY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+        with self.lock:
+            if self._manifest_handle is not None:
+                self._manifest_handle.flush()
+                os.fsync(self._manifest_handle.fileno())
+        if self.results is not None:
+            self.results.sync()
+
+    def _record_encode(self, size, start):
+        if self.metrics is not None:
+            self.metrics.inc("writer_content_bytes_total", size)
+            self.metrics.inc("writer_encode_seconds_total", time.monotonic() - start)
+
+    @contextlib.contextmanager
+    def _append_lock(self):
+        """Hold self.lock, recording the time spent waiting for and holding it"""
+        if self.metrics is None:
+            with self.lock:
+                yield
+            return
+
+        start = time.monotonic()
+        with self.lock:
+            acquired = time.monotonic()
+            try:
+                yield
+            finally:
+                held = time.monotonic() - acquired
+        self.metrics.observe("writer_lock_wait_seconds", acquired - start)
+        self.metrics.inc("writer_append_seconds_total", held)
+
+    def _write_dedup(self, file_path, content):
+        """Store content as a blob, once per digest, and record it in the manifest"""
+        if isinstance(content, str):
+            content = content.encode("utf-8")
+        digest = hashlib.sha256(content).hexdigest()
+
+        # One thread writes a new blob; others with the same content wait for
+        # it, and take over if that write failed
+        while True:
+            with self.lock:
+                if digest in self._blobs:
+                    break
+                pending = self._pending_blobs.get(digest)
+                writing = pending is None
+                if writing:
+                    pending = self._pending_blobs[digest] = threading.Event()
+            if not writing:
+                pending.wait()
+                continue
+
+            stored = False
+            try:
+                blob_path = self.get_path(DEDUP_BLOB_DIR, digest[:2], digest)
+                if self.archive_type == "directory":
+                    os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+                    with open(blob_path, "wb") as f:
+                        f.write(content)
+                        self._synced(f, blob_path)
+                else:
+                    self.write_stream(blob_path, [content])
+                stored = True
+            finally:
+                with self.lock:
+                    del self._pending_blobs[digest]
+                    if stored:
+                        self._blobs.add(digest)
+                        self.dedup_stored_bytes += len(content)
+                pending.set()
+            break
+
+        if self.archive_type == "directory":
+            rel_path = os.path.relpath(file_path, self.path).replace(os.sep, "/")
+        else:
+            rel_path = file_path
+        if self.index is not None:
+            self.index.add_link(rel_path, self.get_path(DEDUP_BLOB_DIR, digest[:2], digest))
+        self.add_manifest_entry({"path": rel_path, "sha256": digest, "size": len(content)})
+
+    def add_manifest_entry(self, entry):
+        """Record in the dedup manifest that entry["path"] is stored as a blob"""
+        with self.lock:
+            self.dedup_files += 1
+            self.dedup_bytes += entry["size"]
+            if self._manifest_handle is not None:
+                self._manifest_handle.write(json.dumps(entry) + "\n")
+                self._manifest_handle.flush()
+            else:
+                self._manifest.append(entry)
+
+    def copy_zip_member(self, source, info, name=None):
+        """Append a member of the open ZipFile source without recompressing it,
+        optionally under another name"""
+        if not self._zip_raw_append:
+            with source.open(info) as f:
+                self.write_stream(name or info.filename, iter_file_chunks(f))
+            return
+
+        fp = source.fp
+        fp.seek(info.header_offset)
+        header = fp.read(zipfile.sizeFileHeader)
+        name_length, extra_length = struct.unpack("<HH", header[26:30])
+        fp.seek(name_length + extra_length, os.SEEK_CUR)
+
+        name = name or info.filename
+        zipinfo = zipfile.ZipInfo(name, date_time=info.date_time)
+        zipinfo.compress_type = info.compress_type
+        zipinfo.external_attr = info.external_attr
+        zipinfo.file_size = info.file_size
+        zipinfo.compress_size = info.compress_size
+        zipinfo.CRC = info.CRC
+
+        with tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_BYTES) as encoded:
+            remaining = info.compress_size
+            while remaining > 0:
+                data = fp.read(min(COPY_CHUNK_SIZE, remaining))
+                if not data:
+                    raise zipfile.BadZipFile(f"Truncated member {info.filename} in {source.filename}")
+                encoded.write(data)
+                remaining -= len(data)
+            encoded.seek(0)
+            with self._append_lock():
+                data_offset = self._append_zip_member(zipinfo, encoded)
+        if self.index is not None:
+            self.index.add_member(name, data_offset, info.file_size,
+                                  info.compress_size, info.compress_type)
+
+    def _encode_zip_member(self, file_path, chunks, out):
+        """Deflate chunks into out and return the matching ZipInfo (no lock)"""
+        compressor = zlib.compressobj(
+            zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -zlib.MAX_WBITS
+        )
+        crc = 0
+        file_size = 0
+        compress_size = 0
+        for chunk in chunks:
+            crc = zlib.crc32(chunk, crc)
+            file_size += len(chunk)
+            data = compressor.compress(chunk)
+            out.write(data)
+            compress_size += len(data)
+        data = compressor.flush()
+        out.write(data)
+        compress_size += len(data)
+
+        zipinfo = zipfile.ZipInfo(file_path, date_time=time.localtime(time.time())[:6])
+        zipinfo.compress_type = zipfile.ZIP_DEFLATED
+        zipinfo.external_attr = 0o600 << 16
+        zipinfo.file_size = file_size
+        zipinfo.compress_size = compress_size
+        zipinfo.CRC = crc
+        return zipinfo
+
+    def _append_zip_member(self, zipinfo, encoded):
+        """Append an already deflated member to the zip file (caller holds lock)
+
+        Mirrors what ZipFile.open(mode="w") does, minus the compression:
+        local header, data, then registration for the central directory
+        that ZipFile.close() writes. Returns the file offset of the data.
+        Uses private ZipFile internals; see zip_raw_append_supported().
+        """
+        zf = self.archive_handle
+        zip64 = (zipinfo.file_size > zipfile.ZIP64_LIMIT or
+                 zipinfo.compress_size > zipfile.ZIP64_LIMIT)
+        zipinfo.header_offset = zf.fp.tell()
+        zf._writecheck(zipinfo)
+        zf._didModify = True
+        header = zipinfo.FileHeader(zip64)
+        zf.fp.write(header)
+        shutil.copyfileobj(encoded, zf.fp, COPY_CHUNK_SIZE)
+        zf.filelist.append(zipinfo)
+        zf.NameToInfo[zipinfo.filename] = zipinfo
+        zf.start_dir = zf.fp.tell()
+        return zipinfo.header_offset + len(header)
+
+    def _write_zip_member(self, file_path, data):
+        """Compress and write a member with ZipFile.open() (caller holds lock)
+
+        The fallback for _append_zip_member() where the ZipFile internals it
+        needs are missing. Returns (file offset of the data, ZipInfo)."""
+        zf = self.archive_handle
+        data.seek(0, os.SEEK_END)
+        zipinfo = zipfile.ZipInfo(file_path, date_time=time.localtime(time.time())[:6])
+        zipinfo.compress_type = zipfile.ZIP_DEFLATED
+        zipinfo.external_attr = 0o600 << 16
+        zipinfo.file_size = data.tell()  # Lets ZipFile decide on zip64 up front
+        data.seek(0)
+        with zf.open(zipinfo, "w") as dest:
+            shutil.copyfileobj(data, dest, COPY_CHUNK_SIZE)
+
+        # The data follows the local header, whose name and extra field
+        # lengths ZipFile chose
+        end = zf.fp.tell()
+        zf.fp.seek(zipinfo.header_offset)
+        header = zf.fp.read(zipfile.sizeFileHeader)
+        zf.fp.seek(end)
+        name_length, extra_length = struct.unpack("<HH", header[26:30])
+        return zipinfo.header_offset + zipfile.sizeFileHeader + name_length + extra_length, zipinfo
+
+    def _encode_tar_member(self, file_path, chunks, out):
+        """Write header, data and padding of one tar member into out (no lock)
+
+        Returns (header size, data size, size of the member in the tar stream).
+        """
+        with tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_BYTES) as data:
+            size = 0
+            for chunk in chunks:
+                data.write(chunk)
+                size += len(chunk)
+            data.seek(0)
+
+            tarinfo = tarfile.TarInfo(name=file_path)
+            tarinfo.size = size
+            tarinfo.mtime = datetime.now().timestamp()
+            header = tarinfo.tobuf(tarfile.DEFAULT_FORMAT, "utf-8", "surrogateescape")
+            padding = tarfile.NUL * (-size % tarfile.BLOCKSIZE)
+
+            out.write(header)
+            shutil.copyfileobj(data, out, COPY_CHUNK_SIZE)
+            out.write(padding)
+
+        return len(header), size, len(header) + size + len(padding)
+
+    def _tar_trailer(self):
+        """End-of-archive blocks, padded to a full tar record"""
+        trailer = tarfile.NUL * (tarfile.BLOCKSIZE * 2)
+        trailer += tarfile.NUL * (-(self._tar_offset + len(trailer)) % tarfile.RECORDSIZE)
+        return trailer
 
     def get_path(self, *parts):
         """Get a path suitable for this writer (forward slashes for archives)"""
@@ -100,10 +711,36 @@ class ArchiveWriter:
             # Archives use forward slashes (no base path needed, handled by archive)
             return "/".join(parts)
 
-    def close(self):
-        """Finalize the archive if needed"""
+    def close(self, sync=False):
+        """Finalize the archive if needed
+
+        With sync, an archive file is also forced to stable storage, so its
+        actions can be deleted from the server."""
+        if self.results is not None:
+            self.results.close()
+        if self._manifest_handle is not None:
+            self._manifest_handle.flush()
+            os.fsync(self._manifest_handle.fileno())
+            self._manifest_handle.close()
+            self._manifest_handle = None
+        if self.dedup and self.archive_handle and self._manifest is not None:
+            manifest, self._manifest = self._manifest, None
+            self.write_stream(
+                self.get_path(DEDUP_MANIFEST_NAME),
+                [(json.dumps(entry) + "\n").encode("utf-8") for entry in manifest],
+            )
         if self.archive_handle:
-            self.archive_handle.close()
+            with self.lock:
+                if self.archive_type == "tar":
+                    self.archive_handle.write(self._tar_trailer())
+                elif self.compressor is not None:
+                    self.compressor.write(self._tar_trailer())
+                    self.compressor.close()
+                self.archive_handle.close()
+            if sync:
+                sync_file(self.path)
+            if self.index is not None:
+                self.index.close(self.compressor.blocks if self.compressor else ())
             if self.verbose:
                 print(f"Archive finalized: {self.path}")
 
@@ -115,127 +752,2759 @@ class ArchiveWriter:
         return False
 
 
-def process_action(actid, big_fix, writer, conf, progress_lock, actions_processed, total_actions):
-    """Process a single action in a worker thread
+def sync_file(path):
+    """Force a closed file, and its directory entry, to stable storage"""
+    with open(path, "rb+") as f:
+        os.fsync(f.fileno())
+    if os.name == "posix":
+        fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
 
-    Args:
-        actid: Action tuple from relevance query
-        big_fix: BigfixRESTConnection instance
-        writer: ArchiveWriter instance (thread-safe)
-        conf: Configuration namespace
-        progress_lock: Lock for progress reporting and counter
-        actions_processed: Shared counter (list with single int for mutability)
-        total_actions: Total number of actions to process
 
-    Returns:
-        tuple: (success: bool, actid: tuple, error: Exception or None)
+def segment_path(path, number):
+    """Path of segment number of the archive at path: a.tar.gz -> a.part0003.tar.gz"""
+    lower_path = path.lower()
+    suffix = max((suffix for suffix in SEGMENT_SUFFIXES if lower_path.endswith(suffix)), key=len)
+    return f"{path[:-len(suffix)]}.part{number:04d}{path[-len(suffix):]}"
+
+
+class SegmentedArchiveWriter:
+    """Writes an archive as a series of archives, one per segment
+
+    a.zip is written as a.part0001.zip, a.part0002.zip, and so on. Each
+    segment is an ArchiveWriter of its own, with its own dedup blobs,
+    manifest and index sidecar, so it can be read, expanded, queried and
+    uploaded on its own. The files of a top-level action and of all its
+    MAG member actions go to one segment: write_action_files() and
+    write_mag_files() write inside action_files(action_id), and the first
+    of them takes a lease on the open segment for the action, which
+    action_done() releases once all of its work items have finished.
+    Other files go to the segment open at the time, whatever its size, so
+    the run's action_data.json and execution config are usually in the
+    first segment and the results table is in the last.
+
+    finish_segment() closes the open segment and syncs it to disk, so its
+    actions can be deleted, and the next write starts a new segment. With
+    segment_bytes, an action that finds the open segment at or past that
+    size starts a new one as well; the old segment is closed once the
+    actions still holding it are done, so it can exceed segment_bytes by
+    those actions (a MAG's members included).
     """
-    try:
-        acturl = f"/api/action/{str(actid[0])}"
 
-        # Report action being processed (unless quiet) - with lock
-        if not conf.quiet:
-            with progress_lock:
-                print(f"Archiving action {actid[0]}: {actid[2]} (by {actid[4]})")
+    def __init__(self, path, segment_bytes=0, verbose=False, **options):
+        self.path = path
+        self.archive_type = archive_type_of(path)
+        self.segment_bytes = segment_bytes
+        self.verbose = verbose
+        self.options = options  # ArchiveWriter options for every segment
+        self.dedup = options.get("dedup", False)
+        self.results = None  # One ResultsTable for all segments (--results)
+        self.segments = []  # Paths of the segments started so far
+        self.lock = threading.Lock()
+        self._writers = []  # ArchiveWriter of every segment
+        self._current = None  # Segment new actions are written to
+        self._leases = {}  # ArchiveWriter -> actions and writes holding it
+        self._actions = {}  # Top-level action ID -> the segment its files go to
+        self._local = threading.local()
 
-        # Verbose mode shows the API URL details
-        if conf.verbose:
-            with progress_lock:
-                print(f"  Fetching from API: {acturl}")
+    def _start_segment(self):
+        """Open the next segment (caller holds self.lock)"""
+        path = segment_path(self.path, len(self.segments) + 1)
+        segment = ArchiveWriter(path, verbose=self.verbose, **self.options)
+        self.segments.append(path)
+        self._writers.append(segment)
+        self._leases[segment] = 0
+        self._current = segment
+        return segment
 
-        # Fetch action data from BigFix
-        action = str(big_fix.api_get(acturl))
-        action_status = str(big_fix.api_get(acturl + "/status"))
+    def _retire(self):
+        """Stop writing new actions to the open segment (caller holds self.lock)
 
-        # Create action directory
-        actpath = writer.get_path(actid[4])
-        writer.makedirs(actpath, exist_ok=True)
+        Returns the segment if it is ready to be closed, or None if there is
+        none or actions are still writing to it."""
+        segment, self._current = self._current, None
+        if segment is None or self._leases[segment] > 0:
+            return None
+        del self._leases[segment]
+        return segment
 
-        # Write action files (writer is thread-safe)
-        writer.write_file(
-            writer.get_path(actid[4], f"{str(actid[0])}_action.xml"),
-            action
-        )
-        writer.write_file(
-            writer.get_path(actid[4], f"{str(actid[0])}_result.xml"),
-            action_status
+    def _release(self, segment):
+        """Drop one lease on segment, closing it if it was the last on a retired one"""
+        with self.lock:
+            self._leases[segment] -= 1
+            finished = segment is not self._current and self._leases[segment] == 0
+            if finished:
+                del self._leases[segment]
+        if finished:
+            segment.close(sync=True)
+
+    @contextlib.contextmanager
+    def action_files(self, action_id=None):
+        """Write files to the segment of top-level action action_id (thread-safe)
+
+        The first call for an action picks the open segment and holds it
+        for the action until action_done(action_id)."""
+        if getattr(self._local, "segment", None) is not None:
+            yield
+            return
+
+        retired = None
+        with self.lock:
+            segment = self._actions.get(action_id)
+            if segment is None:
+                segment = self._current
+                full = action_id is not None and self.segment_bytes and segment is not None \
+                    and segment.size >= self.segment_bytes
+                if segment is None or full:
+                    retired = self._retire()
+                    segment = self._start_segment()
+                if action_id is not None:
+                    self._actions[action_id] = segment
+                    self._leases[segment] += 1
+            self._leases[segment] += 1
+        if retired is not None:
+            retired.close(sync=True)
+
+        self._local.segment = segment
+        try:
+            yield
+        finally:
+            self._local.segment = None
+            self._release(segment)
+
+    def action_done(self, action_id):
+        """Release the segment held for a top-level action and its MAG members"""
+        with self.lock:
+            segment = self._actions.pop(action_id, None)
+        if segment is not None:
+            self._release(segment)
+
+    def finish_segment(self):
+        """Close and sync the open segment, once the actions written to it are done"""
+        with self.lock:
+            retired = self._retire()
+        if retired is not None:
+            retired.close(sync=True)
+
+    @property
+    def index(self):
+        """Index sidecar of the segment this thread is writing an action to"""
+        segment = getattr(self._local, "segment", None)
+        return segment.index if segment is not None else None
+
+    @property
+    def dedup_files(self):
+        return sum(segment.dedup_files for segment in self._writers)
+
+    @property
+    def dedup_bytes(self):
+        return sum(segment.dedup_bytes for segment in self._writers)
+
+    @property
+    def dedup_stored_bytes(self):
+        return sum(segment.dedup_stored_bytes for segment in self._writers)
+
+    def makedirs(self, dir_path, exist_ok=True):
+        """No-op: segments are archives"""
+
+    def write_file(self, file_path, content, dedup=False):
+        """Write a file to the segment of this thread's action, or the open one"""
+        with self.action_files():
+            self._local.segment.write_file(file_path, content, dedup=dedup)
+
+    def write_stream(self, file_path, chunks):
+        """Write a file from bytes chunks to the segment of this thread's action, or the open one"""
+        with self.action_files():
+            self._local.segment.write_stream(file_path, chunks)
+
+    def get_path(self, *parts):
+        """Get a path within the archive (forward slashes)"""
+        return "/".join(parts)
+
+    def close(self, sync=False):
+        """Add the results table and close the open segment (always synced)"""
+        if self.results is not None:
+            self.results.close()
+        self.finish_segment()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
+
+
+def read_manifest_lines(fileobj):
+    """Yield the entries of a dedup manifest, skipping a partial last line"""
+    for line in fileobj:
+        try:
+            yield json.loads(line)
+        except ValueError:
+            continue
+
+
+class ArchiveReader:
+    """Read access to the files of a directory or archive written by ArchiveWriter
+
+    Member names are relative paths with forward slashes, whatever the
+    output type.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.archive_type = archive_type_of(path)
+        self.archive_handle = None
+
+        if self.archive_type == "zip":
+            self.archive_handle = zipfile.ZipFile(path, "r")
+        elif self.archive_type in ("tar", "tar.gz", "tar.xz"):
+            self.archive_handle = tarfile.open(path, "r:*")
+        elif not os.path.isdir(path):
+            raise FileNotFoundError(f"No such archive or directory: {path}")
+
+    def names(self):
+        """List the files (not directories) in the archive"""
+        if self.archive_type == "zip":
+            return [info.filename for info in self.archive_handle.infolist()
+                    if not info.is_dir()]
+        if self.archive_type in ("tar", "tar.gz", "tar.xz"):
+            return [member.name for member in self.archive_handle.getmembers()
+                    if member.isfile()]
+
+        names = []
+        for root, _dirs, files in os.walk(self.path):
+            for name in files:
+                rel_path = os.path.relpath(os.path.join(root, name), self.path)
+                names.append(rel_path.replace(os.sep, "/"))
+        return sorted(names)
+
+    def open(self, name):
+        """Open one file for reading as a binary file object"""
+        if self.archive_type == "zip":
+            return self.archive_handle.open(name)
+        if self.archive_type in ("tar", "tar.gz", "tar.xz"):
+            return self.archive_handle.extractfile(name)
+        return open(os.path.join(self.path, *name.split("/")), "rb")
+
+    def read_manifest(self):
+        """Return the dedup manifest as {path: sha256}, or {} if there is none
+
+        Later entries for a path win, as a resumed run may rewrite a file."""
+        if self.archive_type == "directory":
+            present = os.path.exists(os.path.join(self.path, DEDUP_MANIFEST_NAME))
+        else:
+            present = DEDUP_MANIFEST_NAME in self.names()
+        if not present:
+            return {}
+        with self.open(DEDUP_MANIFEST_NAME) as f:
+            return {entry["path"]: entry["sha256"] for entry in read_manifest_lines(f)}
+
+    def close(self):
+        if self.archive_handle:
+            self.archive_handle.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
+
+
+def expand_archive(source, dest, verbose=False, index=False):
+    """Copy an archive into dest, replacing deduplicated files by their content
+
+    dest may be a directory or any archive type. Blobs and the manifest are
+    not copied, so the result has the plain per-operator layout. Returns the
+    number of files written."""
+    files_written = 0
+    with ArchiveReader(source) as reader:
+        manifest = reader.read_manifest()
+        writer = ArchiveWriter(dest, verbose=verbose, index=index)
+        try:
+            def copy(name, member):
+                parts = name.split("/")
+                if len(parts) > 1:
+                    writer.makedirs(writer.get_path(*parts[:-1]), exist_ok=True)
+                with reader.open(member) as f:
+                    writer.write_stream(writer.get_path(*parts), iter_file_chunks(f))
+
+            for name in reader.names():
+                if name == DEDUP_MANIFEST_NAME or name.startswith(DEDUP_BLOB_DIR + "/"):
+                    continue
+                copy(name, name)
+                files_written += 1
+            for name, digest in manifest.items():
+                copy(name, "/".join((DEDUP_BLOB_DIR, digest[:2], digest)))
+                files_written += 1
+        finally:
+            writer.close()
+    return files_written
+
+
+class ShardMerger:
+    """Combines the outputs of disjoint shards into one output
+
+    Used for the shards of --processes and by the merge command. The files
+    of an action are in exactly one shard and are copied as they are:
+    moved into place (with move) or copied for directory output, copied
+    still deflated for zip output, and re-encoded for tar output
+    (compressed on the writer's BlockCompressor for tar.gz and tar.xz).
+    The files every shard has its own copy of are combined: the
+    action_data.json rows, the checkpoint journal, the results table and
+    the dedup manifest. Blobs are named by their content, so each one is
+    copied once. For archive output, the action and link rows of each
+    shard's index sidecar are merged too; a directory shard, which has no
+    index, is indexed from its META files and dedup manifest.
+    """
+
+    def __init__(self, writer, move=False):
+        self.writer = writer
+        self.move = move
+        self.rows = {}  # action ID -> selection row from action_data.json
+        self.configs = []  # execution_config_data.json of each shard
+        self.files = 0
+        self._blobs = set()
+
+    def add(self, path):
+        """Merge the shard at path (a directory or archive)"""
+        index = self.writer.index
+        shard_index = path + INDEX_SUFFIX
+        if index is not None and os.path.exists(shard_index):
+            index.merge(shard_index)
+            index = None
+
+        with ArchiveReader(path) as reader:
+            names = reader.names()
+            if index is not None:
+                self._index_actions(reader, names)
+            for name in names:
+                if name == "action_data.json":
+                    with reader.open(name) as f:
+                        for row in json.load(f).get("result", []):
+                            self.rows[row[0]] = row
+                elif name == "execution_config_data.json":
+                    with reader.open(name) as f:
+                        self.configs.append(json.load(f))
+                elif name == JOURNAL_NAME:
+                    self._merge_journal(reader, name)
+                elif name in RESULTS_NAMES.values():
+                    self._merge_results(reader, name)
+                elif name == DEDUP_MANIFEST_NAME:
+                    with reader.open(name) as f:
+                        for entry in read_manifest_lines(f):
+                            self.writer.add_manifest_entry(entry)
+                            if index is not None:
+                                digest = entry["sha256"]
+                                index.add_link(entry["path"], "/".join((DEDUP_BLOB_DIR, digest[:2], digest)))
+                elif name.startswith(DEDUP_BLOB_DIR + "/") and name in self._blobs:
+                    continue
+                else:
+                    if name.startswith(DEDUP_BLOB_DIR + "/"):
+                        self._blobs.add(name)
+                    self._copy(reader, name)
+                    self.files += 1
+
+    def _index_actions(self, reader, names):
+        """Index the actions of a shard without an index from its META files
+
+        MAG sub-actions take the issuer and issued time of their MAG; their
+        name and state are not in the shard's files and are left empty."""
+        parents = {}
+        for name in names:
+            operator, _, filename = name.partition("/")
+            if "/" in filename or not filename.endswith("_META.txt"):
+                continue
+            with reader.open(name) as f:
+                actid = json.load(f)
+            parents[str(actid[0])] = actid
+            prefix = f"{operator}/{actid[0]}"
+            self.writer.index.add_action(actid, {
+                "action": f"{prefix}_action.xml", "result": f"{prefix}_result.xml", "meta": name,
+            })
+
+        for name in names:
+            parts = name.split("/")
+            if len(parts) != 3 or not parts[1].endswith("_MAG") or not parts[2].endswith("_result.xml"):
+                continue
+            parent = parents.get(parts[1][:-len("_MAG")])
+            member_id = parts[2][:-len("_result.xml")]
+            if parent is None or not member_id.isdigit():
+                continue
+            self.writer.index.add_action((int(member_id), None, None), {
+                "action": name[:-len("_result.xml")] + "_action.xml", "result": name,
+            }, mag_parent=parent)
+
+    def _copy(self, reader, name):
+        writer = self.writer
+        parts = name.split("/")
+        dest = writer.get_path(*parts)
+        if self.move and reader.archive_type == "directory" and writer.archive_type == "directory":
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            os.replace(os.path.join(reader.path, *parts), dest)
+        elif reader.archive_type == "zip" and writer.archive_type == "zip":
+            writer.copy_zip_member(reader.archive_handle, reader.archive_handle.getinfo(name))
+        else:
+            if len(parts) > 1:
+                writer.makedirs(writer.get_path(*parts[:-1]), exist_ok=True)
+            with reader.open(name) as f:
+                writer.write_stream(dest, iter_file_chunks(f))
+
+    def _merge_journal(self, reader, name):
+        # Only directory output keeps a journal
+        if self.writer.archive_type != "directory":
+            return
+        with reader.open(name) as src, open(self.writer.get_path(JOURNAL_NAME), "ab") as dest:
+            for line in src:
+                if line.endswith(b"\n"):
+                    dest.write(line)
+
+    def _merge_results(self, reader, name):
+        fmt = "sqlite" if name == RESULTS_NAMES["sqlite"] else "jsonl"
+        if self.writer.results is None:
+            self.writer.results = ResultsTable(self.writer, fmt)
+        if reader.archive_type == "directory":
+            self.writer.results.merge(os.path.join(reader.path, name))
+            return
+
+        fd, path = tempfile.mkstemp(suffix="." + fmt)
+        try:
+            with os.fdopen(fd, "wb") as dest, reader.open(name) as src:
+                shutil.copyfileobj(src, dest, COPY_CHUNK_SIZE)
+            self.writer.results.merge(path)
+        finally:
+            os.remove(path)
+
+    def merged_config(self):
+        """One execution config for the shards: the options they share, and
+        under "shards" the options that differ, per shard"""
+        keys = set().union(*self.configs) if self.configs else set()
+        shared = {
+            key for key in keys
+            if all(key in config and config[key] == self.configs[0][key] for config in self.configs)
+        }
+        merged = {key: self.configs[0][key] for key in shared}
+        merged["shards"] = [
+            {key: value for key, value in config.items() if key not in shared}
+            for config in self.configs
+        ]
+        return merged
+
+    def write_action_data(self, query):
+        """Write action_data.json with the rows of every shard, by action ID"""
+        rows = [self.rows[action_id] for action_id in sorted(self.rows)]
+        self.writer.write_file(
+            self.writer.get_path("action_data.json"),
+            json.dumps({"plural": True, "query": query, "result": rows}, sort_keys=True, indent=4),
         )
-        writer.write_file(
-            writer.get_path(actid[4], f"{str(actid[0])}_META.txt"),
-            json.dumps(actid, sort_keys=True, indent=4)
+
+
+def result_time(text):
+    """Convert a BigFix result timestamp to ISO 8601 (unchanged if unparsable)"""
+    if not text:
+        return None
+    try:
+        return parsedate_to_datetime(text).isoformat()
+    except (TypeError, ValueError):
+        return text
+
+
+def utc_time(text):
+    """ISO 8601 text as fixed-width UTC text that sorts in time order
+    (a time without an offset is taken as UTC); None if unparsable"""
+    if not text:
+        return None
+    try:
+        value = datetime.fromisoformat(text.strip().replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%f")
+
+
+def result_int(text):
+    try:
+        return int(text)
+    except (TypeError, ValueError):
+        return None
+
+
+def result_row(computer, action_id, parent_id=None):
+    """Results table row for one <Computer> element of an action status document"""
+    def child_text(tag):
+        child = computer.find(tag)
+        return child.text if child is not None else None
+
+    state = computer.find("State")
+    is_error = None
+    if state is not None and state.get("IsError") is not None:
+        is_error = 1 if state.get("IsError") in ("1", "true") else 0
+    return {
+        "action_id": action_id,
+        "parent_id": parent_id,
+        "computer_id": result_int(computer.get("ID")),
+        "computer_name": computer.get("Name"),
+        "status": child_text("Status"),
+        "state": state.text if state is not None else None,
+        "is_error": is_error,
+        "apply_count": result_int(child_text("ApplyCount")),
+        "start_time": result_time(child_text("StartTime")),
+        "end_time": result_time(child_text("EndTime")),
+    }
+
+
+class ResultsTable:
+    """Per-endpoint rows extracted from action status documents (--results)
+
+    tap() wraps a status chunk stream: the chunks pass through unchanged to
+    the writer while an XMLPullParser picks out each <Computer> element and
+    drops it once its row is taken, so memory stays constant however many
+    endpoints an action has. An action's rows are spooled and added to the
+    table only once its whole status document has been read.
+
+    The table is action_results.jsonl (one JSON object per row) or
+    action_results.sqlite (table "results") at the top of the output. For
+    archive output it is built in a temporary file and added to the archive
+    by close(), before the archive is finalized. With keep_actions (--resume)
+    an existing table is kept, minus rows of actions not in keep_actions.
+    """
+
+    def __init__(self, writer, fmt, keep_actions=None):
+        self.writer = writer
+        self.format = fmt
+        self.name = RESULTS_NAMES[fmt]
+        self.lock = threading.Lock()
+        self.rows = 0
+        self.parse_errors = 0
+        self.db = None
+        self.handle = None
+
+        if writer.archive_type == "directory":
+            self.path = writer.get_path(self.name)
+            self._temporary = False
+        else:
+            fd, self.path = tempfile.mkstemp(suffix="." + fmt)
+            os.close(fd)
+            self._temporary = True
+            keep_actions = None
+
+        if keep_actions is None and os.path.exists(self.path):
+            os.remove(self.path)
+
+        if fmt == "sqlite":
+            self.db = sqlite3.connect(self.path, check_same_thread=False)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS results (action_id INTEGER NOT NULL, "
+                "parent_id INTEGER, computer_id INTEGER, computer_name TEXT, status TEXT, "
+                "state TEXT, is_error INTEGER, apply_count INTEGER, start_time TEXT, "
+                "end_time TEXT)"
+            )
+            if keep_actions is not None:
+                self._prune_sqlite(keep_actions)
+            self.db.commit()
+        else:
+            if keep_actions is not None and os.path.exists(self.path):
+                self._prune_jsonl(keep_actions)
+            self.handle = open(self.path, "ab")
+
+    def _prune_sqlite(self, keep_actions):
+        self.db.execute("CREATE TEMP TABLE keep_actions (id INTEGER PRIMARY KEY)")
+        self.db.executemany("INSERT INTO keep_actions VALUES (?)",
+                            ((action_id,) for action_id in keep_actions))
+        self.db.execute("DELETE FROM results WHERE coalesce(parent_id, action_id) "
+                        "NOT IN (SELECT id FROM keep_actions)")
+        self.db.execute("DROP TABLE keep_actions")
+
+    def _prune_jsonl(self, keep_actions):
+        pruned_path = self.path + ".tmp"
+        with open(self.path, "rb") as old, open(pruned_path, "wb") as new:
+            for line in old:
+                try:
+                    row = json.loads(line)
+                except ValueError:
+                    continue
+                owner = row["parent_id"] if row.get("parent_id") is not None else row["action_id"]
+                if owner in keep_actions:
+                    new.write(line)
+        os.replace(pruned_path, self.path)
+
+    def tap(self, chunks, action_id, parent_id=None):
+        """Yield chunks unchanged, collecting the rows of the document they form
+
+        A document that is not well-formed XML is still archived; it is
+        counted in parse_errors and contributes no rows."""
+        parser = ET.XMLPullParser(events=("start", "end"))
+        open_elements = []
+        parsing = True
+        with tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_BYTES) as rows:
+            for chunk in chunks:
+                if parsing:
+                    try:
+                        parser.feed(chunk)
+                        for event, elem in parser.read_events():
+                            if event == "start":
+                                open_elements.append(elem)
+                                continue
+                            open_elements.pop()
+                            if elem.tag == "Computer":
+                                row = result_row(elem, action_id, parent_id)
+                                rows.write(json.dumps(row).encode("utf-8") + b"\n")
+                                elem.clear()
+                                if open_elements:
+                                    open_elements[-1].remove(elem)
+                    except ET.ParseError:
+                        parsing = False
+                yield chunk
+
+            if parsing:
+                try:
+                    parser.close()
+                except ET.ParseError:
+                    parsing = False
+            if not parsing:
+                with self.lock:
+                    self.parse_errors += 1
+                return
+            rows.seek(0)
+            self._add_rows(rows)
+
+    def _add_rows(self, rows):
+        """Append one action's spooled JSON lines to the table"""
+        with self.lock:
+            if self.handle is not None:
+                for line in rows:
+                    self.handle.write(line)
+                    self.rows += 1
+                self.handle.flush()
+                return
+
+            batch = []
+            for line in rows:
+                row = json.loads(line)
+                batch.append(tuple(row[column] for column in RESULT_COLUMNS))
+                if len(batch) >= RESULT_INSERT_BATCH:
+                    self._insert(batch)
+                    batch = []
+            if batch:
+                self._insert(batch)
+            self.db.commit()
+
+    def merge(self, path):
+        """Append the rows of another table file of the same format"""
+        with self.lock:
+            if self.db is not None:
+                self.db.execute("ATTACH DATABASE ? AS other", (path,))
+                columns = ", ".join(RESULT_COLUMNS)
+                cursor = self.db.execute(
+                    f"INSERT INTO results ({columns}) SELECT {columns} FROM other.results"
+                )
+                self.rows += cursor.rowcount
+                self.db.commit()
+                self.db.execute("DETACH DATABASE other")
+                return
+
+            with open(path, "rb") as f:
+                for line in f:
+                    self.handle.write(line)
+                    self.rows += 1
+            self.handle.flush()
+
+    def sync(self):
+        """Force the rows added so far to disk (directory output)"""
+        if self._temporary:
+            return
+        with self.lock:
+            if self.db is not None:
+                self.db.execute("PRAGMA wal_checkpoint(FULL)")
+            elif self.handle is not None:
+                self.handle.flush()
+                os.fsync(self.handle.fileno())
+
+    def _insert(self, batch):
+        self.db.executemany(
+            f"INSERT INTO results ({', '.join(RESULT_COLUMNS)}) "
+            f"VALUES ({', '.join('?' * len(RESULT_COLUMNS))})",
+            batch,
         )
+        self.rows += len(batch)
 
-        # If we are a multiple action group, handle MAG sub-actions
-        if actid[5]:
-            mag_query = f"""
-            (id of it, state of it, name of it) of member actions of bes action
-              whose (id of it = {actid[0]})
-            """
-            mag_components = big_fix.relevance_query_json(mag_query)
+    def close(self):
+        """Finish the table and, for archive output, add it to the archive"""
+        with self.lock:
+            if self.db is not None:
+                self.db.execute("CREATE INDEX IF NOT EXISTS results_action ON results (action_id)")
+                self.db.execute("CREATE INDEX IF NOT EXISTS results_computer "
+                                "ON results (computer_name)")
+                self.db.commit()
+                self.db.execute("PRAGMA journal_mode=DELETE")
+                self.db.close()
+                self.db = None
+            if self.handle is not None:
+                if not self._temporary:
+                    self.handle.flush()
+                    os.fsync(self.handle.fileno())
+                self.handle.close()
+                self.handle = None
+
+        if self._temporary:
+            try:
+                with open(self.path, "rb") as f:
+                    self.writer.write_stream(self.writer.get_path(self.name), iter_file_chunks(f))
+            finally:
+                os.remove(self.path)
+            self._temporary = False
+
+
+class ArchiveIndex:
+    """SQLite sidecar index of an archive, for random access (see query)
+
+    Tables:
+      members(name, offset, size, compressed_size, method): where each member's
+        data starts -- a file offset for zip and tar, an offset into the
+        uncompressed tar stream for tar.gz and tar.xz
+      blocks(raw_offset, raw_size, offset, size): the independently
+        compressed blocks of tar.gz and tar.xz output
+      actions(action_id, name, issuer, issued, state, mag_parent)
+      action_files(action_id, kind, name): the action, result and meta file
+        of each action
+      links(name, target): deduplicated files and the blob holding them
+
+    Rows are buffered and inserted in batches; close() writes the block
+    table and builds the secondary indexes.
+    """
+
+    def __init__(self, archive_path, archive_type):
+        self.path = archive_path + INDEX_SUFFIX
+        self.lock = threading.Lock()
+        self._pending = {"members": [], "actions": [], "action_files": [], "links": []}
+
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        self.db.executescript("""
+            CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE members (name TEXT PRIMARY KEY, offset INTEGER, size INTEGER,
+                                  compressed_size INTEGER, method INTEGER);
+            CREATE TABLE blocks (raw_offset INTEGER PRIMARY KEY, raw_size INTEGER,
+                                 offset INTEGER, size INTEGER);
+            CREATE TABLE actions (action_id INTEGER PRIMARY KEY, name TEXT, issuer TEXT,
+                                  issued TEXT, state TEXT, mag_parent INTEGER);
+            CREATE TABLE action_files (action_id INTEGER, kind TEXT, name TEXT,
+                                       PRIMARY KEY (action_id, kind));
+            CREATE TABLE links (name TEXT PRIMARY KEY, target TEXT);
+        """)
+        self.db.executemany("INSERT INTO meta VALUES (?, ?)", [
+            ("archive", os.path.basename(archive_path)),
+            ("archive_type", archive_type),
+            ("version", VERSION),
+        ])
+
+    def _add(self, table, row):
+        with self.lock:
+            pending = self._pending[table]
+            pending.append(row)
+            if len(pending) >= INDEX_INSERT_BATCH:
+                self._flush(table)
+
+    def _flush(self, table):
+        """Insert the buffered rows of one table (caller holds lock)"""
+        rows = self._pending[table]
+        if rows:
+            placeholders = ", ".join("?" * len(rows[0]))
+            self.db.executemany(f"INSERT OR REPLACE INTO {table} VALUES ({placeholders})", rows)
+            self._pending[table] = []
+
+    def add_member(self, name, offset, size, compressed_size=None, method=None):
+        self._add("members", (name, offset, size, compressed_size, method))
+
+    def add_link(self, name, target):
+        self._add("links", (name, target))
+
+    def add_action(self, actid, files, mag_parent=None):
+        """Index an action (a selection row) and its files, {kind: member name}
+
+        MAG sub-actions, given as (id, state, name), take the issuer and
+        issued time of their parent selection row mag_parent."""
+        if mag_parent is None:
+            row = (actid[0], actid[2], actid[4], result_time(actid[3]), actid[1], None)
+        else:
+            row = (actid[0], actid[2], mag_parent[4], result_time(mag_parent[3]), actid[1],
+                   mag_parent[0])
+        self._add("actions", row)
+        for kind, name in files.items():
+            self._add("action_files", (actid[0], kind, name))
+
+    def merge(self, path):
+        """Copy the action, action file and link rows of another index
+
+        Member and block rows describe the other archive's layout, so they
+        are not copied."""
+        with self.lock:
+            for table in ("actions", "action_files", "links"):
+                self._flush(table)
+            self.db.execute("ATTACH DATABASE ? AS other", (path,))
+            for table in ("actions", "action_files", "links"):
+                self.db.execute(f"INSERT OR REPLACE INTO {table} SELECT * FROM other.{table}")
+            self.db.commit()
+            self.db.execute("DETACH DATABASE other")
+
+    def close(self, blocks=()):
+        with self.lock:
+            for table in self._pending:
+                self._flush(table)
+            self.db.executemany("INSERT INTO blocks VALUES (?, ?, ?, ?)", blocks)
+            self.db.executescript("""
+                CREATE INDEX actions_name ON actions (name);
+                CREATE INDEX actions_issuer ON actions (issuer);
+                CREATE INDEX actions_issued ON actions (issued);
+                CREATE INDEX actions_mag_parent ON actions (mag_parent);
+            """)
+            self.db.commit()
+            self.db.close()
+
+
+class IndexedArchive:
+    """Random access to an archive through its ArchiveIndex sidecar
+
+    Reads only the bytes of the members asked for: a seek and a read for
+    zip and tar, and the decompression of the blocks holding the member
+    for tar.gz and tar.xz.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        index_path = path + INDEX_SUFFIX
+        if not os.path.exists(index_path):
+            raise FileNotFoundError(f"No index for {path} (expected {index_path})")
+        self.db = sqlite3.connect(f"file:{index_path}?mode=ro", uri=True)
+        self.db.create_function("utc_time", 1, utc_time, deterministic=True)
+        self.archive_type = dict(self.db.execute("SELECT key, value FROM meta"))["archive_type"]
+        self.handle = open(path, "rb")
+
+    def find_actions(self, ids=None, name=None, issuer=None, since=None, until=None,
+                     mag_parent=None):
+        """Return matching (action_id, name, issuer, issued, state, mag_parent) rows
+
+        since and until are ISO 8601 times; they and the issued times, which
+        keep the offset the server gave, are compared in UTC."""
+        clauses = []
+        params = []
+        if ids:
+            clauses.append(f"action_id IN ({', '.join('?' * len(ids))})")
+            params.extend(ids)
+        if name:
+            clauses.append("name LIKE ?")
+            params.append(f"%{name}%")
+        if issuer:
+            clauses.append("issuer = ?")
+            params.append(issuer)
+        if since:
+            clauses.append("utc_time(issued) >= ?")
+            params.append(utc_time(since))
+        if until:
+            clauses.append("utc_time(issued) < ?")
+            params.append(utc_time(until))
+        if mag_parent is not None:
+            clauses.append("mag_parent = ?")
+            params.append(mag_parent)
+        where = " WHERE " + " AND ".join(clauses) if clauses else ""
+        return self.db.execute(
+            f"SELECT action_id, name, issuer, issued, state, mag_parent FROM actions{where} "
+            "ORDER BY action_id", params
+        ).fetchall()
+
+    def action_files(self, action_id):
+        """Return {kind: member name} for one action"""
+        return dict(self.db.execute(
+            "SELECT kind, name FROM action_files WHERE action_id = ?", (action_id,)
+        ))
+
+    def iter_member(self, name):
+        """Yield the content of one member in chunks"""
+        link = self.db.execute("SELECT target FROM links WHERE name = ?", (name,)).fetchone()
+        if link is not None:
+            name = link[0]
+        member = self.db.execute(
+            "SELECT offset, size, compressed_size, method FROM members WHERE name = ?", (name,)
+        ).fetchone()
+        if member is None:
+            raise KeyError(f"{name} is not in the archive index")
+        offset, size, compressed_size, method = member
+
+        if self.archive_type in ("tar.gz", "tar.xz"):
+            yield from self._iter_blocks(offset, size)
+            return
+
+        # zip and tar members are contiguous in the file
+        self.handle.seek(offset)
+        remaining = compressed_size if self.archive_type == "zip" else size
+        decompressor = None
+        if self.archive_type == "zip" and method == zipfile.ZIP_DEFLATED:
+            decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        while remaining > 0:
+            data = self.handle.read(min(COPY_CHUNK_SIZE, remaining))
+            if not data:
+                raise EOFError(f"{self.path} is truncated")
+            remaining -= len(data)
+            yield decompressor.decompress(data) if decompressor else data
+        if decompressor:
+            yield decompressor.flush()
+
+    def _iter_blocks(self, offset, size):
+        """Yield size bytes of the tar stream at offset from the compressed blocks"""
+        blocks = self.db.execute(
+            "SELECT raw_offset, raw_size, offset, size FROM blocks "
+            "WHERE raw_offset + raw_size > ? AND raw_offset < ? ORDER BY raw_offset",
+            (offset, offset + size),
+        ).fetchall()
+        for raw_offset, raw_size, block_offset, block_size in blocks:
+            self.handle.seek(block_offset)
+            data = self.handle.read(block_size)
+            if self.archive_type == "tar.gz":
+                data = zlib.decompress(data, 16 + zlib.MAX_WBITS)
+            else:
+                data = lzma.decompress(data, format=lzma.FORMAT_XZ)
+            start = max(offset - raw_offset, 0)
+            end = min(offset + size - raw_offset, raw_size)
+            yield data[start:end]
+
+    def close(self):
+        self.db.close()
+        self.handle.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
+
+
+class ArchiveJournal:
+    """Append-only checkpoint journal of archived and deleted actions
+
+    One JSON object per line: {"id": 123, "state": "archived"|"deleted",
+    "time": "..."}. An action is journaled as archived only after all of its
+    files have been written, and as deleted only after the server confirmed
+    the DELETE, so --resume can skip finished work after a crash. A partial
+    last line left by a crash is ignored when the journal is loaded.
+
+    Records are written and fsynced JOURNAL_SYNC_EVERY at a time, and by
+    sync(). Before each write, before_sync (the writer's sync_written) makes
+    the files of the recorded actions durable, so the journal never gets
+    ahead of the files on disk. Records lost in a crash only mean the
+    actions are archived again on --resume.
+    """
+
+    def __init__(self, path, resume=False, before_sync=None):
+        self.path = path
+        self.lock = threading.Lock()
+        self.archived = set()
+        self.deleted = set()
+        self.before_sync = before_sync
+        self._pending = []  # Record lines not yet written
+
+        if resume and os.path.exists(path):
+            self._load()
+        self.handle = open(path, "a" if resume else "w", encoding="utf-8")
+
+    def _load(self):
+        """Read the states recorded by a previous run"""
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if record.get("state") == "archived":
+                    self.archived.add(record["id"])
+                elif record.get("state") == "deleted":
+                    self.deleted.add(record["id"])
+
+    def record(self, action_id, state):
+        """Append one state record (thread-safe)"""
+        line = json.dumps({
+            "id": action_id,
+            "state": state,
+            "time": datetime.now().isoformat(timespec="seconds"),
+        })
+        with self.lock:
+            self._pending.append(line + "\n")
+            if state == "archived":
+                self.archived.add(action_id)
+            else:
+                self.deleted.add(action_id)
+            if len(self._pending) >= JOURNAL_SYNC_EVERY:
+                self._write_pending()
+
+    def _write_pending(self):
+        """Write and fsync the pending records (caller holds lock)"""
+        if self.before_sync is not None:
+            self.before_sync()
+        self.handle.writelines(self._pending)
+        self._pending = []
+        self.handle.flush()
+        os.fsync(self.handle.fileno())
+
+    def sync(self):
+        """Force the journal, and the files it records, to stable storage"""
+        with self.lock:
+            self._write_pending()
+
+    def close(self):
+        """Sync and close the journal"""
+        if not self.handle.closed:
+            self.sync()
+            self.handle.close()
+
+
+class ActionSpool:
+    """Action rows spooled to a temporary file, in the order appended
+
+    Holds the actions collected over a whole run (the deletions of an
+    unbatched run and of a resumed one), which would otherwise grow with
+    the selection. Rows are read back as lists.
+    """
+
+    def __init__(self):
+        self._file = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_BYTES)
+        self._count = 0
+
+    def append(self, actid):
+        self._file.seek(0, os.SEEK_END)
+        self._file.write(json.dumps(actid).encode("utf-8") + b"\n")
+        self._count += 1
+
+    def extend(self, actids):
+        for actid in actids:
+            self.append(actid)
+
+    def clear(self):
+        self._file.seek(0)
+        self._file.truncate()
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def __iter__(self):
+        position = 0
+        while True:
+            self._file.seek(position)
+            line = self._file.readline()
+            if not line:
+                return
+            position = self._file.tell()
+            yield json.loads(line)
+
+
+def is_archive_path(path):
+    """True if the output path names an archive file rather than a directory"""
+    return archive_type_of(path) != "directory"
+
+
+class RunStats:
+    """Run-wide counters for the performance summary (thread-safe)"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.actions_deleted = 0
+        self.delete_seconds = 0.0
+        self.limiter = None  # AdaptiveLimiter with --threads auto
+        self.retry_policy = None
+        self.breaker = None
+        self.transfer = None  # bigfixREST.TransferStats
+        self.writer = None  # ArchiveWriter, for --dedup savings
+
+    def add_deletes(self, count, seconds):
+        """Account for one delete phase"""
+        with self.lock:
+            self.actions_deleted += count
+            self.delete_seconds += seconds
+
+
+def delete_action(actid, big_fix, conf, journal, progress_lock):
+    """Delete a single archived action from the server in a worker thread
+
+    Returns:
+        tuple: (deleted: bool, actid: tuple, error: BigfixAPIError or None)
+    """
+    durl = f"/api/action/{str(actid[0])}"
+
+    # Verbose mode shows the API details
+    if conf.verbose:
+        with progress_lock:
+            print(f"  Running REST API: DELETE {durl}")
+
+    try:
+        with runtrace.span("delete", "delete", id=actid[0]):
+            delres = big_fix.api_delete(durl)
+    except BigfixAPIError as e:
+        with progress_lock:
+            print(f"ERROR deleting action {actid[0]}: {e}")
+            print(f"Archive is complete but some actions may not have been deleted.")
+        return (False, actid, e)
+
+    if delres != b"ok":
+        with progress_lock:
+            print(
+                f"WARNING: [DELETE https://{conf.bfserver}:{conf.bfport}{durl}] returned {delres}."
+            )
+        return (False, actid, None)
+
+    if journal is not None:
+        journal.record(actid[0], "deleted")
+    if not conf.quiet:
+        with progress_lock:
+            print(f"  Deleted action {actid[0]}: {actid[2]}")
+    return (True, actid, None)
+
+
+def pending_limit(conf, workers):
+    """Most work items to keep submitted to a pool of workers at once"""
+    return conf.max_pending or workers * PENDING_PER_WORKER
+
+
+def delete_actions(big_fix, actions, conf, journal=None, stats=None, stop_on_error=False):
+    """Delete archived actions from the server on a bounded worker pool
+
+    Callers must only pass actions whose archive files are already durable.
+    Up to --delete-threads (default: --threads) DELETE requests run at once
+    and each one is reported as it completes. Deletions are submitted as
+    earlier ones finish, so only a few are queued at any time.
+
+    Returns:
+        list of (actid, error) for the deletions that failed. With
+        stop_on_error, deletions not yet started are cancelled after the
+        first failure.
+    """
+    errors = []
+    deleted = 0
+    progress_lock = threading.Lock()
+    start = time.time()
+
+    workers = conf.delete_threads or conf.threads
+    limit = pending_limit(conf, workers)
+    remaining = iter(actions)
+    stopped = False
+    with runtrace.span("delete", "phase", actions=len(actions)), \
+            concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = set()
+        while True:
+            while not stopped and len(futures) < limit:
+                actid = next(remaining, None)
+                if actid is None:
+                    break
+                futures.add(executor.submit(
+                    runtrace.profiled(delete_action), actid, big_fix, conf, journal, progress_lock
+                ))
+            if not futures:
+                break
+
+            done, futures = concurrent.futures.wait(
+                futures, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in done:
+                if future.cancelled():
+                    continue
+                success, actid, error = future.result()
+                if success:
+                    deleted += 1
+                elif error is not None:
+                    errors.append((actid, error))
+                    if stop_on_error:
+                        # Deletions already running finish and are still counted
+                        stopped = True
+                        for pending in futures:
+                            pending.cancel()
+
+    if stats is not None:
+        stats.add_deletes(deleted, time.time() - start)
+
+    return errors
+
+
+def report_fetch(message, url, conf, progress_lock, indent="  "):
+    """Print a progress line (unless quiet) and the API URL (if verbose)"""
+    if not conf.quiet:
+        with progress_lock:
+            print(message)
+
+    if conf.verbose:
+        with progress_lock:
+            print(f"{indent}Fetching from API: {url}")
+
+
+def report_action_done(conf, progress_lock, actions_processed, total_actions):
+    """Increment the shared counter and report progress if needed"""
+    with progress_lock:
+        actions_processed[0] += 1
+        if (not conf.quiet and
+            conf.progress > 0 and
+            actions_processed[0] % conf.progress == 0 and
+            actions_processed[0] < total_actions):
+            remaining = total_actions - actions_processed[0]
+            percentage = (actions_processed[0] / total_actions) * 100
+            print(f"Progress: {actions_processed[0]}/{total_actions} actions archived ({percentage:.1f}% complete, {remaining} remaining)")
+
+
+def write_action_files(writer, actid, action, action_status):
+    """Write the action, result and META files of one top-level action
+
+    action_status is an iterable of bytes chunks (see api_get_stream), so
+    with a streamed response its transfer is part of the "write files" span."""
+    if writer.results is not None:
+        action_status = writer.results.tap(action_status, actid[0])
+
+    with writer.action_files(actid[0]), runtrace.span("write files", "write", id=actid[0]):
+        # Create action directory
+        actpath = writer.get_path(actid[4])
+        writer.makedirs(actpath, exist_ok=True)
+
+        # Write action files (writer is thread-safe)
+        files = {
+            "action": writer.get_path(actid[4], f"{str(actid[0])}_action.xml"),
+            "result": writer.get_path(actid[4], f"{str(actid[0])}_result.xml"),
+            "meta": writer.get_path(actid[4], f"{str(actid[0])}_META.txt"),
+        }
+        writer.write_file(files["action"], action, dedup=True)
+        writer.write_stream(files["result"], action_status)
+        writer.write_file(files["meta"], json.dumps(actid, sort_keys=True, indent=4))
+        if writer.index is not None:
+            writer.index.add_action(actid, files)
+
+
+def write_mag_files(writer, actid, mag_id, mag_action, mag_action_status):
+    """Write the action and result files of one MAG sub-action
+
+    mag_action_status is an iterable of bytes chunks (see api_get_stream)."""
+    if writer.results is not None:
+        mag_action_status = writer.results.tap(mag_action_status, mag_id[0], actid[0])
+
+    with writer.action_files(actid[0]), runtrace.span("write files", "write", id=mag_id[0]):
+        files = {
+            "action": writer.get_path(actid[4], f"{actid[0]}_MAG", f"{str(mag_id[0])}_action.xml"),
+            "result": writer.get_path(actid[4], f"{actid[0]}_MAG", f"{str(mag_id[0])}_result.xml"),
+        }
+        writer.write_file(files["action"], mag_action, dedup=True)
+        writer.write_stream(files["result"], mag_action_status)
+        if writer.index is not None:
+            writer.index.add_action(mag_id, files, mag_parent=actid)
+
+
+def mag_members_query(parent_ids):
+    """Session relevance for the member actions of several MAGs at once
+
+    Each result row is (MAG id, member id, member state, member name)."""
+    id_set = ";".join(str(parent_id) for parent_id in parent_ids)
+    return f"""
+            (id of it, (id of it, state of it, name of it) of member actions of it)
+              of bes actions whose (id of it is contained by set of ({id_set}))
+            """
+
+
+def resolve_mag_members(big_fix, batch, conf):
+    """Look up the member actions of every MAG in a batch up front
+
+    Uses one relevance query per MAG_QUERY_CHUNK MAGs instead of one query
+    per MAG.
+
+    Returns:
+        tuple: (members: dict of MAG id -> list of (id, state, name),
+                errors: dict of MAG id -> Exception for failed lookups)
+    """
+    parent_ids = [actid[0] for actid in batch if actid[5]]
+    members = {parent_id: [] for parent_id in parent_ids}
+    errors = {}
+
+    for i in range(0, len(parent_ids), MAG_QUERY_CHUNK):
+        chunk = parent_ids[i:i + MAG_QUERY_CHUNK]
+        if conf.verbose:
+            print(f"  Resolving member actions of {len(chunk)} MAG(s)")
+        try:
+            with runtrace.span("resolve MAGs", "query", mags=len(chunk)):
+                mag_rows = big_fix.relevance_query_json(mag_members_query(chunk))
+        except BigfixAPIError as e:
+            for parent_id in chunk:
+                errors[parent_id] = e
+            continue
+
+        for row in mag_rows["result"]:
+            members[row[0]].append(row[1:])
+
+    return members, errors
+
+
+def action_costs(big_fix, batch, conf):
+    """Look up the endpoint result counts of a batch's actions
+
+    Uses one relevance query per COST_QUERY_CHUNK actions.
+
+    Returns:
+        dict of action id -> (results, member actions, member results), or
+        None if a query failed (the batch then keeps the query order)
+    """
+    costs = {}
+    ids = [actid[0] for actid in batch]
+    for i in range(0, len(ids), COST_QUERY_CHUNK):
+        id_set = ";".join(str(action_id) for action_id in ids[i:i + COST_QUERY_CHUNK])
+        try:
+            with runtrace.span("action costs", "query", actions=len(ids[i:i + COST_QUERY_CHUNK])):
+                rows = big_fix.relevance_query_json(
+                    f"{COST_PROPERTIES} of bes actions whose (id of it is contained by set of ({id_set}))",
+                    timeout=conf.query_timeout,
+                )["result"]
+        except BigfixAPIError as e:
+            print(f"WARNING: Could not look up action sizes, keeping the query order: {e}")
+            return None
+        for row in rows:
+            costs[int(row[0])] = tuple(int(value) for value in row[1:])
+    return costs
+
+
+def work_item_cost(item, costs):
+    """Endpoint results to download for a work item; MAG members get an even
+    share of their MAG's member results"""
+    actid, mag_id = item
+    results, members, member_results = costs.get(actid[0], (0, 0, 0))
+    if mag_id is None:
+        return results
+    return member_results / members if members else 0
+
+
+def schedule_work_items(batch, mag_members, costs=None):
+    """Expand a batch into work items
+
+    Every action is one item, and every MAG member action is an item of its
+    own, so a large baseline is spread across the pool instead of pinning a
+    single worker. With costs (see action_costs) the items are ordered
+    largest first, so the biggest downloads start early instead of running
+    on alone after everything else has finished.
+
+    Yields:
+        tuple: (actid, mag_id) with mag_id None for the top-level action
+    """
+    items = []
+    for actid in batch:
+        items.append((actid, None))
+        if actid[5]:
+            items.extend((actid, mag_id) for mag_id in mag_members.get(actid[0], []))
+
+    if costs is not None:
+        items.sort(key=lambda item: work_item_cost(item, costs), reverse=True)
+    yield from items
+
+
+class ActionCompletion:
+    """Folds work item results back into one result per top-level action
+
+    An action is finished once its own item and all of its MAG member items
+    have finished; it failed if any of them failed. The writer, if given, is
+    then told that the action's files are complete.
+    """
+
+    def __init__(self, writer=None):
+        self.writer = writer
+        self.pending = {}
+        self.errors = {}
+
+    def add(self, chunk, mag_members, mag_errors):
+        """Register the actions of a chunk before their items are scheduled"""
+        self.errors.update(mag_errors)
+        for actid in chunk:
+            self.pending[actid[0]] = 1 + len(mag_members.get(actid[0], [])) if actid[5] else 1
+
+    def item_done(self, actid, error):
+        """Record one finished item
+
+        Returns:
+            (success, actid, error) once the whole action is finished, else None
+        """
+        if error is not None and actid[0] not in self.errors:
+            self.errors[actid[0]] = error
+
+        self.pending[actid[0]] -= 1
+        if self.pending[actid[0]] > 0:
+            return None
+
+        del self.pending[actid[0]]
+        if self.writer is not None:
+            self.writer.action_done(actid[0])
+        error = self.errors.pop(actid[0], None)
+        return (error is None, actid, error)
+
+
+def process_action(actid, big_fix, writer, conf, progress_lock):
+    """Archive the files of a single top-level action in a worker thread
+
+    Args:
+        actid: Action tuple from relevance query
+        big_fix: BigfixRESTConnection instance
+        writer: ArchiveWriter instance (thread-safe)
+        conf: Configuration namespace
+        progress_lock: Lock for progress reporting
+
+    Returns:
+        tuple: (success: bool, actid: tuple, error: Exception or None)
+    """
+    try:
+        acturl = f"/api/action/{str(actid[0])}"
+        report_fetch(f"Archiving action {actid[0]}: {actid[2]} (by {actid[4]})",
+                     acturl, conf, progress_lock)
+
+        with runtrace.span("action", "action", id=actid[0]):
+            # Fetch action data from BigFix
+            # The status result can be huge, so it is streamed into the writer
+            with runtrace.span("fetch action", "fetch", id=actid[0]):
+                action = str(big_fix.api_get(acturl))
+                action_status = big_fix.api_get_stream(acturl + "/status")
+
+            write_action_files(writer, actid, action, action_status)
+
+            # A MAG gets its directory even if it has no member actions
+            if actid[5]:
+                writer.makedirs(writer.get_path(actid[4], f"{actid[0]}_MAG"), exist_ok=True)
+
+        return (True, actid, None)
+
+    except Exception as e:
+        # Return error, will be handled by main thread
+        return (False, actid, e)
+
+
+def process_mag_action(actid, mag_id, big_fix, writer, conf, progress_lock):
+    """Archive the files of one MAG member action in a worker thread
+
+    Returns:
+        tuple: (success: bool, actid: tuple, error: Exception or None)
+        where actid is the parent MAG action
+    """
+    try:
+        magurl = f"/api/action/{str(mag_id[0])}"
+        report_fetch(f"  - MAG sub-action {mag_id[0]}: {mag_id[2]}",
+                     magurl, conf, progress_lock, indent="    ")
+
+        with runtrace.span("MAG sub-action", "action", id=mag_id[0], mag=actid[0]):
+            # Fetch MAG sub-action data
+            with runtrace.span("fetch action", "fetch", id=mag_id[0]):
+                mag_action = str(big_fix.api_get(magurl))
+                mag_action_status = big_fix.api_get_stream(magurl + "/status")
+
+            writer.makedirs(writer.get_path(actid[4], f"{actid[0]}_MAG"), exist_ok=True)
+            write_mag_files(writer, actid, mag_id, mag_action, mag_action_status)
+
+        return (True, actid, None)
+
+    except Exception as e:
+        return (False, actid, e)
+
+
+async def spool_stream_async(chunks):
+    """Drain an async chunk iterator into a SpooledTemporaryFile, rewound
+
+    Lets the blocking writer consume a streamed body from a worker thread
+    without holding the whole body in memory."""
+    spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_BYTES)
+    try:
+        async for chunk in chunks:
+            spool.write(chunk)
+    except BaseException:
+        spool.close()
+        raise
+    spool.seek(0)
+    return spool
+
+
+async def process_action_async(actid, big_fix, writer, conf, progress_lock):
+    """Archive a single top-level action as an asyncio task (--engine async)
+
+    Same contract as process_action(), but big_fix is a
+    BigfixRESTAsyncConnection. The action and status requests are issued
+    concurrently; blocking archive writes run in the default executor so
+    they do not stall the event loop.
+
+    Returns:
+        tuple: (success: bool, actid: tuple, error: Exception or None)
+    """
+    try:
+        acturl = f"/api/action/{str(actid[0])}"
+        report_fetch(f"Archiving action {actid[0]}: {actid[2]} (by {actid[4]})",
+                     acturl, conf, progress_lock)
+
+        with runtrace.task_span("fetch action", "fetch", id=actid[0]):
+            action, action_status = await asyncio.gather(
+                big_fix.api_get(acturl),
+                spool_stream_async(big_fix.api_get_stream(acturl + "/status")),
+            )
+        with action_status:
+            await asyncio.to_thread(
+                runtrace.profiled(write_action_files), writer, actid, action,
+                iter_file_chunks(action_status)
+            )
+
+        if actid[5]:
+            await asyncio.to_thread(
+                writer.makedirs, writer.get_path(actid[4], f"{actid[0]}_MAG"), True
+            )
+
+        return (True, actid, None)
+
+    except Exception as e:
+        return (False, actid, e)
+
+
+async def process_mag_action_async(actid, mag_id, big_fix, writer, conf, progress_lock):
+    """Archive one MAG member action as an asyncio task (--engine async)
+
+    Returns:
+        tuple: (success: bool, actid: tuple, error: Exception or None)
+        where actid is the parent MAG action
+    """
+    try:
+        magurl = f"/api/action/{str(mag_id[0])}"
+        report_fetch(f"  - MAG sub-action {mag_id[0]}: {mag_id[2]}",
+                     magurl, conf, progress_lock, indent="    ")
+
+        with runtrace.task_span("fetch action", "fetch", id=mag_id[0]):
+            mag_action, mag_action_status = await asyncio.gather(
+                big_fix.api_get(magurl),
+                spool_stream_async(big_fix.api_get_stream(magurl + "/status")),
+            )
+        with mag_action_status:
+            await asyncio.to_thread(
+                writer.makedirs, writer.get_path(actid[4], f"{actid[0]}_MAG"), True
+            )
+            await asyncio.to_thread(
+                runtrace.profiled(write_mag_files), writer, actid, mag_id, mag_action,
+                iter_file_chunks(mag_action_status)
+            )
+
+        return (True, actid, None)
+
+    except Exception as e:
+        return (False, actid, e)
+
+
+def collect_results(futures, completion, conf, progress_lock, actions_processed, total_actions, wait):
+    """Fold finished work item futures into per-action results
+
+    Finished futures are removed from futures. With wait, blocks until all
+    of them are done; with wait="first", until at least one is done;
+    otherwise only takes those already finished.
+
+    Yields:
+        tuple: (success: bool, actid: tuple, error: Exception or None)
+    """
+    if wait == "first":
+        done = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)[0]
+    elif wait:
+        done = concurrent.futures.as_completed(list(futures))
+    else:
+        done = [future for future in futures if future.done()]
+
+    for future in done:
+        actid = futures.pop(future)
+        try:
+            error = future.result()[2]
+        except Exception as e:
+            # Unexpected exception from the future itself
+            error = e
+
+        result = completion.item_done(actid, error)
+        if result is not None:
+            if result[0]:
+                report_action_done(conf, progress_lock, actions_processed, total_actions)
+            yield result
+
+
+def archive_batch_threads(chunks, big_fix, writer, conf, progress_lock, actions_processed, total_actions):
+    """Archive one batch on a ThreadPoolExecutor, yielding results as they complete
+
+    Work items are submitted as earlier ones finish, keeping at most
+    pending_limit() of them queued, and the next chunk is only selected
+    once the current one has been handed out. Memory therefore stays flat
+    however many actions are selected.
+
+    Args:
+        chunks: iterable of lists of action tuples, consumed lazily
+
+    Yields:
+        tuple: (success: bool, actid: tuple, error: Exception or None)
+        once per top-level action
+    """
+    completion = ActionCompletion(writer)
+    limit = pending_limit(conf, conf.threads)
+
+    with runtrace.span("archive", "phase"), \
+            concurrent.futures.ThreadPoolExecutor(max_workers=conf.threads) as executor:
+        futures = {}
+        for chunk in chunks:
+            mag_members, mag_errors = resolve_mag_members(big_fix, chunk, conf)
+            costs = action_costs(big_fix, chunk, conf) if conf.schedule == "largest-first" else None
+            completion.add(chunk, mag_members, mag_errors)
+
+            # Submit the actions and MAG member actions of this chunk as
+            # the workers free up
+            for actid, mag_id in schedule_work_items(chunk, mag_members, costs):
+                if len(futures) >= limit:
+                    yield from collect_results(
+                        futures, completion, conf, progress_lock, actions_processed, total_actions, "first"
+                    )
+                if mag_id is None:
+                    future = executor.submit(
+                        runtrace.profiled(process_action),
+                        actid, big_fix, writer, conf, progress_lock
+                    )
+                else:
+                    future = executor.submit(
+                        runtrace.profiled(process_mag_action),
+                        actid, mag_id, big_fix, writer, conf, progress_lock
+                    )
+                futures[future] = actid
+
+            # Report what finished while the next chunk is being selected
+            yield from collect_results(
+                futures, completion, conf, progress_lock, actions_processed, total_actions, False
+            )
+
+        # Collect the remaining results as they complete
+        yield from collect_results(
+            futures, completion, conf, progress_lock, actions_processed, total_actions, True
+        )
+
+
+def archive_batch_async(chunks, big_fix, credentials, writer, conf, progress_lock, actions_processed, total_actions):
+    """Archive one batch with asyncio, yielding results as they complete
+
+    The event loop runs in a thread of its own, keeping up to conf.threads
+    requests in flight, and hands each finished action over through a
+    queue, so the caller journals it while the batch is still running.
+    Tasks are created as earlier ones finish, at most pending_limit() at
+    a time, so a large selection does not become one task per item, and
+    the queue holds at most as many results, so tasks wait for a caller
+    that falls behind.
+
+    Args:
+        chunks: iterable of lists of action tuples, consumed lazily
+        big_fix: BigfixRESTConnection used for selection and MAG member lookups
+        credentials: (bfserver, bfport, bfuser, bfpass) for the async connection
+
+    Yields:
+        tuple: (success: bool, actid: tuple, error: Exception or None)
+        once per top-level action
+    """
+    # action_done() may close a segment (with fsync), so it runs in a worker
+    # thread rather than on the event loop
+    completion = ActionCompletion()
+    limit = pending_limit(conf, conf.threads)
+    results = queue.Queue(maxsize=limit)  # Finished actions, then None (or the exception) at the end
+    running = {}  # "loop" and "task" of run(), to cancel it if the caller stops early
+
+    async def run_item(async_fix, actid, mag_id):
+        if mag_id is None:
+            with runtrace.task_span("action", "action", id=actid[0]):
+                error = (await process_action_async(
+                    actid, async_fix, writer, conf, progress_lock
+                ))[2]
+        else:
+            with runtrace.task_span("MAG sub-action", "action", id=mag_id[0], mag=actid[0]):
+                error = (await process_mag_action_async(
+                    actid, mag_id, async_fix, writer, conf, progress_lock
+                ))[2]
+
+        result = completion.item_done(actid, error)
+        if result is not None:
+            await asyncio.to_thread(writer.action_done, actid[0])
+            if result[0]:
+                report_action_done(conf, progress_lock, actions_processed, total_actions)
+            try:
+                results.put_nowait(result)
+            except queue.Full:
+                await asyncio.to_thread(results.put, result)
+
+    def next_chunk(chunk_iter):
+        """Select the next chunk, resolve its MAGs and look up its action
+        sizes (blocking calls)"""
+        chunk = next(chunk_iter, None)
+        if chunk is None:
+            return None
+        costs = action_costs(big_fix, chunk, conf) if conf.schedule == "largest-first" else None
+        return chunk, resolve_mag_members(big_fix, chunk, conf), costs
+
+    async def run():
+        running["loop"], running["task"] = asyncio.get_running_loop(), asyncio.current_task()
+        async with bigfixREST.BigfixRESTAsyncConnection(
+            *credentials,
+            max_in_flight=conf.threads,
+            limiter=big_fix.limiter,
+            retry_policy=big_fix.retry_policy,
+            breaker=big_fix.breaker,
+            transfer=big_fix.transfer,
+            metrics=big_fix.metrics,
+        ) as async_fix:
+            tasks = set()
+            chunk_iter = iter(chunks)
+            # Selection queries run in a thread so started items keep going
+            while (selected := await asyncio.to_thread(next_chunk, chunk_iter)) is not None:
+                chunk, (mag_members, mag_errors), costs = selected
+                completion.add(chunk, mag_members, mag_errors)
+                for actid, mag_id in schedule_work_items(chunk, mag_members, costs):
+                    if len(tasks) >= limit:
+                        done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                        for task in done:
+                            task.result()
+                    tasks.add(asyncio.create_task(run_item(async_fix, actid, mag_id)))
+            await asyncio.gather(*tasks)
+
+    def run_loop():
+        try:
+            asyncio.run(run())
+        except BaseException as e:
+            results.put(e)
+        else:
+            results.put(None)
+
+    with runtrace.span("archive", "phase"):
+        thread = threading.Thread(target=run_loop, name="async-engine")
+        thread.start()
+        try:
+            while (result := results.get()) is not None:
+                if isinstance(result, BaseException):
+                    raise result
+                yield result
+        finally:
+            # Stopped early: cancel what is still running, and unblock
+            # tasks waiting for room in the queue
+            if thread.is_alive() and "task" in running:
+                running["loop"].call_soon_threadsafe(running["task"].cancel)
+            while thread.is_alive():
+                try:
+                    results.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            thread.join()
+
+
+def selection_filter(conf):
+    """The whose clause that selects the actions to archive
+
+    With conf.shard = (i, N), only the actions whose ID is i - 1 modulo N."""
+    whose = f"""{conf.whose} and ((now - time issued of it) > {conf.older}*day) and
+    top level flag of it and
+    (state of it = "Expired" or state of it = "Stopped")"""
+    if conf.shard is not None:
+        whose += f" and (id of it mod {conf.shard[1]} = {conf.shard[0] - 1})"
+    return whose
+
+
+def next_id_query(conf, low, high):
+    """Session relevance for the lowest selected action ID >= low, which is
+    high + 1 if there is none"""
+    return f"""minimum of (ids of bes actions
+    whose (id of it >= {low} and {selection_filter(conf)}); {high + 1})"""
+
+
+def selection_query(conf, id_window=None):
+    """Session relevance for the actions to archive, optionally restricted
+    to the action ID window [low, high)"""
+    whose = selection_filter(conf)
+    if id_window is not None:
+        whose = f"id of it >= {id_window[0]} and id of it < {id_window[1]} and {whose}"
+
+    return f"""(id of it, state of it, name of it, time issued of it,
+    name of issuer of it | "_DeletedOperator", multiple flag of it)
+    of bes actions
+    whose ({whose})""".strip()
+
+
+class ActionSelection:
+    """The actions selected for archiving, fetched by the selection query
+
+    Without --query-chunk, one query returns the whole selection, as it
+    always has; its rows are spooled to disk and the parsed response is
+    dropped once action_data.json is written. With --query-chunk N, a cheap
+    count query runs up front and the action ID space is then walked in
+    windows of N IDs, each fetched only when the archiver consumes it.
+    Archiving starts as soon as the first window arrives and the selection
+    is never in memory as a whole; the rows seen are spooled to disk for
+    action_data.json.
+
+    A window without selected actions is followed by one next_id_query(),
+    which jumps over the rest of the empty stretch, and the walk ends once
+    the counted number of actions has been read. Sparse ID ranges thus cost
+    at most about two queries per window that holds selected actions.
+    """
+
+    def __init__(self, big_fix, conf):
+        self.big_fix = big_fix
+        self.conf = conf
+        self.chunked = conf.query_chunk > 0
+        self.query = selection_query(conf)
+        self.total = 0
+        self.action_count = 0  # Rows written to action_data.json
+        self._result = None
+        self._id_range = None
+        self._rows = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_BYTES)
+
+    def start(self):
+        """Run the up-front query. Raises BigfixAPIError on failure"""
+        if not self.chunked:
+            self._result = self.big_fix.relevance_query_json(
+                self.query, timeout=self.conf.query_timeout
+            )
+            self.total = len(self._result["result"])
+            for row in self._result["result"]:
+                self._rows.write(json.dumps(row).encode("utf-8") + b"\n")
+            return
+
+        count = self.big_fix.relevance_query_json(
+            f"number of bes actions whose ({selection_filter(self.conf)})",
+            timeout=self.conf.query_timeout,
+        )
+        self.total = int(count["result"][0])
+
+        if self.total > 0:
+            id_range = self.big_fix.relevance_query_json(
+                "(minimum of ids of bes actions, maximum of ids of bes actions)",
+                timeout=self.conf.query_timeout,
+            )
+            self._id_range = tuple(int(i) for i in id_range["result"][0])
+
+    def chunks(self):
+        """Yield the selected action rows in lists, fetching lazily
+
+        Raises BigfixAPIError if a window query fails."""
+        if not self.chunked:
+            self._rows.seek(0)
+            rows = []
+            for line in self._rows:
+                rows.append(json.loads(line))
+                if len(rows) >= SELECTION_SPOOL_ROWS:
+                    yield rows
+                    rows = []
+            if rows:
+                yield rows
+            return
+
+        if self._id_range is None:
+            return
+
+        low, high = self._id_range
+        window_low = low
+        selected = 0
+        while window_low <= high and selected < self.total:
+            window = (window_low, window_low + self.conf.query_chunk)
+            if self.conf.verbose:
+                print(f"  Selecting actions with IDs in [{window[0]}, {window[1]})")
+            with runtrace.span("select window", "query", low=window[0], high=window[1]):
+                rows = self.big_fix.relevance_query_json(
+                    selection_query(self.conf, window), timeout=self.conf.query_timeout
+                )["result"]
+            window_low = window[1]
+            selected += len(rows)
+            if rows:
+                for row in rows:
+                    self._rows.write(json.dumps(row).encode("utf-8") + b"\n")
+                yield rows
+            elif window_low <= high:
+                # Skip the rest of a stretch without selected actions
+                with runtrace.span("next selected ID", "query", low=window_low):
+                    window_low = int(self.big_fix.relevance_query_json(
+                        next_id_query(self.conf, window_low, high), timeout=self.conf.query_timeout
+                    )["result"][0])
+
+    def write_action_data(self, writer, merge_previous=False):
+        """Write action_data.json for the rows selected so far
+
+        With merge_previous (--resume), rows of an existing action_data.json
+        that the selection no longer returns are kept.
+        """
+        with runtrace.span("write action data", "phase"):
+            self._write_action_data(writer, merge_previous)
+
+    def _write_action_data(self, writer, merge_previous):
+        path = writer.get_path("action_data.json")
+
+        if not self.chunked:
+            ares = self._result
+            if merge_previous:
+                ares = merge_action_data(path, ares)
+            self.action_count = len(ares["result"])
+            writer.write_file(path, json.dumps(ares, sort_keys=True, indent=4))
+            self._result = None  # The rows are read back from the spool
+            return
+
+        # Previous rows must be read before the file is rewritten
+        previous = []
+        if merge_previous:
+            previous = merge_action_data(path, {"result": []})["result"]
+
+        seen = set()
+
+        def document():
+            yield (json.dumps({"plural": True, "query": self.query}, sort_keys=True)[:-1]
+                   + ', "result": [\n').encode("utf-8")
+            self._rows.seek(0)
+            first = True
+            for line in self._rows:
+                seen.add(json.loads(line)[0])
+                yield (b"" if first else b",\n") + line.rstrip(b"\n")
+                first = False
+            for row in previous:
+                if row[0] not in seen:
+                    seen.add(row[0])
+                    yield (b"" if first else b",\n") + json.dumps(row).encode("utf-8")
+                    first = False
+            yield b"\n]}\n"
+
+        writer.write_stream(path, document())
+        self.action_count = len(seen)
+
+
+def filter_resumed(chunks, journal, conf, resumed_deletes):
+    """Drop journaled actions from the selection chunks (--resume)
+
+    Actions archived by an earlier run but not deleted are appended to
+    resumed_deletes when --delete is set.
+    """
+    for rows in chunks:
+        if conf.delete:
+            resumed_deletes.extend(a for a in rows if a[0] in journal.archived)
+        rows = [a for a in rows if a[0] not in journal.archived]
+        if rows:
+            yield rows
+
+
+def guard_selection(chunks, errors):
+    """Pass selection chunks through, stopping at the first failed query
+
+    The BigfixAPIError is appended to errors instead of being raised inside
+    the worker pool.
+    """
+    try:
+        yield from chunks
+    except BigfixAPIError as e:
+        errors.append(e)
+
+
+def mark_last(batches):
+    """Yield (batch, is_last) pairs, selecting one batch ahead"""
+    batches = iter(batches)
+    batch = next(batches, None)
+    while batch is not None:
+        following = next(batches, None)
+        yield batch, following is None
+        batch = following
+
+
+def iter_batches(chunks, batch_size):
+    """Group selection chunks into batches
+
+    Yields:
+        One iterable of row lists per batch. Without batching there is a
+        single batch that consumes the chunks lazily.
+    """
+    if batch_size <= 0:
+        yield chunks
+        return
+
+    batch = []
+    for rows in chunks:
+        for row in rows:
+            batch.append(row)
+            if len(batch) == batch_size:
+                yield [batch]
+                batch = []
+    if batch:
+        yield [batch]
+
+
+def merge_action_data(path, ares):
+    """Fold the action rows of an existing action_data.json into ares
+
+    Used on --resume, so actions deleted by the interrupted run (which the
+    new selection query no longer returns) stay in the action data file.
+    """
+    if not os.path.exists(path):
+        return ares
+
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            previous = json.load(f)
+    except (OSError, ValueError):
+        return ares
+
+    seen = {row[0] for row in ares["result"]}
+    merged = [row for row in previous.get("result", []) if row[0] not in seen]
+    ares["result"] = merged + ares["result"]
+    return ares
+
+
+def estimate_query(conf, id_window=None):
+    """Session relevance for the result and member counts of the selected
+    actions, optionally restricted to the action ID window [low, high)"""
+    whose = selection_filter(conf)
+    if id_window is not None:
+        whose = f"id of it >= {id_window[0]} and id of it < {id_window[1]} and {whose}"
+
+    return f"""{COST_PROPERTIES}
+    of bes actions
+    whose ({whose})""".strip()
+
+
+class RunEstimate:
+    """Predicts the output size and duration of a run (--estimate)
+
+    count() runs relevance aggregates for the selected actions: endpoint
+    results per action, and member actions and their results for MAGs.
+    sample() downloads a few actions, spread over the range of result
+    counts, to measure request latency, transfer time, client CPU time,
+    document size per endpoint result and compression. report()
+    extrapolates to the whole selection for each thread count and output
+    format. The client's CPU time is a floor for the run time, since only
+    one thread runs Python code at a time.
+    """
+
+    def __init__(self, big_fix, conf):
+        self.big_fix = big_fix
+        self.conf = conf
+        self.rows = []  # (id, results, member actions, member results)
+        self.query_seconds = []
+        self.samples = []  # (results, action bytes, status bytes, action seconds, status seconds)
+        self.sample_cpu = 0.0
+        self.documents = []  # Sampled documents, for compression ratios
+        self._kept = 0
+
+    def _query(self, relevance):
+        start = time.monotonic()
+        result = self.big_fix.relevance_query_json(relevance, timeout=self.conf.query_timeout)
+        self.query_seconds.append(time.monotonic() - start)
+        return result["result"]
+
+    def count(self):
+        """Fetch the counts of the selection. Raises BigfixAPIError on failure"""
+        if self.conf.query_chunk <= 0:
+            self._count_window(None)
+            return
+
+        id_range = self._query("(minimum of ids of bes actions, maximum of ids of bes actions)")
+        if not id_range:
+            return
+        low, high = (int(i) for i in id_range[0])
+        window_low = low
+        while window_low <= high:
+            window = (window_low, window_low + self.conf.query_chunk)
+            counted = self._count_window(window)
+            window_low = window[1]
+            if not counted and window_low <= high:
+                # Skip the rest of a stretch without selected actions
+                window_low = int(self._query(next_id_query(self.conf, window_low, high))[0])
+
+    def _count_window(self, window):
+        """Add the counts of the actions in an ID window (or all); returns how many"""
+        if self.conf.verbose and window is not None:
+            print(f"  Counting actions with IDs in [{window[0]}, {window[1]})")
+        rows = self._query(estimate_query(self.conf, window))
+        self.rows.extend(tuple(int(value) for value in row) for row in rows)
+        return len(rows)
+
+    def sample(self, size=ESTIMATE_SAMPLE):
+        """Download up to size actions; failed downloads are skipped"""
+        ordered = sorted(self.rows, key=lambda row: row[1])
+        count = min(size, len(ordered))
+        picks = [ordered[i * (len(ordered) - 1) // max(count - 1, 1)] for i in range(count)]
+
+        for row in picks:
+            acturl = f"/api/action/{row[0]}"
+            if self.conf.verbose:
+                print(f"  Sampling action {row[0]} ({row[1]} result(s))")
+            cpu_start = time.thread_time()
+            try:
+                start = time.monotonic()
+                action = self.big_fix.api_get(acturl).encode("utf-8")
+                action_seconds = time.monotonic() - start
+
+                start = time.monotonic()
+                status = b"".join(self.big_fix.api_get_stream(acturl + "/status"))
+                status_seconds = time.monotonic() - start
+            except BigfixAPIError as e:
+                print(f"WARNING: Could not sample action {row[0]}: {e}")
+                continue
+            self.sample_cpu += time.thread_time() - cpu_start
+            self.samples.append((row[1], len(action), len(status), action_seconds, status_seconds))
+            for document in (action, status):
+                if self._kept + len(document) <= ESTIMATE_SAMPLE_BYTES:
+                    self.documents.append(document)
+                    self._kept += len(document)
+
+    def _status_model(self):
+        """Least-squares fit of status bytes = fixed + per_result * results"""
+        xs = [sample[0] for sample in self.samples]
+        ys = [sample[2] for sample in self.samples]
+        mean_x, mean_y = sum(xs) / len(xs), sum(ys) / len(ys)
+        spread = sum((x - mean_x) ** 2 for x in xs)
+        if spread > 0:
+            per_result = sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys)) / spread
+            fixed = mean_y - per_result * mean_x
+            if per_result >= 0 and fixed >= 0:
+                return fixed, per_result
+        if mean_x > 0:
+            return 0.0, mean_y / mean_x
+        return mean_y, 0.0
+
+    def _compression(self):
+        """Size ratio and seconds per input byte of each archive codec
+
+        Zip members are deflated one by one; tar.gz and tar.xz compress
+        the stream of files in blocks."""
+        data = b"".join(self.documents) or b" "
+        codecs = {
+            "zip": lambda: sum(len(zlib.compress(document)) for document in self.documents),
+            "tar.gz": lambda: len(compress_block("gzip", data)),
+            "tar.xz": lambda: len(compress_block("xz", data)),
+        }
+        measured = {}
+        for name, compress in codecs.items():
+            start = time.process_time()
+            size = compress()
+            measured[name] = (size / len(data), (time.process_time() - start) / len(data))
+        return measured
+
+    def report(self):
+        """Print the prediction"""
+        conf = self.conf
+        actions = len(self.rows)
+        mags = sum(1 for row in self.rows if row[2] > 0)
+        members = sum(row[2] for row in self.rows)
+        results = sum(row[1] + row[3] for row in self.rows)
+        items = actions + members
+        files = 3 * actions + 2 * members
+
+        fixed, per_result = self._status_model()
+        action_bytes = sum(sample[1] for sample in self.samples) / len(self.samples)
+        content = int(items * (action_bytes + fixed) + results * per_result + actions * META_FILE_BYTES)
+        transfer = self.big_fix.transfer
+        wire_ratio = transfer.wire_bytes / transfer.body_bytes if transfer.body_bytes else 1.0
+
+        # Request time: the action GET, then the status GET whose duration
+        # grows with the size of the document
+        latency = sorted(sample[3] for sample in self.samples)[len(self.samples) // 2]
+        status_bytes = sum(sample[2] for sample in self.samples)
+        status_seconds = sum(sample[4] for sample in self.samples)
+        per_byte = max(0.0, status_seconds - latency * len(self.samples)) / max(status_bytes, 1)
+        fetch_seconds = items * 2 * latency + (content - actions * META_FILE_BYTES) * per_byte
+
+        # Client CPU per item, scaled by how the average item compares in
+        # size with the average sampled one
+        sampled_bytes = sum(sample[1] + sample[2] for sample in self.samples)
+        cpu_seconds = (self.sample_cpu * items / len(self.samples)
+                       * (content / items) / max(sampled_bytes / len(self.samples), 1))
+
+        mag_queries = (mags + MAG_QUERY_CHUNK - 1) // MAG_QUERY_CHUNK
+        query_seconds = sum(self.query_seconds) + mag_queries * max(self.query_seconds)
+        requests_total = len(self.query_seconds) + mag_queries + 2 * items + (actions if conf.delete else 0)
+        delete_threads = conf.delete_threads or conf.threads
+        delete_seconds = actions * latency / delete_threads if conf.delete else 0.0
+
+        compression = self._compression()
+        sizes = {
+            "directory": content,
+            "zip": content * compression["zip"][0] + files * ZIP_FILE_OVERHEAD,
+            "tar": content + files * TAR_FILE_OVERHEAD,
+            "tar.gz": (content + files * TAR_FILE_OVERHEAD) * compression["tar.gz"][0],
+            "tar.xz": (content + files * TAR_FILE_OVERHEAD) * compression["tar.xz"][0],
+        }
+        compress_seconds = {
+            "directory": 0.0,
+            "tar": 0.0,
+            "zip": content * compression["zip"][1],
+            "tar.gz": content * compression["tar.gz"][1],
+            "tar.xz": content * compression["tar.xz"][1],
+        }
+
+        print(f"\nEstimate for {actions} action(s) ({mags} MAG(s) with {members} member action(s)), "
+              f"{results} endpoint result(s):")
+        print(f"  Files:               {files}")
+        print(f"  Requests:            {requests_total}")
+        print(f"  Data to download:    {format_bytes(content)} decoded, "
+              f"about {format_bytes(int(content * wire_ratio))} on the wire")
+        print(f"  Sampled:             {len(self.samples)} action(s), median latency "
+              f"{latency * 1000:.0f} ms, {format_bytes(int(per_result))} per endpoint result")
+        print(f"  Client CPU time:     about {format_elapsed_time(cpu_seconds)}, the least the run can take")
+
+        print("\n  Output size by format:")
+        for name, size in sizes.items():
+            print(f"    {name:<10} {format_bytes(int(size))}")
+
+        # Deflate (zip) runs in the worker threads; tar.gz and tar.xz blocks
+        # in --compress-workers processes
+        print("\n  Run time by --threads (if the server keeps up):")
+        print("    " + "Threads".rjust(7) + "".join(name.rjust(12) for name in sizes))
+        thread_counts = sorted(set(ESTIMATE_THREADS) | {conf.threads})
+        for threads in thread_counts:
+            cells = []
+            for name in sizes:
+                parallel = threads if name == "zip" else max(conf.compress_workers, 1)
+                seconds = max(fetch_seconds / threads, compress_seconds[name] / parallel, cpu_seconds)
+                cells.append(format_elapsed_time(seconds + query_seconds + delete_seconds).rjust(12))
+            print("    " + str(threads).rjust(7) + "".join(cells))
+        if conf.delete:
+            print(f"\n  Includes {format_elapsed_time(delete_seconds)} of deletes "
+                  f"with {delete_threads} delete thread(s).")
+
+
+def estimate_main(conf, bfpass):
+    """--estimate: predict the run from aggregates and a sample, then exit"""
+    try:
+        big_fix = bigfixREST.BigfixRESTConnection(
+            conf.bfserver,
+            conf.bfport,
+            conf.bfuser,
+            bfpass,
+            retry_policy=bigfixREST.RetryPolicy(max_retries=conf.retries, backoff=conf.retry_backoff),
+        )
+    except BigfixAuthenticationError as e:
+        print(f"AUTHENTICATION ERROR: {e}")
+        sys.exit(1)
+    except BigfixConnectionError as e:
+        print(f"CONNECTION ERROR: {e}")
+        sys.exit(1)
+
+    estimate = RunEstimate(big_fix, conf)
+    try:
+        estimate.count()
+    except BigfixAPIError as e:
+        print(f"QUERY ERROR: {e}")
+        if conf.verbose:
+            print(f"Query was: {estimate_query(conf)}")
+        sys.exit(1)
+
+    if not estimate.rows:
+        print("Found 0 action(s) to archive.")
+        sys.exit(0)
+
+    if not conf.quiet:
+        print(f"Found {len(estimate.rows)} action(s) to archive. "
+              f"Sampling up to {ESTIMATE_SAMPLE} of them...")
+    estimate.sample()
+    if not estimate.samples:
+        print("ERROR: No action could be sampled")
+        sys.exit(1)
+
+    estimate.report()
+    sys.exit(0)
+
+
+def shard_paths(path, count):
+    """Paths of the count shard outputs for output path, in a staging directory"""
+    staging = path.rstrip("/" + os.sep) + SHARD_DIR_SUFFIX
+    suffix = SHARD_SUFFIXES[archive_type_of(path)]
+    return [os.path.join(staging, f"shard{i}{suffix}") for i in range(1, count + 1)]
+
+
+class PrefixedOutput:
+    """Text stream that starts every line written to it with a prefix"""
+
+    def __init__(self, stream, prefix):
+        self.stream = stream
+        self.prefix = prefix
+        self._line_start = True
+
+    def write(self, text):
+        out = []
+        for line in text.splitlines(keepends=True):
+            if self._line_start:
+                out.append(self.prefix)
+            out.append(line)
+            self._line_start = line.endswith("\n")
+        self.stream.write("".join(out))
+        return len(text)
+
+    def flush(self):
+        self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+def run_shard(conf, bfpass, shard, path, label):
+    """Archive one shard into path, in a --processes worker process"""
+    sys.stdout = PrefixedOutput(sys.stdout, f"[{label}] ")
+    conf.folder = path
+    conf.shard = shard
+    conf.processes = 1
+    # Actions are deleted by the parent once the merged output is complete
+    conf.delete = False
+    archive_main(conf, bfpass)
+
+
+def processes_main(conf, bfpass):
+    """Archive with --processes worker processes, then merge their shards
+
+    Each process selects the actions whose ID falls in its shard (ID modulo
+    the number of processes) and archives them with its own connection and
+    --threads worker threads, into a shard output of its own. With --shard,
+    the processes split that shard the same way. Once all have succeeded
+    the shards are merged into the output and, with --delete, the actions
+    are deleted."""
+    count = conf.processes
+    paths = shard_paths(conf.folder, count)
+    staging = os.path.dirname(paths[0])
+    shutil.rmtree(staging, ignore_errors=True)
+    os.makedirs(staging)
+
+    if not conf.quiet:
+        print(f"Using {count} processes with {conf.threads} worker thread(s) each.")
+    start_time = time.time()
+    start_datetime = datetime.now()
+
+    # Buffered output would otherwise be printed again by forked processes
+    sys.stdout.flush()
+    # Shard i/N split in P: the IDs that are i - 1 + N * (j - 1) modulo N * P
+    outer_index, outer_count = conf.shard or (1, 1)
+    workers = [
+        multiprocessing.Process(
+            target=run_shard,
+            args=(conf, bfpass, (outer_index + outer_count * (i - 1), outer_count * count), path,
+                  f"{i}/{count}"),
+            name=f"shard-{i}",
+        )
+        for i, path in enumerate(paths, 1)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    failed = [i for i, worker in enumerate(workers, 1) if worker.exitcode != 0]
+    if failed:
+        print(f"\nERROR: {len(failed)} of {count} process(es) failed (shard "
+              f"{', '.join(str(i) for i in failed)}).")
+        print(f"Shard outputs are kept in {staging}. No actions will be deleted.")
+        sys.exit(1)
+
+    if not conf.quiet:
+        print(f"\nMerging {count} shard(s) into {conf.folder}...")
+    writer = ArchiveWriter(conf.folder, verbose=conf.verbose, dedup=conf.dedup,
+                           compress_workers=conf.compress_workers, index=not conf.no_index)
+    merger = ShardMerger(writer, move=True)
+    for path in paths:
+        merger.add(path)
+    merger.write_action_data(selection_query(conf))
+    write_execution_config(writer, conf)
+    writer.close()
+    shutil.rmtree(staging, ignore_errors=True)
+    total_actions = len(merger.rows)
+
+    stats = RunStats()
+    if conf.delete and merger.rows:
+        if not conf.quiet:
+            print(f"\nArchive complete. Deleting {total_actions} action(s) from server...")
+        retry_policy = bigfixREST.RetryPolicy(max_retries=conf.retries, backoff=conf.retry_backoff)
+        breaker = None
+        if conf.breaker_threshold > 0:
+            breaker = bigfixREST.CircuitBreaker(conf.breaker_threshold, conf.breaker_cooldown)
+        big_fix = connect_bigfix(conf, bfpass, retry_policy=retry_policy, breaker=breaker,
+                                 pool_size=(conf.delete_threads or conf.threads) + 1)
+        stats.retry_policy = retry_policy
+        stats.breaker = breaker
+        stats.transfer = big_fix.transfer
+
+        journal = None
+        if writer.archive_type == "directory":
+            journal = ArchiveJournal(writer.get_path(JOURNAL_NAME), resume=True)
+        rows = [merger.rows[action_id] for action_id in sorted(merger.rows)]
+        errors = delete_actions(big_fix, rows, conf, journal, stats, stop_on_error=True)
+        if journal is not None:
+            journal.close()
+        if errors:
+            print_performance_summary(start_time, start_datetime, total_actions, conf.quiet, stats)
+            sys.exit(1)
+
+    if not conf.quiet:
+        if not conf.delete:
+            print(f"\nComplete: {total_actions} action(s) archived.")
+        else:
+            print(f"\nComplete: {total_actions} action(s) archived and deleted.")
+    print_performance_summary(start_time, start_datetime, total_actions, conf.quiet, stats)
+    sys.exit(0)
+
+
+def threads_arg(value):
+    """argparse type for --threads: a number, or 'auto' for adaptive concurrency"""
+    if value == "auto":
+        return value
+    try:
+        return int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid thread count: '{value}' (use a number or 'auto')")
+
+
+def load_servers(conf):
+    """Read the --config file into one configuration namespace per server
+
+    The file is a JSON object whose "servers" list has an object per
+    server. Each needs a "name", which names its subtree of the output, and
+    may set any of SERVER_OPTIONS (the connection options also by their
+    SERVER_ALIASES); other options come from the command line.
+    """
+    try:
+        with open(conf.config, "r", encoding="utf-8") as f:
+            entries = json.load(f)["servers"]
+        if not isinstance(entries, list) or not all(isinstance(entry, dict) for entry in entries):
+            raise ValueError('"servers" must be a list of objects')
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        print(f"ERROR: Could not read the server config {conf.config}: {e}")
+        sys.exit(1)
+    if not entries:
+        print(f"ERROR: No servers listed in {conf.config}")
+        sys.exit(1)
+
+    servers = []
+    for entry in entries:
+        name = entry.get("name")
+        if not isinstance(name, str) or name in ("", ".", "..") or "/" in name or os.sep in name:
+            print(f'ERROR: Every server in {conf.config} needs a "name" usable as a directory name')
+            sys.exit(1)
+        if name in (server.server_name for server in servers):
+            print(f"ERROR: Server name {name} is used more than once in {conf.config}")
+            sys.exit(1)
+        unknown = sorted(set(entry) - set(SERVER_OPTIONS) - set(SERVER_ALIASES) - {"name"})
+        if unknown:
+            print(f"ERROR: Server {name}: unknown option(s) {', '.join(unknown)}")
+            sys.exit(1)
+        for alias, option in SERVER_ALIASES.items():
+            if alias in entry and option in entry:
+                print(f"ERROR: Server {name}: {alias} and {option} are the same option")
+                sys.exit(1)
+            if alias in entry:
+                entry[option] = entry.pop(alias)
+
+        server = argparse.Namespace(**vars(conf))
+        for key, value in entry.items():
+            if key != "name":
+                setattr(server, key, value)
+        server.server_name = name
+
+        if server.bfserver is None or server.bfuser is None:
+            print(f"ERROR: Server {name} needs a bfserver and a bfuser")
+            sys.exit(1)
+        if "threads" in entry:
+            try:
+                server.threads = threads_arg(str(entry["threads"]))
+            except argparse.ArgumentTypeError as e:
+                print(f"ERROR: Server {name}: {e}")
+                sys.exit(1)
+            server.adaptive = server.threads == "auto"
+        if server.adaptive:
+            server.threads = server.max_threads
+        if server.threads < 1 or server.processes < 1:
+            print(f"ERROR: Server {name}: threads and processes must be 1 or greater")
+            sys.exit(1)
+        servers.append(server)
+    return servers
+
+
+def output_action_rows(path):
+    """The selection rows in the action_data.json of an output, or []"""
+    try:
+        with ArchiveReader(path) as reader, reader.open("action_data.json") as f:
+            return json.load(f).get("result", [])
+    except (OSError, KeyError, ValueError, zipfile.BadZipFile, tarfile.TarError):
+        return []
+
+
+def add_subtree(writer, path, prefix):
+    """Copy every file of the output at path into writer under prefix/"""
+    with ArchiveReader(path) as reader:
+        for name in reader.names():
+            dest = writer.get_path(prefix, *name.split("/"))
+            if reader.archive_type == "zip" and writer.archive_type == "zip":
+                writer.copy_zip_member(reader.archive_handle, reader.archive_handle.getinfo(name), dest)
+            else:
+                with reader.open(name) as f:
+                    writer.write_stream(dest, iter_file_chunks(f))
+
+
+def run_server(conf, bfpass):
+    """Archive one --config server, in a process of its own"""
+    sys.stdout = PrefixedOutput(sys.stdout, f"[{conf.server_name}] ")
+    if conf.processes > 1:
+        processes_main(conf, bfpass)
+    else:
+        archive_main(conf, bfpass)
+
+
+def delete_server_actions(conf, bfpass, rows, stats):
+    """Delete the archived actions of one --config server, returning the errors"""
+    retry_policy = bigfixREST.RetryPolicy(max_retries=conf.retries, backoff=conf.retry_backoff)
+    try:
+        big_fix = bigfixREST.BigfixRESTConnection(
+            conf.bfserver, conf.bfport, conf.bfuser, bfpass, retry_policy=retry_policy,
+            pool_size=(conf.delete_threads or conf.threads) + 1,
+        )
+    except (BigfixAuthenticationError, BigfixConnectionError) as e:
+        print(f"ERROR: Could not connect to server {conf.server_name} to delete its actions: {e}")
+        return [(None, e)]
+    return delete_actions(big_fix, rows, conf, None, stats, stop_on_error=True)
+
+
+def servers_main(conf):
+    """Archive every server of the --config file at once
+
+    Each server is archived by a process of its own, with its own
+    connection, credentials, whose clause and thread budget, into a subtree
+    of the output named after it: a subdirectory of directory output, where
+    each server's run is complete on its own (deletes, journal and all).
+    For archive output the servers are archived into staging archives,
+    which are copied into the output as they are; the archived actions are
+    deleted after the output is closed, all servers at once."""
+    servers = load_servers(conf)
+    passwords = {}
+    for server in servers:
+        if server.keycreds is None and server.bfpass is None:
+            print(f"Server {server.server_name} ({server.bfserver}):")
+        passwords[server.server_name] = read_password(server)
+
+    archive = is_archive_path(conf.folder)
+    staging = conf.folder.rstrip("/" + os.sep) + SERVER_DIR_SUFFIX
+    for server in servers:
+        if archive:
+            server.folder = os.path.join(
+                staging, server.server_name + SHARD_SUFFIXES[archive_type_of(conf.folder)]
+            )
+            server.delete = False
+            server.no_index = True
+        else:
+            server.folder = os.path.join(conf.folder, server.server_name)
+    if archive:
+        shutil.rmtree(staging, ignore_errors=True)
+        os.makedirs(staging)
+
+    if not conf.quiet:
+        print(f"Archiving {len(servers)} server(s) at once: "
+              f"{', '.join(server.server_name for server in servers)}.")
+    start_time = time.time()
+    start_datetime = datetime.now()
+
+    # Buffered output would otherwise be printed again by forked processes
+    sys.stdout.flush()
+    pending = {}
+    for server in servers:
+        process = multiprocessing.Process(target=run_server, args=(server, passwords[server.server_name]),
+                                          name=f"server-{server.server_name}")
+        process.start()
+        pending[process.sentinel] = (server, process)
+
+    # Note when each server finishes, for the summary
+    finished = {}
+    while pending:
+        for sentinel in multiprocessing.connection.wait(list(pending)):
+            server, process = pending.pop(sentinel)
+            process.join()
+            finished[server.server_name] = (process.exitcode, time.time() - start_time)
+
+    succeeded = [server for server in servers if finished[server.server_name][0] == 0]
+    failed = [server for server in servers if finished[server.server_name][0] != 0]
+    rows = {server.server_name: output_action_rows(server.folder) for server in succeeded}
+
+    stats = RunStats()
+    if archive and succeeded:
+        if not conf.quiet:
+            print(f"\nCombining {len(succeeded)} server archive(s) into {conf.folder}...")
+        writer = ArchiveWriter(conf.folder, verbose=conf.verbose, compress_workers=conf.compress_workers)
+        try:
+            for server in succeeded:
+                add_subtree(writer, server.folder, server.server_name)
+        finally:
+            writer.close()
+
+        if conf.delete:
+            if not conf.quiet:
+                print(f"\nArchive complete. Deleting the actions of {len(succeeded)} server(s)...")
+            with concurrent.futures.ThreadPoolExecutor(max_workers=len(succeeded)) as executor:
+                futures = {
+                    executor.submit(delete_server_actions, server, passwords[server.server_name],
+                                    rows[server.server_name], stats): server
+                    for server in succeeded
+                }
+                for future in concurrent.futures.as_completed(futures):
+                    if future.result():
+                        failed.append(futures[future])
+
+        for server in succeeded:
+            if server not in failed:
+                os.remove(server.folder)
+        if not failed:
+            shutil.rmtree(staging, ignore_errors=True)
+
+    if not conf.quiet:
+        print(f"\n{'='*60}")
+        print("Server Summary:")
+        for server in servers:
+            exitcode, seconds = finished[server.server_name]
+            status = "ok" if exitcode == 0 else f"failed (exit {exitcode})"
+            print(f"  {server.server_name:<20} {status:<18} "
+                  f"{len(rows.get(server.server_name, [])):>7} action(s) in {format_elapsed_time(seconds)}")
+        print(f"{'='*60}")
+    total_actions = sum(len(server_rows) for server_rows in rows.values())
+    print_performance_summary(start_time, start_datetime, total_actions, conf.quiet, stats)
+
+    if failed:
+        print(f"\nERROR: {len(failed)} of {len(servers)} server(s) failed: "
+              f"{', '.join(server.server_name for server in failed)}.")
+        if archive:
+            print(f"Their outputs are kept in {staging}, and their actions were not deleted.")
+        sys.exit(1)
+    sys.exit(0)
+
+
+def shard_arg(value):
+    """argparse type for --shard: i/N, the i-th of N shards"""
+    try:
+        index, count = (int(part) for part in value.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid shard: '{value}' (use i/N, e.g. 2/4)")
+    if not 1 <= index <= count:
+        raise argparse.ArgumentTypeError(f"invalid shard: '{value}' (i must be from 1 to N)")
+    return (index, count)
+
+
+def time_arg(value):
+    """argparse type for --since and --until: an ISO 8601 date or time"""
+    if utc_time(value) is None:
+        raise argparse.ArgumentTypeError(f"invalid time: '{value}' (use ISO 8601, e.g. 2024-01-31)")
+    return value
+
+
+def size_arg(value):
+    """argparse type for --segment-size: bytes, or a number with a K, M or G suffix"""
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+    text = value.strip().upper().removesuffix("IB").removesuffix("B")
+    try:
+        if text[-1:] in units:
+            return int(float(text[:-1]) * units[text[-1]])
+        return int(text)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid size: '{value}' (use bytes or e.g. 500M, 2G)")
+
+
+def format_elapsed_time(seconds):
+    """Format elapsed time in human readable format"""
+    hours = int(seconds // 3600)
+    minutes = int((seconds % 3600) // 60)
+    secs = int(seconds % 60)
+
+    if hours > 0:
+        return f"{hours}h {minutes}m {secs}s"
+    elif minutes > 0:
+        return f"{minutes}m {secs}s"
+    else:
+        return f"{secs}s"
+
+
+def format_bytes(count):
+    """Format a byte count in human readable format"""
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if count < 1024 or unit == "GiB":
+            break
+        count /= 1024
+    if unit == "B":
+        return f"{count} B"
+    return f"{count:.1f} {unit}"
+
+
+def read_password(conf):
+    """The password of conf.bfuser: from the keyring (-k), -P, or a prompt"""
+    if conf.keycreds is not None:
+        bfpass = keyring.get_password(conf.keycreds, conf.bfuser)
+    else:
+        bfpass = conf.bfpass
+
+    # If password is still not set, prompt for it with double-entry verification
+    if bfpass is None:
+        onepass = "not"  # Set to ensure mismatch and avoid fail msg 1st time
+        twopass = ""
+        print(f"Enter the password for the user {conf.bfuser}")
+        print("The password will not display. You must enter the same")
+        print("password twice in a row for verification.")
 
-            mag_path = writer.get_path(actid[4], f"{actid[0]}_MAG")
-            writer.makedirs(mag_path, exist_ok=True)
+        while onepass != twopass:
+            if onepass != "not":
+                print("\nPasswords did not match. Try again.\n")
 
-            for mag_id in mag_components["result"]:
-                magurl = f"/api/action/{str(mag_id[0])}"
+            onepass = getpass(f"BigFix password for {conf.bfuser}: ")
+            twopass = getpass("Enter the password again: ")
 
-                # Report MAG sub-action (unless quiet) - with lock
-                if not conf.quiet:
-                    with progress_lock:
-                        print(f"  - MAG sub-action {mag_id[0]}: {mag_id[2]}")
+        bfpass = onepass
 
-                # Verbose mode shows the API URL details
-                if conf.verbose:
-                    with progress_lock:
-                        print(f"    Fetching from API: {magurl}")
+    return bfpass
 
-                # Fetch MAG sub-action data
-                mag_action = str(big_fix.api_get(magurl))
-                mag_action_status = str(big_fix.api_get(magurl + "/status"))
 
-                # Write MAG action files (writer is thread-safe)
-                writer.write_file(
-                    writer.get_path(actid[4], f"{actid[0]}_MAG", f"{str(mag_id[0])}_action.xml"),
-                    mag_action
-                )
-                writer.write_file(
-                    writer.get_path(actid[4], f"{actid[0]}_MAG", f"{str(mag_id[0])}_result.xml"),
-                    mag_action_status
-                )
+def connect_bigfix(conf, bfpass, **options):
+    """Open a BigfixRESTConnection, exiting with a message if that fails"""
+    try:
+        with runtrace.span("connect", "phase"):
+            return bigfixREST.BigfixRESTConnection(
+                conf.bfserver, conf.bfport, conf.bfuser, bfpass, **options
+            )
+    except BigfixAuthenticationError as e:
+        print(f"AUTHENTICATION ERROR: {e}")
+        sys.exit(1)
+    except BigfixConnectionError as e:
+        print(f"CONNECTION ERROR: {e}")
+        sys.exit(1)
+    except Exception as e:
+        print(f"UNEXPECTED ERROR connecting to BigFix: {e}")
+        sys.exit(1)
 
-        # Increment counter and report progress if needed - with lock
-        with progress_lock:
-            actions_processed[0] += 1
-            if (not conf.quiet and
-                conf.progress > 0 and
-                actions_processed[0] % conf.progress == 0 and
-                actions_processed[0] < total_actions):
-                remaining = total_actions - actions_processed[0]
-                percentage = (actions_processed[0] / total_actions) * 100
-                print(f"Progress: {actions_processed[0]}/{total_actions} actions archived ({percentage:.1f}% complete, {remaining} remaining)")
 
-        return (True, actid, None)
+def write_execution_config(writer, conf):
+    """Write execution_config_data.json, the run's options minus the password"""
+    v_conf = dict(vars(conf))
+    v_conf["bfpass"] = "Removed_for_Security"
+    writer.write_file(
+        writer.get_path("execution_config_data.json"),
+        json.dumps(v_conf, sort_keys=True, indent=4)
+    )
 
-    except Exception as e:
-        # Return error, will be handled by main thread
-        return (False, actid, e)
 
+def finish_profile(tracer, quiet=False):
+    """Write the --profile trace and profile files"""
+    try:
+        paths = tracer.finish()
+    except OSError as e:
+        print(f"WARNING: Could not write the profile: {e}")
+        return
+    if not quiet:
+        print(f"Profile written to {', '.join(paths)}")
 
-def format_elapsed_time(seconds):
-    """Format elapsed time in human readable format"""
-    hours = int(seconds // 3600)
-    minutes = int((seconds % 3600) // 60)
-    secs = int(seconds % 60)
 
-    if hours > 0:
-        return f"{hours}h {minutes}m {secs}s"
-    elif minutes > 0:
-        return f"{minutes}m {secs}s"
-    else:
-        return f"{secs}s"
+def refresh_metrics(metrics, stats, actions_processed, all_errors):
+    """Copy the run-wide counters kept elsewhere into metrics before an export"""
+    metrics.set("actions_processed_total", actions_processed[0])
+    metrics.set("action_errors_total", len(all_errors))
+    metrics.set("actions_deleted_total", stats.actions_deleted)
+    if stats.transfer is not None:
+        metrics.set("connections_opened_total", stats.transfer.connections)
+        metrics.set("response_bytes_total", stats.transfer.wire_bytes, encoding="wire")
+        metrics.set("response_bytes_total", stats.transfer.body_bytes, encoding="decoded")
+    if stats.retry_policy is not None:
+        metrics.set("request_retries_total", stats.retry_policy.retries)
+    if stats.breaker is not None:
+        metrics.set("circuit_breaker_trips_total", stats.breaker.trips)
+    if stats.limiter is not None:
+        metrics.set("concurrency_limit", stats.limiter.limit)
 
 
-def print_performance_summary(start_time, start_datetime, total_actions, quiet=False):
+def print_performance_summary(start_time, start_datetime, total_actions, quiet=False, stats=None):
     """Print performance metrics summary"""
     if quiet:
         return
@@ -257,11 +3526,240 @@ def print_performance_summary(start_time, start_datetime, total_actions, quiet=F
     print(f"  Elapsed time:        {format_elapsed_time(elapsed_seconds)}")
     print(f"  Actions processed:   {total_actions}")
     print(f"  Processing rate:     {actions_per_minute:.1f} actions/minute")
+    if stats is not None and stats.actions_deleted > 0:
+        if stats.delete_seconds > 0:
+            deletes_per_minute = (stats.actions_deleted / stats.delete_seconds) * 60
+        else:
+            deletes_per_minute = 0
+        print(f"  Actions deleted:     {stats.actions_deleted} in {format_elapsed_time(stats.delete_seconds)}")
+        print(f"  Delete rate:         {deletes_per_minute:.1f} actions/minute")
+    if stats is not None and stats.retry_policy is not None and stats.retry_policy.retries > 0:
+        print(f"  Request retries:     {stats.retry_policy.retries}")
+    if stats is not None and stats.breaker is not None and stats.breaker.trips > 0:
+        print(f"  Circuit breaker:     opened {stats.breaker.trips} time(s)")
+    if stats is not None and stats.transfer is not None:
+        transfer = stats.transfer
+        print(f"  Connections opened:  {transfer.connections}")
+        if transfer.body_bytes > 0:
+            saved = 100.0 * (1 - transfer.wire_bytes / transfer.body_bytes)
+            print(f"  Bytes received:      {format_bytes(transfer.wire_bytes)} on the wire, "
+                  f"{format_bytes(transfer.body_bytes)} decoded ({saved:.0f}% saved)")
+    if stats is not None and stats.writer is not None and stats.writer.dedup_files > 0:
+        writer = stats.writer
+        print(f"  Deduplicated:        {writer.dedup_files} action files, "
+              f"{format_bytes(writer.dedup_bytes)} stored as "
+              f"{format_bytes(writer.dedup_stored_bytes)}")
+    if stats is not None and stats.writer is not None and stats.writer.results is not None:
+        results = stats.writer.results
+        print(f"  Result rows added:   {results.rows} to {results.name}")
+        if results.parse_errors > 0:
+            print(f"  Unparsable results:  {results.parse_errors} (archived, but not in {results.name})")
+    if stats is not None and isinstance(stats.writer, SegmentedArchiveWriter) and stats.writer.segments:
+        segments = stats.writer.segments
+        print(f"  Archive segments:    {len(segments)} ({os.path.basename(segments[0])}"
+              f"{' to ' + os.path.basename(segments[-1]) if len(segments) > 1 else ''})")
+    if stats is not None and stats.limiter is not None:
+        limiter = stats.limiter
+        print(f"  Concurrency:         adaptive, ended at {limiter.limit} "
+              f"(range {limiter.lowest}-{limiter.highest} of max {limiter.maximum})")
     print(f"{'='*60}")
 
 
+def expand_main(argv):
+    """expand command: rebuild the plain layout of a --dedup archive"""
+    parser = argparse.ArgumentParser(
+        prog="actionarchive.py expand",
+        description="Copy an archive or directory, restoring deduplicated action files",
+    )
+    parser.add_argument("source", help="Directory or archive written with --dedup")
+    parser.add_argument("dest", help="Output directory or archive (.zip, .tar, .tar.gz, .tgz, .tar.xz, .txz)")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Verbose output")
+    conf = parser.parse_args(argv)
+
+    if os.path.exists(conf.dest) and is_archive_path(conf.dest):
+        print(f"ERROR: {conf.dest} already exists")
+        return 1
+    try:
+        files_written = expand_archive(conf.source, conf.dest, verbose=conf.verbose, index=True)
+    except (OSError, zipfile.BadZipFile, tarfile.TarError) as e:
+        print(f"ERROR: Could not expand {conf.source}: {e}")
+        return 1
+    print(f"Expanded {files_written} files from {conf.source} into {conf.dest}")
+    return 0
+
+
+def merge_main(argv):
+    """merge command: combine the outputs of --shard runs into one output"""
+    parser = argparse.ArgumentParser(
+        prog="actionarchive.py merge",
+        description="Combine the outputs of --shard runs into one archive or directory",
+    )
+    parser.add_argument("shards", nargs="+", help="Shard output directories or archives")
+    parser.add_argument("-o", "--output", required=True,
+                        help="Output directory or archive (.zip, .tar, .tar.gz, .tgz, .tar.xz, .txz)")
+    parser.add_argument("--move", action="store_true",
+                        help="Move the files of directory shards into a directory output "
+                             "instead of copying them (the shards are left incomplete)")
+    parser.add_argument("--no-index", action="store_true",
+                        help="Do not write the <archive>.index.sqlite sidecar")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Verbose output")
+    conf = parser.parse_args(argv)
+
+    if os.path.exists(conf.output) and is_archive_path(conf.output):
+        print(f"ERROR: {conf.output} already exists")
+        return 1
+
+    # Check the shard specs recorded by each run before writing anything
+    specs = []
+    dedup = False
+    try:
+        for path in conf.shards:
+            with ArchiveReader(path) as reader:
+                dedup = dedup or bool(reader.read_manifest())
+                with reader.open("execution_config_data.json") as f:
+                    specs.append(json.load(f).get("shard"))
+    except (OSError, KeyError, ValueError, zipfile.BadZipFile, tarfile.TarError) as e:
+        print(f"ERROR: Could not read shard {path}: {e}")
+        return 1
+    if None in specs:
+        print(f"ERROR: {conf.shards[specs.index(None)]} was not written with --shard")
+        return 1
+    counts = {spec[1] for spec in specs}
+    if len(counts) > 1:
+        print(f"ERROR: The shards were split different ways ({', '.join(f'{i}/{n}' for i, n in specs)})")
+        return 1
+    indexes = [spec[0] for spec in specs]
+    duplicates = sorted({i for i in indexes if indexes.count(i) > 1})
+    if duplicates:
+        print(f"ERROR: Shard {', '.join(str(i) for i in duplicates)} given more than once")
+        return 1
+    missing = sorted(set(range(1, counts.pop() + 1)) - set(indexes))
+    if missing:
+        print(f"WARNING: Shard {', '.join(str(i) for i in missing)} missing; "
+              f"the merged output is incomplete")
+
+    writer = ArchiveWriter(conf.output, verbose=conf.verbose, dedup=dedup, index=not conf.no_index)
+    merger = ShardMerger(writer, move=conf.move)
+    try:
+        for path in conf.shards:
+            merger.add(path)
+        config = merger.merged_config()
+        config["folder"] = conf.output
+        config["shard"] = None
+        query = selection_query(argparse.Namespace(**config)) if "whose" in config else None
+        merger.write_action_data(query)
+        writer.write_file(writer.get_path("execution_config_data.json"),
+                          json.dumps(config, sort_keys=True, indent=4))
+    except (OSError, zipfile.BadZipFile, tarfile.TarError, sqlite3.Error) as e:
+        print(f"ERROR: Could not merge the shards: {e}")
+        return 1
+    finally:
+        writer.close()
+    print(f"Merged {len(merger.rows)} action(s), {merger.files} files from "
+          f"{len(conf.shards)} shard(s) into {conf.output}")
+    return 0
+
+
+def query_main(argv):
+    """query command: find actions in an archive through its index"""
+    parser = argparse.ArgumentParser(
+        prog="actionarchive.py query",
+        description="Find archived actions using the archive's .index.sqlite sidecar, "
+                    "reading only the files needed",
+    )
+    parser.add_argument("archive", help="Archive written by actionarchive.py (.zip, .tar, .tar.gz, .tgz, .tar.xz, .txz)")
+    parser.add_argument("-i", "--id", type=int, action="append", help="Action ID (may be repeated)")
+    parser.add_argument("-n", "--name", help="Substring of the action name (case-insensitive)")
+    parser.add_argument("-u", "--issuer", help="Operator who issued the action")
+    parser.add_argument("--since", type=time_arg,
+                        help="Issued on or after this time (ISO 8601, e.g. 2024-01-31; UTC unless it "
+                             "has an offset)")
+    parser.add_argument("--until", type=time_arg,
+                        help="Issued before this time (ISO 8601; UTC unless it has an offset)")
+    parser.add_argument("-m", "--mag", type=int, help="List the sub-actions of this MAG")
+    parser.add_argument(
+        "-s",
+        "--show",
+        choices=["action", "result", "meta"],
+        help="Print this file of each matching action instead of the list",
+    )
+    parser.add_argument(
+        "-x",
+        "--extract",
+        help="Copy all files of the matching actions into this directory or archive",
+    )
+    conf = parser.parse_args(argv)
+
+    try:
+        archive = IndexedArchive(conf.archive)
+    except (OSError, sqlite3.Error) as e:
+        print(f"ERROR: Could not open {conf.archive}: {e}")
+        return 1
+
+    with archive:
+        rows = archive.find_actions(ids=conf.id, name=conf.name, issuer=conf.issuer,
+                                    since=conf.since, until=conf.until, mag_parent=conf.mag)
+
+        if conf.show:
+            try:
+                for row in rows:
+                    name = archive.action_files(row[0]).get(conf.show)
+                    if name is not None:
+                        for chunk in archive.iter_member(name):
+                            sys.stdout.buffer.write(chunk)
+                        sys.stdout.buffer.write(b"\n")
+                sys.stdout.flush()
+            except BrokenPipeError:
+                return stdout_closed()
+            return 0
+
+        if conf.extract:
+            writer = ArchiveWriter(conf.extract)
+            try:
+                for row in rows:
+                    for name in archive.action_files(row[0]).values():
+                        parts = name.split("/")
+                        writer.makedirs(writer.get_path(*parts[:-1]), exist_ok=True)
+                        writer.write_stream(writer.get_path(*parts), archive.iter_member(name))
+            finally:
+                writer.close()
+            print(f"Extracted {len(rows)} action(s) into {conf.extract}")
+            return 0
+
+        try:
+            print("ID\tIssued\tState\tIssuer\tName\tMAG")
+            for action_id, name, issuer, issued, state, mag_parent in rows:
+                print(f"{action_id}\t{issued}\t{state}\t{issuer}\t{name}\t{mag_parent or ''}")
+            sys.stdout.flush()
+        except BrokenPipeError:
+            return stdout_closed()
+    return 0
+
+
+def stdout_closed():
+    """Handle a reader of stdout (e.g. head) that went away: stop quietly
+
+    stdout is pointed at devnull so flushing it on exit does not fail again."""
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, sys.stdout.fileno())
+    os.close(devnull)
+    return 1
+
+
+# Commands other than archiving, selected by the first argument
+COMMANDS = {
+    "expand": expand_main,
+    "merge": merge_main,
+    "query": query_main,
+}
+
+
 def main():
     """main routine"""
+    # Other commands print only their own output, so it can be piped
+    if len(sys.argv) > 1 and sys.argv[1] in COMMANDS:
+        sys.exit(COMMANDS[sys.argv[1]](sys.argv[2:]))
+
     ## MAIN code begins:
     print(f"BigFix Action Archiver v{VERSION}")
 
@@ -287,7 +3785,7 @@ def main():
         default=52311,
     )
     parser.add_argument(
-        "-u", "--bfuser", type=str, help="BigFix Console/REST User name", required=True
+        "-u", "--bfuser", type=str, help="BigFix Console/REST User name (required unless --config)"
     )
     parser.add_argument("-P", "--bfpass", type=str, help="BigFix Console/REST Password")
     parser.add_argument(
@@ -301,7 +3799,7 @@ def main():
         "-f",
         "--folder",
         type=str,
-        help="Output path: directory or archive file (.zip, .tar, .tar.gz, .tgz). Default: ./aarchive",
+        help="Output path: directory or archive file (.zip, .tar, .tar.gz, .tgz, .tar.xz, .txz). Default: ./aarchive",
         default="./aarchive",
     )
     parser.add_argument(
@@ -323,16 +3821,189 @@ def main():
     parser.add_argument(
         "-t",
         "--threads",
+        type=threads_arg,
+        default=1,
+        help="Number of worker threads for parallel processing, or concurrent requests with --engine async. "
+             "'auto' adapts the number of requests in flight to server latency and errors (default: 1)",
+    )
+    parser.add_argument(
+        "-M",
+        "--max-threads",
+        type=int,
+        default=16,
+        help="Upper limit for --threads auto (default: 16)",
+    )
+    parser.add_argument(
+        "-D",
+        "--delete-threads",
+        type=int,
+        default=0,
+        help="Number of concurrent DELETE requests in the delete phase (default: same as --threads)",
+    )
+    parser.add_argument(
+        "--processes",
         type=int,
         default=1,
-        help="Number of worker threads for parallel processing (default: 1)",
+        help="Archive with N processes, each with its own connection and --threads threads, "
+             "and merge their outputs (default: 1)",
+    )
+    parser.add_argument(
+        "--config",
+        metavar="PATH",
+        help="Archive every BigFix server listed in this JSON file at once, each into a "
+             "subtree of the output named after it",
+    )
+    parser.add_argument(
+        "--shard",
+        type=shard_arg,
+        metavar="I/N",
+        help="Archive only shard I of N: the actions whose ID is I-1 modulo N. "
+             "Run all N shards (on any hosts) and combine their outputs with the merge command",
+    )
+    parser.add_argument(
+        "--max-pending",
+        type=int,
+        default=0,
+        help=f"Work items queued ahead of the fetch and delete workers "
+             f"(default: {PENDING_PER_WORKER} per worker)",
+    )
+    parser.add_argument(
+        "--retries",
+        type=int,
+        default=3,
+        help="Retries for failed idempotent requests (network errors, timeouts, HTTP 429/5xx) (default: 3)",
+    )
+    parser.add_argument(
+        "--retry-backoff",
+        type=float,
+        default=1.0,
+        help="Base delay in seconds for exponential backoff with jitter between retries (default: 1.0)",
+    )
+    parser.add_argument(
+        "--breaker-threshold",
+        type=int,
+        default=10,
+        help="Consecutive request failures that pause all workers (0 to disable, default: 10)",
+    )
+    parser.add_argument(
+        "--breaker-cooldown",
+        type=float,
+        default=30.0,
+        help="Seconds all workers pause when the circuit breaker opens (default: 30)",
+    )
+    parser.add_argument(
+        "-e",
+        "--engine",
+        choices=("threads", "async"),
+        default="threads",
+        help="Fetch engine: a thread pool, or one asyncio event loop (requires aiohttp) (default: threads)",
     )
     parser.add_argument(
         "-B",
         "--batch-size",
         type=int,
         default=0,
-        help="Process actions in batches of N (directory output only, 0 to disable, default: 0)",
+        help="Process actions in batches of N; archive output gets one segment per batch "
+             "(0 to disable, default: 0)",
+    )
+    parser.add_argument(
+        "--segment-size",
+        type=size_arg,
+        default=0,
+        metavar="SIZE",
+        help="Split archive output into segments of about SIZE bytes (K, M and G suffixes "
+             "accepted): a.zip is written as a.part0001.zip, a.part0002.zip, ... (0 to disable, default: 0)",
+    )
+    parser.add_argument(
+        "--schedule",
+        choices=("largest-first", "query"),
+        default="query",
+        help="Order of the work: the order the selection query returns, or actions with the most "
+             "endpoint results first (default: query)",
+    )
+    parser.add_argument(
+        "-Q",
+        "--query-chunk",
+        type=int,
+        default=0,
+        help="Select actions in windows of N action IDs, fetched as archiving proceeds (0 for one query, default: 0)",
+    )
+    parser.add_argument(
+        "--query-timeout",
+        type=int,
+        default=120,
+        help="Timeout in seconds for each selection query (default: 120)",
+    )
+    parser.add_argument(
+        "-R",
+        "--resume",
+        action="store_true",
+        help="Resume an interrupted run: skip actions already recorded in the output's checkpoint journal (directory output only)",
+    )
+    parser.add_argument(
+        "--dedup",
+        action="store_true",
+        help="Store identical action XML once under its content hash (use the expand command to restore the plain layout)",
+    )
+    parser.add_argument(
+        "--results",
+        choices=["jsonl", "sqlite"],
+        help="Also extract one row per endpoint from each action's results into action_results.jsonl or action_results.sqlite",
+    )
+    parser.add_argument(
+        "--no-index",
+        action="store_true",
+        help="Do not write the <archive>.index.sqlite sidecar used by the query command",
+    )
+    parser.add_argument(
+        "--compress-workers",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="Processes compressing .tar.gz/.tar.xz output in parallel blocks (0 to compress in the writing thread, default: number of CPUs)",
+    )
+    parser.add_argument(
+        "--metrics-file",
+        metavar="PATH",
+        help="Write run metrics to PATH as a Prometheus textfile, or as JSON if PATH ends in .json",
+    )
+    parser.add_argument(
+        "--metrics-interval",
+        type=float,
+        default=METRICS_INTERVAL,
+        help=f"Seconds between metrics file updates (0 to write only at the end, default: {METRICS_INTERVAL:g})",
+    )
+    parser.add_argument(
+        "--estimate",
+        action="store_true",
+        help="Predict the archive size and run time from relevance aggregates and a small sample, "
+             "without archiving anything",
+    )
+    parser.add_argument(
+        "--record",
+        metavar="PATH",
+        help="Record all REST requests and responses (without credentials) to the cassette PATH",
+    )
+    parser.add_argument(
+        "--replay",
+        metavar="PATH",
+        help="Answer REST requests from the cassette PATH instead of the server",
+    )
+    parser.add_argument(
+        "--replay-speed",
+        type=float,
+        default=1.0,
+        help="Replay recorded latencies divided by this factor (0 for no delay, default: 1)",
+    )
+    parser.add_argument(
+        "--profile",
+        metavar="PATH",
+        help="Write timed spans of every phase and action to PATH as a Chrome trace (JSON)",
+    )
+    parser.add_argument(
+        "--profiler",
+        choices=runtrace.PROFILERS,
+        help="With --profile, also profile the Python code: cprofile writes PATH.pstats, "
+             "sample writes stack samples to PATH.collapsed",
     )
     parser.add_argument(
         "-w",
@@ -357,6 +4028,8 @@ def main():
         help="Display version information and exit",
     )
     conf = parser.parse_args()
+    if conf.bfuser is None and not conf.config:
+        parser.error("the following arguments are required: -u/--bfuser")
 
     # Validate progress argument
     if conf.progress < 0:
@@ -364,122 +4037,270 @@ def main():
         sys.exit(1)
 
     # Validate threads argument
-    if conf.threads < 1:
+    conf.adaptive = conf.threads == "auto"
+    if conf.adaptive:
+        if conf.max_threads < 1:
+            print("ERROR: Maximum number of threads must be 1 or greater")
+            sys.exit(1)
+        # Size the pools for the ceiling; the limiter decides what is in flight
+        conf.threads = conf.max_threads
+    elif conf.threads < 1:
         print("ERROR: Number of threads must be 1 or greater")
         sys.exit(1)
-    if conf.threads > 10:
-        print(f"WARNING: Using {conf.threads} threads may overload the BigFix server. Recommended maximum is 10.")
+    elif conf.threads > 10:
+        unit = "concurrent requests" if conf.engine == "async" else "threads"
+        print(f"WARNING: Using {conf.threads} {unit} may overload the BigFix server. Recommended maximum is 10.")
+
+    if conf.query_chunk < 0:
+        print("ERROR: Query chunk size must be 0 or greater")
+        sys.exit(1)
+    if conf.query_timeout < 1:
+        print("ERROR: Query timeout must be 1 second or more")
+        sys.exit(1)
+
+    if conf.retries < 0 or conf.retry_backoff < 0:
+        print("ERROR: Retries and retry backoff must be 0 or greater")
+        sys.exit(1)
+    if conf.breaker_threshold < 0 or conf.breaker_cooldown < 0:
+        print("ERROR: Circuit breaker threshold and cooldown must be 0 or greater")
+        sys.exit(1)
+
+    if conf.delete_threads < 0:
+        print("ERROR: Number of delete threads must be 0 or greater")
+        sys.exit(1)
+
+    if conf.processes < 1:
+        print("ERROR: Number of processes must be 1 or greater")
+        sys.exit(1)
+    if conf.processes > 1:
+        for enabled, option in ((conf.batch_size, "-B/--batch-size"), (conf.segment_size, "--segment-size"),
+                                (conf.resume, "-R/--resume"),
+                                (conf.record or conf.replay, "--record and --replay"),
+                                (conf.profile, "--profile"), (conf.metrics_file, "--metrics-file")):
+            if enabled:
+                print(f"ERROR: {option} cannot be used with --processes")
+                sys.exit(1)
+
+    if conf.config:
+        for enabled, option in ((conf.estimate, "--estimate"), (conf.setcreds, "-s/--setcreds"),
+                                (conf.record or conf.replay, "--record and --replay"),
+                                (conf.profile, "--profile"), (conf.metrics_file, "--metrics-file")):
+            if enabled:
+                print(f"ERROR: {option} cannot be used with --config")
+                sys.exit(1)
+        if is_archive_path(conf.folder) and (conf.batch_size or conf.segment_size):
+            print("ERROR: Archive segments (-B/--batch-size or --segment-size with archive output) "
+                  "cannot be used with --config")
+            sys.exit(1)
+
+    if conf.max_pending < 0:
+        print("ERROR: Number of pending work items must be 0 or greater")
+        sys.exit(1)
+
+    if conf.compress_workers < 0:
+        print("ERROR: Number of compress workers must be 0 or greater")
+        sys.exit(1)
+
+    if conf.metrics_interval < 0:
+        print("ERROR: Metrics interval must be 0 or greater")
+        sys.exit(1)
+
+    if conf.profiler and not conf.profile:
+        print("ERROR: --profiler requires --profile")
+        sys.exit(1)
+
+    if conf.record and conf.replay:
+        print("ERROR: --record and --replay cannot be used together")
+        sys.exit(1)
+    if (conf.record or conf.replay) and conf.engine == "async":
+        print("ERROR: --record and --replay require --engine threads")
+        sys.exit(1)
+    if conf.replay_speed < 0:
+        print("ERROR: Replay speed must be 0 or greater")
+        sys.exit(1)
 
     # Validate batch-size argument
     if conf.batch_size < 0:
         print("ERROR: Batch size must be 0 or greater")
         sys.exit(1)
-    if conf.batch_size > 0:
-        # Check if output is a directory (not an archive)
-        lower_folder = conf.folder.lower()
-        if (lower_folder.endswith(".zip") or
-            lower_folder.endswith(".tar") or
-            lower_folder.endswith(".tar.gz") or
-            lower_folder.endswith(".tgz")):
-            print("ERROR: Batch processing is only supported with directory output (not ZIP/TAR archives)")
-            print("Remove the -B/--batch-size flag or change output to a directory path")
-            sys.exit(1)
+    if conf.segment_size < 0:
+        print("ERROR: Segment size must be 0 or greater")
+        sys.exit(1)
+    if conf.segment_size > 0 and not is_archive_path(conf.folder):
+        print("ERROR: --segment-size requires archive output (.zip, .tar, .tar.gz, .tgz, .tar.xz, .txz)")
+        sys.exit(1)
+
+    # Validate resume argument (an unfinished ZIP/TAR cannot be appended to)
+    if conf.resume and is_archive_path(conf.folder):
+        print("ERROR: Resume is only supported with directory output (not ZIP/TAR archives)")
+        print("Remove the -R/--resume flag or change output to a directory path")
+        sys.exit(1)
 
     # setcreds is a "single" operation, do it and terminate.
     if conf.setcreds is not None:
         set_secure_credentials(conf.setcreds, conf.bfuser)
         sys.exit(0)
 
-    if conf.keycreds is not None:
-        bfpass = keyring.get_password(conf.keycreds, conf.bfuser)
-    else:
-        bfpass = conf.bfpass
+    # Several servers from a config file, each archived by its own process
+    if conf.config:
+        servers_main(conf)
 
-    # If password is still not set, prompt for it with double-entry verification
-    if bfpass is None:
-        onepass = "not"  # Set to ensure mismatch and avoid fail msg 1st time
-        twopass = ""
-        print(f"Enter the password for the user {conf.bfuser}")
-        print("The password will not display. You must enter the same")
-        print("password twice in a row for verification.")
+    bfpass = read_password(conf)
 
-        while onepass != twopass:
-            if onepass != "not":
-                print("\nPasswords did not match. Try again.\n")
+    # --estimate downloads only a sample and writes nothing
+    if conf.estimate:
+        estimate_main(conf, bfpass)
 
-            onepass = getpass(f"BigFix password for {conf.bfuser}: ")
-            twopass = getpass("Enter the password again: ")
+    # Several processes archive one shard each, merged at the end
+    if conf.processes > 1:
+        processes_main(conf, bfpass)
 
-        bfpass = onepass
+    archive_main(conf, bfpass)
+
+
+def archive_main(conf, bfpass):
+    """Archive (and delete) the selected actions with one process"""
+    # Trace files are written on exit, whichever path ends the run
+    if conf.profile:
+        tracer = runtrace.start(conf.profile, conf.profiler)
+        atexit.register(finish_profile, tracer, conf.quiet)
+
+    # Run metrics are only collected when they are exported
+    metrics = runmetrics.RunMetrics() if conf.metrics_file else None
 
     # Create the archive writer (handles both directories and archive files)
-    # Show writer creation only in verbose mode
-    writer = ArchiveWriter(conf.folder, verbose=conf.verbose)
+    # Show writer creation only in verbose mode. Batched or size-capped
+    # archive output is written as segments, each closed before its
+    # actions are deleted.
+    segmented = is_archive_path(conf.folder) and (conf.batch_size > 0 or conf.segment_size > 0)
+    writer_class = SegmentedArchiveWriter if segmented else ArchiveWriter
+    writer_options = {"segment_bytes": conf.segment_size} if segmented else {}
+    writer = writer_class(conf.folder, verbose=conf.verbose, dedup=conf.dedup,
+                          compress_workers=conf.compress_workers, index=not conf.no_index,
+                          metrics=metrics, **writer_options)
 
-    # Connect to BigFix server
-    try:
-        big_fix = bigfixREST.BigfixRESTConnection(
-            conf.bfserver, conf.bfport, conf.bfuser, bfpass
+    # With --threads auto, one limiter paces every request of the run
+    limiter = None
+    if conf.adaptive:
+        limiter = bigfixREST.AdaptiveLimiter(
+            initial=min(ADAPTIVE_INITIAL_THREADS, conf.max_threads),
+            maximum=conf.max_threads,
         )
-    except BigfixAuthenticationError as e:
-        print(f"AUTHENTICATION ERROR: {e}")
-        sys.exit(1)
-    except BigfixConnectionError as e:
-        print(f"CONNECTION ERROR: {e}")
-        sys.exit(1)
-    except Exception as e:
-        print(f"UNEXPECTED ERROR connecting to BigFix: {e}")
-        sys.exit(1)
 
-    actquery = f"""(id of it, state of it, name of it, time issued of it,
-    name of issuer of it | "_DeletedOperator", multiple flag of it)
-    of bes actions
-    whose ({conf.whose} and ((now - time issued of it) > {conf.older}*day) and
-    top level flag of it and
-    (state of it = "Expired" or state of it = "Stopped"))""".strip()
+    # Transient failures are retried; a run of them pauses every worker
+    retry_policy = bigfixREST.RetryPolicy(max_retries=conf.retries, backoff=conf.retry_backoff)
+    breaker = None
+    if conf.breaker_threshold > 0:
+        breaker = bigfixREST.CircuitBreaker(conf.breaker_threshold, conf.breaker_cooldown)
+
+    # Recorded traffic is written as it happens and committed on exit
+    cassette = None
+    if conf.record or conf.replay:
+        try:
+            cassette = bigfixREST.Cassette(
+                conf.record or conf.replay, "record" if conf.record else "replay", conf.replay_speed
+            )
+        except (OSError, sqlite3.Error) as e:
+            print(f"ERROR: Could not open the cassette: {e}")
+            sys.exit(1)
+        atexit.register(cassette.close)
+        if conf.replay and not conf.quiet:
+            print(f"Replaying {cassette.exchanges} recorded request(s) from {conf.replay}.")
+
+    # Connect to BigFix server. The connection pool holds one keep-alive
+    # connection per worker thread (whichever phase uses more) plus one for
+    # the selection queries the main thread runs alongside them.
+    big_fix = connect_bigfix(
+        conf,
+        bfpass,
+        limiter=limiter,
+        retry_policy=retry_policy,
+        breaker=breaker,
+        pool_size=max(conf.threads, conf.delete_threads or 0) + 1,
+        metrics=metrics,
+        cassette=cassette,
+    )
 
     # Query for actions to archive
+    selection = ActionSelection(big_fix, conf)
     try:
-        ares = big_fix.relevance_query_json(actquery)
+        with runtrace.span("select actions", "phase"):
+            selection.start()
     except BigfixAPIError as e:
         print(f"QUERY ERROR: {e}")
         if conf.verbose:
-            print(f"Query was: {actquery}")
+            print(f"Query was: {selection.query}")
         sys.exit(1)
 
     # Report query results (unless quiet)
     if not conf.quiet:
-        print(f"Found {len(ares['result'])} action(s) to archive.")
+        print(f"Found {selection.total} action(s) to archive.")
 
     # Record start time for performance metrics
     start_time = time.time()
     start_datetime = datetime.now()
 
-    # Write action data
-    writer.write_file(
-        writer.get_path("action_data.json"),
-        json.dumps(ares, sort_keys=True, indent=4)
-    )
+    # The checkpoint journal is kept for directory output, where every
+    # written file is final; --resume picks up from it
+    journal = None
+    if writer.archive_type == "directory":
+        journal = ArchiveJournal(writer.get_path(JOURNAL_NAME), resume=conf.resume,
+                                 before_sync=writer.sync_written)
+
+    # Per-endpoint results table; a resumed run keeps the rows of journaled actions
+    if conf.results:
+        keep_actions = journal.archived if conf.resume and journal is not None else None
+        try:
+            writer.results = ResultsTable(writer, conf.results, keep_actions=keep_actions)
+        except (OSError, sqlite3.Error) as e:
+            print(f"ERROR: Could not create the results table: {e}")
+            sys.exit(1)
+
+    # On resume, skip journaled actions; those archived but not yet deleted
+    # only need their deletion
+    chunks = selection.chunks()
+    resumed_deletes = ActionSpool()
+    total_actions = selection.total
+    if conf.resume:
+        chunks = filter_resumed(chunks, journal, conf, resumed_deletes)
+        total_actions = max(0, selection.total - len(journal.archived - journal.deleted))
+        if not conf.quiet:
+            print(f"Resuming: {selection.total - total_actions} action(s) "
+                  f"already archived, about {total_actions} remaining.")
+
+    # Write action data (a chunked selection is only known once consumed)
+    if not selection.chunked:
+        selection.write_action_data(writer, merge_previous=conf.resume)
 
     # Write execution config data
-    v_conf = vars(conf)
-    v_conf["bfpass"] = "Removed_for_Security"
-    writer.write_file(
-        writer.get_path("execution_config_data.json"),
-        json.dumps(v_conf, sort_keys=True, indent=4)
-    )
+    write_execution_config(writer, conf)
 
     # Phase 1: Archive all actions (collect IDs for deletion if needed)
-    total_actions = len(ares["result"])
-
     # Create shared resources for threading
+    stats = RunStats()
+    stats.limiter = limiter
+    stats.retry_policy = retry_policy
+    stats.breaker = breaker
+    stats.transfer = big_fix.transfer
+    stats.writer = writer
     progress_lock = threading.Lock()
     actions_processed = [0]  # Use list for mutability across threads
-    all_actions_to_delete = []  # Collect all actions for final deletion (no batching)
+    all_actions_to_delete = ActionSpool()  # Collect all actions for final deletion (no batching)
     all_errors = []
 
+    # Export metrics periodically and once more on exit, whichever path ends the run
+    if metrics is not None:
+        metrics.add_refresh(lambda m: refresh_metrics(m, stats, actions_processed, all_errors))
+        exporter = runmetrics.MetricsExporter(metrics, conf.metrics_file, conf.metrics_interval)
+        atexit.register(exporter.stop)
+        exporter.start()
+
     # Report threading mode (unless quiet)
-    if not conf.quiet and conf.threads > 1:
+    if not conf.quiet and conf.adaptive:
+        print(f"Using adaptive concurrency: starting at {limiter.limit}, up to {conf.max_threads} request(s) in flight.")
+    elif not conf.quiet and conf.engine == "async":
+        print(f"Using the async engine with up to {conf.threads} concurrent request(s).")
+    elif not conf.quiet and conf.threads > 1:
         print(f"Using {conf.threads} worker threads for parallel processing.")
 
     # Report batching mode (unless quiet)
@@ -487,58 +4308,57 @@ def main():
         num_batches = (total_actions + conf.batch_size - 1) // conf.batch_size
         print(f"Processing {total_actions} actions in {num_batches} batch(es) of {conf.batch_size}.")
 
-    # Determine batches
-    if conf.batch_size > 0:
-        # Split actions into batches
-        batches = [ares["result"][i:i+conf.batch_size]
-                   for i in range(0, len(ares["result"]), conf.batch_size)]
-    else:
-        # No batching - process all at once
-        batches = [ares["result"]]
-
-    # Process each batch
-    for batch_num, batch in enumerate(batches, 1):
-        batch_actions_to_delete = []
+    # Process each batch; the selection is fetched as the batches consume it
+    num_batches = (total_actions + conf.batch_size - 1) // conf.batch_size if conf.batch_size > 0 else 1
+    selection_errors = []
+    batches = iter_batches(guard_selection(chunks, selection_errors), conf.batch_size)
+    action_data_written = False
+    for batch_num, (batch, last_batch) in enumerate(mark_last(batches), 1):
+        # Without batching the one batch is the whole selection
+        batch_actions_to_delete = [] if conf.batch_size > 0 else ActionSpool()
         batch_errors = []
 
         # Report batch start (if batching enabled and not quiet)
         if not conf.quiet and conf.batch_size > 0:
-            print(f"\nBatch {batch_num}/{len(batches)}: Processing {len(batch)} action(s)...")
-
-        # Use ThreadPoolExecutor for parallel processing
-        with concurrent.futures.ThreadPoolExecutor(max_workers=conf.threads) as executor:
-            # Submit all actions in this batch to the executor
-            futures = {
-                executor.submit(
-                    process_action,
-                    actid,
-                    big_fix,
-                    writer,
-                    conf,
-                    progress_lock,
-                    actions_processed,
-                    total_actions
-                ): actid
-                for actid in batch
-            }
-
-            # Collect results as they complete
-            for future in concurrent.futures.as_completed(futures):
-                actid = futures[future]
-                try:
-                    success, returned_actid, error = future.result()
+            print(f"\nBatch {batch_num}/{max(num_batches, batch_num)}: Processing {len(batch[0])} action(s)...")
+
+        # Archive the batch with the selected fetch engine
+        if conf.engine == "async":
+            results = archive_batch_async(
+                batch,
+                big_fix,
+                (conf.bfserver, conf.bfport, conf.bfuser, bfpass),
+                writer,
+                conf,
+                progress_lock,
+                actions_processed,
+                total_actions
+            )
+        else:
+            results = archive_batch_threads(
+                batch,
+                big_fix,
+                writer,
+                conf,
+                progress_lock,
+                actions_processed,
+                total_actions
+            )
+
+        for success, returned_actid, error in results:
+            if not success:
+                # Collect error for reporting
+                batch_errors.append((returned_actid, error))
+                continue
 
-                    if not success:
-                        # Collect error for reporting
-                        batch_errors.append((returned_actid, error))
-                    elif conf.delete:
-                        # Collect action for deletion (thread-safe)
-                        with progress_lock:
-                            batch_actions_to_delete.append(returned_actid)
+            if journal is not None:
+                journal.record(returned_actid[0], "archived")
+            if conf.delete:
+                batch_actions_to_delete.append(returned_actid)
 
-                except Exception as e:
-                    # Unexpected exception from the future itself
-                    batch_errors.append((actid, e))
+        # Actions archived by an earlier run are already durable
+        batch_actions_to_delete.extend(resumed_deletes)
+        resumed_deletes.clear()
 
         # Report batch errors
         if batch_errors:
@@ -548,34 +4368,44 @@ def main():
             all_errors.extend(batch_errors)
             # Continue to next batch even if this one had errors
 
+        # Each batch of archive output ends its segment. The last one also
+        # takes the run's closing files, so that no segment holds only those
+        if segmented and conf.batch_size > 0:
+            if last_batch:
+                if selection.chunked:
+                    selection.write_action_data(writer, merge_previous=conf.resume)
+                    action_data_written = True
+                if writer.results is not None:
+                    writer.results.close()
+            with runtrace.span("finish segment", "phase"):
+                writer.finish_segment()
+
         # If batching with delete: delete this batch now (Phase 2 per batch)
         if conf.batch_size > 0 and conf.delete and batch_actions_to_delete and not batch_errors:
             if not conf.quiet:
                 print(f"\nBatch {batch_num} complete. Deleting {len(batch_actions_to_delete)} action(s) from server...")
 
-            for actid in batch_actions_to_delete:
-                durl = f"/api/action/{str(actid[0])}"
-
-                # Verbose mode shows the API details
-                if conf.verbose:
-                    print(f"  Running REST API: DELETE {durl}")
-
-                try:
-                    delres = big_fix.api_delete(durl)
-                    if delres != b"ok":
-                        print(
-                            f"WARNING: [DELETE https://{conf.bfserver}:{conf.bfport}{durl}] returned {delres}."
-                        )
-                    elif not conf.quiet:
-                        print(f"  Deleted action {actid[0]}: {actid[2]}")
-                except BigfixAPIError as e:
-                    print(f"ERROR deleting action {actid[0]}: {e}")
-                    print(f"Archive is complete but some actions may not have been deleted.")
-                    all_errors.append((actid, e))
+            if journal is not None:
+                journal.sync()
+            all_errors.extend(delete_actions(big_fix, batch_actions_to_delete, conf, journal, stats))
         else:
             # No batching or no delete: collect for later
             all_actions_to_delete.extend(batch_actions_to_delete)
 
+    # A chunked selection is complete once all batches consumed it
+    if selection.chunked and not action_data_written:
+        selection.write_action_data(writer, merge_previous=conf.resume)
+
+    # A failed selection query leaves the run incomplete; --resume continues it
+    if selection_errors:
+        print(f"\nQUERY ERROR: {selection_errors[0]}")
+        print(f"Action selection stopped early. No further actions will be deleted.")
+        writer.close()
+        if journal is not None:
+            journal.close()
+        print_performance_summary(start_time, start_datetime, total_actions, conf.quiet, stats)
+        sys.exit(1)
+
     # Report any errors that occurred across all batches
     if all_errors:
         print(f"\nERROR: {len(all_errors)} total action(s) failed during processing:")
@@ -584,48 +4414,37 @@ def main():
                 print(f"  Action {actid[0]} ({actid[2]}): {error}")
         if conf.batch_size == 0:  # Only exit if not batching (batching continues on errors)
             print(f"\nArchiving incomplete due to errors. No actions will be deleted.")
-            print_performance_summary(start_time, start_datetime, total_actions, conf.quiet)
+            print_performance_summary(start_time, start_datetime, total_actions, conf.quiet, stats)
             sys.exit(1)
 
     # Close the writer to finalize any archive
     # This ensures all files are written to disk before any deletions occur
-    writer.close()
+    with runtrace.span("close writer", "phase"):
+        writer.close(sync=conf.delete)
 
     # Phase 2: Delete actions from server (only if no batching was used)
     if conf.batch_size == 0 and conf.delete and all_actions_to_delete:
         if not conf.quiet:
             print(f"\nArchive complete. Deleting {len(all_actions_to_delete)} action(s) from server...")
 
-        for actid in all_actions_to_delete:
-            durl = f"/api/action/{str(actid[0])}"
-
-            # Verbose mode shows the API details
-            if conf.verbose:
-                print(f"  Running REST API: DELETE {durl}")
+        if journal is not None:
+            journal.sync()
+        if delete_actions(big_fix, all_actions_to_delete, conf, journal, stats, stop_on_error=True):
+            print_performance_summary(start_time, start_datetime, total_actions, conf.quiet, stats)
+            sys.exit(1)
 
-            try:
-                delres = big_fix.api_delete(durl)
-                if delres != b"ok":
-                    print(
-                        f"WARNING: [DELETE https://{conf.bfserver}:{conf.bfport}{durl}] returned {delres}."
-                    )
-                elif not conf.quiet:
-                    print(f"  Deleted action {actid[0]}: {actid[2]}")
-            except BigfixAPIError as e:
-                print(f"ERROR deleting action {actid[0]}: {e}")
-                print(f"Archive is complete but some actions may not have been deleted.")
-                print_performance_summary(start_time, start_datetime, total_actions, conf.quiet)
-                sys.exit(1)
+    if journal is not None:
+        journal.close()
 
     # Print final summary (unless quiet)
     if not conf.quiet:
         if not conf.delete:
-            print(f"\nComplete: {len(ares['result'])} action(s) archived.")
+            print(f"\nComplete: {selection.action_count} action(s) archived.")
         else:
-            print(f"\nComplete: {len(ares['result'])} action(s) archived and deleted.")
+            print(f"\nComplete: {selection.action_count} action(s) archived and deleted.")
 
     # Print performance summary
-    print_performance_summary(start_time, start_datetime, total_actions, conf.quiet)
+    print_performance_summary(start_time, start_datetime, total_actions, conf.quiet, stats)
 
     sys.exit(0)
 
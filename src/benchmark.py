@@ -0,0 +1,216 @@
+"""
+benchmark.py -- offline throughput benchmark for actionarchive.py
+
+Starts a mock BigFix server (mockbigfix.py) and runs actionarchive.py
+against it once for every combination of --threads, --batch-sizes,
+--formats and --engines, each run in its own process. For every run it
+reports the wall time, actions/s, output bytes/s, the peak RSS of the
+archiver process and the requests the server saw.
+
+    python benchmark.py --actions 2000 --latency 0.01 --threads 1,4,16 \\
+        --formats directory,zip,tar.gz --json before.json
+
+Deleted actions are restored between runs, so --delete can be benchmarked
+too (pass it with --args).
+"""
+
+import argparse
+import glob
+import itertools
+import json
+import os
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import mockbigfix
+
+ACTIONARCHIVE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "actionarchive.py")
+
+# Output path suffix for each --formats entry
+FORMAT_SUFFIXES = {
+    "directory": "",
+    "zip": ".zip",
+    "tar": ".tar",
+    "tar.gz": ".tar.gz",
+    "tar.xz": ".tar.xz",
+}
+
+COLUMNS = (
+    ("format", "Format", "{}"),
+    ("engine", "Engine", "{}"),
+    ("threads", "Threads", "{}"),
+    ("batch_size", "Batch", "{}"),
+    ("seconds", "Seconds", "{:.2f}"),
+    ("actions_per_second", "Actions/s", "{:.1f}"),
+    ("mib_per_second", "MiB/s", "{:.2f}"),
+    ("peak_rss_mib", "Peak RSS MiB", "{:.1f}"),
+    ("requests", "Requests", "{}"),
+    ("status", "Status", "{}"),
+)
+
+
+def csv_list(convert):
+    def parse(value):
+        try:
+            return [convert(item.strip()) for item in value.split(",") if item.strip()]
+        except ValueError:
+            raise argparse.ArgumentTypeError(f"invalid list: {value}")
+    return parse
+
+
+def output_size(path):
+    """Bytes written: the archive file, or every file under the directory"""
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    total = 0
+    for root, _dirs, files in os.walk(path):
+        total += sum(os.path.getsize(os.path.join(root, name)) for name in files)
+    return total
+
+
+def run_archiver(args):
+    """Run actionarchive.py in a child process
+
+    Returns:
+        tuple: (exit status, wall seconds, peak RSS in bytes or None)
+    """
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, ACTIONARCHIVE] + args,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    if hasattr(os, "wait4"):
+        # wait4 reports the resource usage of this child alone
+        _pid, status, usage = os.wait4(process.pid, 0)
+        seconds = time.perf_counter() - start
+        process.returncode = os.waitstatus_to_exitcode(status)
+        # ru_maxrss is in KiB on Linux and in bytes on macOS
+        peak_rss = usage.ru_maxrss if sys.platform == "darwin" else usage.ru_maxrss * 1024
+        return process.returncode, seconds, peak_rss
+
+    process.wait()
+    return process.returncode, time.perf_counter() - start, None
+
+
+def run_case(server, conf, workdir, output_format, engine, threads, batch_size):
+    """Benchmark one combination and return its result row"""
+    server.reset()
+    output = os.path.join(workdir, f"run{FORMAT_SUFFIXES[output_format]}")
+    args = [
+        "-b", "127.0.0.1", "-p", str(server.port), "-u", server.user, "-P", server.password,
+        "-f", output, "-q", "-e", engine, "-t", str(threads), "-B", str(batch_size),
+    ] + shlex.split(conf.args)
+
+    status, seconds, peak_rss = run_archiver(args)
+    # Batched archive output is written as segments: run.part0001.zip, ...
+    segments = glob.glob(os.path.join(workdir, f"run.part*{FORMAT_SUFFIXES[output_format]}"))
+    outputs = [path for path in [output] + segments if os.path.exists(path)]
+    size = sum(output_size(path) for path in outputs)
+    if os.path.isdir(output):
+        shutil.rmtree(output, ignore_errors=True)
+    for path in outputs:
+        for name in (path, path + ".index.sqlite"):
+            if os.path.isfile(name):
+                os.remove(name)
+
+    # A failed run says nothing about throughput
+    ok = status == 0
+    return {
+        "format": output_format,
+        "engine": engine,
+        "threads": threads,
+        "batch_size": batch_size,
+        "seconds": seconds,
+        "actions_per_second": len(server.data.actions) / seconds if ok else None,
+        "output_bytes": size,
+        "mib_per_second": size / seconds / (1024 * 1024) if ok else None,
+        "peak_rss_mib": peak_rss / (1024 * 1024) if peak_rss is not None else None,
+        "requests": sum(server.requests.values()),
+        "status": "ok" if ok else f"exit {status}",
+    }
+
+
+def format_table(rows):
+    cells = [[title for _key, title, _fmt in COLUMNS]]
+    for row in rows:
+        cells.append([
+            "n/a" if row[key] is None else fmt.format(row[key])
+            for key, _title, fmt in COLUMNS
+        ])
+    widths = [max(len(line[i]) for line in cells) for i in range(len(COLUMNS))]
+    lines = ["  ".join(cell.rjust(width) for cell, width in zip(line, widths)) for line in cells]
+    lines.insert(1, "  ".join("-" * width for width in widths))
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark actionarchive.py against a local mock BigFix server")
+    parser.add_argument("--threads", type=csv_list(int), default=[1, 4, 8],
+                        help="Comma-separated --threads values (default: 1,4,8)")
+    parser.add_argument("--batch-sizes", type=csv_list(int), default=[0],
+                        help="Comma-separated --batch-size values (default: 0)")
+    parser.add_argument("--formats", type=csv_list(str), default=["directory", "zip", "tar.gz"],
+                        help=f"Comma-separated output formats: {', '.join(FORMAT_SUFFIXES)} "
+                             "(default: directory,zip,tar.gz)")
+    parser.add_argument("--engines", type=csv_list(str), default=["threads"],
+                        help="Comma-separated --engine values (default: threads)")
+    parser.add_argument("--repeat", type=int, default=1, help="Runs of each combination (default: 1)")
+    parser.add_argument("--args", default="", help='More actionarchive.py arguments, e.g. "--dedup -d"')
+    parser.add_argument("--json", metavar="PATH", help="Also write the results to PATH as JSON")
+    parser.add_argument("-p", "--port", type=int, default=0,
+                        help="Port for the mock server (default: any free port)")
+    mockbigfix.add_data_arguments(parser)
+    conf = parser.parse_args()
+
+    unknown = [name for name in conf.formats if name not in FORMAT_SUFFIXES]
+    if unknown:
+        print(f"ERROR: Unknown format(s): {', '.join(unknown)}")
+        sys.exit(1)
+    if conf.repeat < 1:
+        print("ERROR: --repeat must be 1 or greater")
+        sys.exit(1)
+
+    try:
+        server = mockbigfix.MockBigFixServer(
+            mockbigfix.data_from_args(conf), port=conf.port, latency=conf.latency,
+            jitter=conf.jitter, error_rate=conf.error_rate, result_latency=conf.result_latency,
+        ).start()
+    except (OSError, RuntimeError, subprocess.CalledProcessError) as e:
+        print(f"ERROR: Could not start the mock server: {e}")
+        sys.exit(1)
+
+    members = sum(len(rows) for rows in server.data.members.values())
+    print(f"Mock server on port {server.port}: {len(server.data.actions)} action(s), "
+          f"{members} MAG member action(s), {conf.endpoints} endpoint(s) per result, "
+          f"{conf.latency * 1000:g} ms latency, {conf.error_rate:.0%} errors.")
+
+    rows = []
+    workdir = tempfile.mkdtemp(prefix="aa-benchmark-")
+    cases = itertools.product(conf.formats, conf.engines, conf.threads, conf.batch_sizes)
+    try:
+        for case in cases:
+            for _ in range(conf.repeat):
+                row = run_case(server, conf, workdir, *case)
+                rows.append(row)
+                print(f"  {row['format']:>9} {row['engine']:>7} threads={row['threads']:<3} "
+                      f"batch={row['batch_size']:<5} {row['seconds']:7.2f}s  {row['status']}")
+    except KeyboardInterrupt:
+        print("Interrupted; reporting the runs completed so far.")
+    finally:
+        server.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print()
+    print(format_table(rows))
+
+    if conf.json:
+        settings = {key: value for key, value in vars(conf).items() if key != "json"}
+        with open(conf.json, "w", encoding="utf-8") as f:
+            json.dump({"settings": settings, "results": rows}, f, indent=4)
+        print(f"\nResults written to {conf.json}")
+
+
+if __name__ == "__main__":
+    main()
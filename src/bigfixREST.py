@@ -6,10 +6,29 @@ access the BigFix core REST API. Consider using jgstew's besapi module
 https://github.com/jgstew/besapi
 """
 
+import asyncio
+import contextlib
+import hashlib
+import io
 import json
+import os
+import random
+import sqlite3
 import threading
+import time
+import zlib
+from email.utils import parsedate_to_datetime
 import xml.etree.ElementTree as ET
 import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+# aiohttp is only needed for BigfixRESTAsyncConnection (--engine async)
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
 
 # This is here ONLY to suppress self-signed certoficate warnings
 import urllib3
@@ -17,6 +36,19 @@ import urllib3
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 # End of warning supression
 
+# Size of the body chunks yielded by api_get_stream()
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# Responses are requested gzip-encoded; action status XML compresses very well
+ACCEPT_ENCODING = "gzip"
+
+# Seconds an idle async connection is kept open for reuse (aiohttp default is 15)
+KEEPALIVE_SECONDS = 60
+
+# Response headers kept in a cassette; request headers (credentials) never are
+CASSETTE_HEADERS = ("Content-Type", "Retry-After")
+CASSETTE_COMMIT_ROWS = 200
+
 
 class BigfixRESTError(Exception):
     """Base exception for BigFix REST API errors"""
@@ -53,6 +85,399 @@ class BigfixAPIError(BigfixRESTError):
     pass
 
 
+## AdaptiveLimiter class
+class AdaptiveLimiter:
+    """Caps the number of REST requests in flight and adapts the cap (AIMD)
+
+    Each finished request reports its latency and whether it succeeded
+    (no network error, timeout or HTTP 5xx). After every window of
+    max(window, limit) requests the cap is adjusted:
+      - halved (multiplicative decrease) if the error rate exceeds
+        error_threshold, or the median latency exceeds latency_factor times
+        the best median seen so far
+      - raised by one (additive increase) otherwise
+    so throughput climbs while the server keeps up and backs off quickly
+    when it starts to struggle.
+
+    acquire()/release() gate threads; asyncio callers read the limit
+    property and report through record().
+    """
+
+    def __init__(self, initial, maximum, minimum=1, window=20,
+                 latency_factor=2.0, error_threshold=0.05):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.window = window
+        self.latency_factor = latency_factor
+        self.error_threshold = error_threshold
+        self._limit = float(max(minimum, min(initial, maximum)))
+        self._in_flight = 0
+        self._samples = []
+        self._baseline = None
+        self.lowest = self.highest = int(self._limit)
+        self._cond = threading.Condition()
+
+    @property
+    def limit(self):
+        """Current number of requests allowed in flight"""
+        return int(self._limit)
+
+    def acquire(self):
+        """Block until a request slot is free"""
+        with self._cond:
+            self._cond.wait_for(lambda: self._in_flight < int(self._limit))
+            self._in_flight += 1
+
+    def release(self):
+        """Free a request slot taken by acquire()"""
+        with self._cond:
+            self._in_flight -= 1
+            self._cond.notify_all()
+
+    def record(self, latency, ok):
+        """Report one finished request and adjust the limit when due"""
+        with self._cond:
+            self._samples.append((latency, ok))
+            if len(self._samples) < max(self.window, int(self._limit)):
+                return
+
+            latencies = sorted(sample[0] for sample in self._samples)
+            median = latencies[len(latencies) // 2]
+            error_rate = sum(1 for sample in self._samples if not sample[1]) / len(self._samples)
+            self._samples = []
+
+            if self._baseline is None or median < self._baseline:
+                self._baseline = median
+
+            if (error_rate > self.error_threshold or
+                    median > self.latency_factor * self._baseline):
+                self._limit = max(float(self.minimum), self._limit / 2)
+            else:
+                self._limit = min(float(self.maximum), self._limit + 1)
+
+            self.lowest = min(self.lowest, int(self._limit))
+            self.highest = max(self.highest, int(self._limit))
+            self._cond.notify_all()
+
+
+## RetryPolicy class
+class RetryPolicy:
+    """How transient failures of idempotent requests are retried
+
+    Network errors, timeouts and the HTTP statuses in RETRY_STATUSES are
+    retried up to max_retries times. The wait before retry n is drawn
+    uniformly from [0, min(max_backoff, backoff * 2**n)] ("full jitter"),
+    unless the server sent a Retry-After header, which is honored (up to
+    MAX_RETRY_AFTER seconds).
+    """
+
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+    MAX_RETRY_AFTER = 300.0
+
+    def __init__(self, max_retries=3, backoff=1.0, max_backoff=60.0):
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.retries = 0  # Retries made so far, across all threads
+        self._lock = threading.Lock()
+
+    def delay(self, attempt, retry_after=None):
+        """Seconds to wait before retrying after failed attempt number attempt"""
+        if retry_after is not None:
+            return min(retry_after, self.MAX_RETRY_AFTER)
+        return random.uniform(0, min(self.max_backoff, self.backoff * (2 ** attempt)))
+
+    def count_retry(self):
+        with self._lock:
+            self.retries += 1
+
+    @staticmethod
+    def parse_retry_after(value):
+        """Seconds from a Retry-After header (delta-seconds or HTTP-date)"""
+        if not value:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+
+## CircuitBreaker class
+class CircuitBreaker:
+    """Pauses every request while the server is clearly overloaded
+
+    After threshold consecutive transient failures (counted across all
+    threads), the breaker opens and all callers wait cooldown seconds
+    before sending anything. A success closes it again; another failure
+    after the pause re-opens it. A Retry-After from the server also holds
+    all callers for the time it asks for.
+    """
+
+    def __init__(self, threshold=10, cooldown=30.0):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.trips = 0  # Times the breaker opened
+        self._failures = 0
+        self._open_until = 0.0
+        self._lock = threading.Lock()
+
+    def wait_time(self):
+        """Seconds until requests may be sent again (0 if closed)"""
+        with self._lock:
+            return max(0.0, self._open_until - time.monotonic())
+
+    def wait(self):
+        """Block the calling thread while the breaker is open"""
+        remaining = self.wait_time()
+        while remaining > 0:
+            time.sleep(remaining)
+            remaining = self.wait_time()
+
+    def success(self):
+        with self._lock:
+            self._failures = 0
+
+    def failure(self, retry_after=None):
+        with self._lock:
+            self._failures += 1
+            now = time.monotonic()
+            if retry_after:
+                self._open_until = max(self._open_until, now + retry_after)
+            if self._failures >= self.threshold and self._open_until <= now:
+                self._open_until = now + self.cooldown
+                self._failures = 0
+                self.trips += 1
+
+
+## TransferStats class
+class TransferStats:
+    """Connection and transfer counters shared by the connections of a run
+
+    wire_bytes counts response bodies as received (compressed, if the server
+    gzip-encoded them); body_bytes counts them after decoding. Thread-safe.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._connections = 0
+        self._adapters = []
+        self.responses = 0
+        self.wire_bytes = 0
+        self.body_bytes = 0
+
+    def attach_adapter(self, adapter):
+        """Count the connections opened by a requests HTTPAdapter's pools"""
+        with self._lock:
+            self._adapters.append(adapter)
+
+    def connection_opened(self):
+        with self._lock:
+            self._connections += 1
+
+    def add_response(self, wire_bytes, body_bytes):
+        with self._lock:
+            self.responses += 1
+            self.wire_bytes += wire_bytes
+            self.body_bytes += body_bytes
+
+    @property
+    def connections(self):
+        """Number of connections (and so TLS handshakes) opened so far"""
+        with self._lock:
+            total = self._connections
+            for adapter in self._adapters:
+                pools = adapter.poolmanager.pools
+                for key in pools.keys():
+                    pool = pools.get(key)
+                    if pool is not None:
+                        total += pool.num_connections
+        return total
+
+
+def endpoint_type(method, url):
+    """Classify a request for metrics: action, status, query, delete or other"""
+    if method == "DELETE":
+        return "delete"
+    if url.startswith("/api/query"):
+        return "query"
+    if url.startswith("/api/action/"):
+        return "status" if url.endswith("/status") else "action"
+    return "other"
+
+
+## Cassette class
+class Cassette:
+    """REST traffic recorded to an SQLite file, for replay without the server
+
+    In "record" mode every request sent through recording_adapter() is
+    stored with its status, a few response headers, the decoded body
+    (zlib-compressed) and its latency to the response headers. Request
+    headers, and so the credentials, are not stored, nor is the server
+    name: a request is keyed by method, path and a hash of its body.
+
+    In "replay" mode replay_adapter() answers requests from the cassette,
+    without any network traffic. Repeated requests (retries, for example)
+    get the recorded responses in order, then the last one again. Each
+    response is delayed by its recorded latency divided by speed; speed 0
+    replays with no delay. A request that was never recorded gets a 404.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS exchanges (
+            seq INTEGER PRIMARY KEY,
+            method TEXT NOT NULL,
+            path TEXT NOT NULL,
+            request_hash TEXT NOT NULL,
+            request_body BLOB,
+            status INTEGER NOT NULL,
+            reason TEXT,
+            headers TEXT NOT NULL,
+            started REAL NOT NULL,
+            elapsed REAL NOT NULL,
+            body BLOB NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS exchanges_key ON exchanges (method, path, request_hash, seq);
+    """
+
+    def __init__(self, path, mode="replay", speed=1.0):
+        if mode not in ("record", "replay"):
+            raise ValueError(f"Unknown cassette mode {mode}")
+        if mode == "replay" and not os.path.exists(path):
+            raise FileNotFoundError(f"Cassette {path} does not exist")
+        if mode == "record" and os.path.exists(path):
+            os.remove(path)
+
+        self.path = path
+        self.mode = mode
+        self.speed = speed
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.executescript(self.SCHEMA)
+        self.start = time.monotonic()
+        self.exchanges = 0
+        self._uncommitted = 0
+        self._replay = {}  # key -> [seq, ...] in recorded order
+        self._played = {}  # key -> responses played so far
+
+        if mode == "replay":
+            for seq, method, path_url, request_hash in self.db.execute(
+                "SELECT seq, method, path, request_hash FROM exchanges ORDER BY seq"
+            ):
+                self._replay.setdefault((method, path_url, request_hash), []).append(seq)
+                self.exchanges += 1
+
+    @staticmethod
+    def _request_key(request):
+        body = request.body or b""
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        return request.method, request.path_url, hashlib.sha256(body).hexdigest(), body
+
+    def record(self, request, response, elapsed):
+        """Store one exchange; the response body must be read already"""
+        method, path_url, request_hash, request_body = self._request_key(request)
+        headers = {name: response.headers[name] for name in CASSETTE_HEADERS if name in response.headers}
+        row = (
+            method, path_url, request_hash, request_body or None,
+            response.status_code, response.reason, json.dumps(headers),
+            time.monotonic() - self.start - elapsed, elapsed, zlib.compress(response.content),
+        )
+        with self.lock:
+            self.db.execute(
+                "INSERT INTO exchanges (method, path, request_hash, request_body, status, reason,"
+                " headers, started, elapsed, body) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", row
+            )
+            self.exchanges += 1
+            self._uncommitted += 1
+            if self._uncommitted >= CASSETTE_COMMIT_ROWS:
+                self.db.commit()
+                self._uncommitted = 0
+
+    def play(self, request):
+        """The next recorded response to request
+
+        Returns:
+            tuple: (status, reason, headers dict, body bytes, elapsed) or None
+        """
+        method, path_url, request_hash, _body = self._request_key(request)
+        key = (method, path_url, request_hash)
+        with self.lock:
+            seqs = self._replay.get(key)
+            if not seqs:
+                return None
+            played = self._played.get(key, 0)
+            self._played[key] = played + 1
+            status, reason, headers, elapsed, body = self.db.execute(
+                "SELECT status, reason, headers, elapsed, body FROM exchanges WHERE seq = ?",
+                (seqs[min(played, len(seqs) - 1)],),
+            ).fetchone()
+        return status, reason, json.loads(headers), zlib.decompress(body), elapsed
+
+    def recording_adapter(self, pool_size):
+        return RecordingAdapter(self, pool_connections=1, pool_maxsize=pool_size)
+
+    def replay_adapter(self):
+        return ReplayAdapter(self)
+
+    def close(self):
+        with self.lock:
+            if self.db is not None:
+                self.db.commit()
+                self.db.close()
+                self.db = None
+
+
+class RecordingAdapter(HTTPAdapter):
+    """HTTPAdapter that stores every exchange in a Cassette
+
+    Bodies are read in full before they are returned, so streamed
+    responses are held in memory while recording."""
+
+    def __init__(self, cassette, **kwargs):
+        self.cassette = cassette
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        start = time.monotonic()
+        response = super().send(request, **kwargs)
+        elapsed = time.monotonic() - start
+        response.content  # Read the body; iter_content() then replays it
+        self.cassette.record(request, response, elapsed)
+        return response
+
+
+class ReplayAdapter(HTTPAdapter):
+    """HTTPAdapter that answers requests from a Cassette instead of the network"""
+
+    def __init__(self, cassette):
+        self.cassette = cassette
+        super().__init__(pool_connections=1, pool_maxsize=1)
+
+    def send(self, request, **kwargs):
+        played = self.cassette.play(request)
+        if played is None:
+            status, reason, headers, body, elapsed = 404, "Not in cassette", {}, b"", 0.0
+        else:
+            status, reason, headers, body, elapsed = played
+        if self.cassette.speed > 0 and elapsed > 0:
+            time.sleep(elapsed / self.cassette.speed)
+
+        response = requests.Response()
+        response.status_code = status
+        response.reason = reason
+        response.headers = CaseInsensitiveDict(headers)
+        response.encoding = get_encoding_from_headers(response.headers)
+        response.raw = io.BytesIO(body)
+        response.url = request.url
+        response.request = request
+        response.connection = self
+        return response
+
+
 ## bigFixActionResult class
 class BigfixActionResult:
     """A class that represents an API Action Result"""
@@ -86,24 +511,61 @@ class BigfixRESTConnection:
     This class is thread-safe for concurrent requests. Multiple threads can safely
     call api_get(), api_delete(), and relevance_query_json() on the same instance.
     Each thread gets its own requests.Session via threading.local() to avoid
-    conflicts with cookies, redirects, and connection pooling. Authentication
-    credentials and configuration are shared across threads.
+    conflicts with cookies and redirects. All sessions share one HTTPAdapter
+    whose connection pool holds pool_size keep-alive connections, so TLS
+    connections (including the one opened by the login check) are reused by
+    every thread for the whole run. Size pool_size to the number of threads.
+    Authentication credentials and configuration are shared across threads.
+
+    Responses are requested gzip-encoded. Connections opened and bytes
+    received are counted in transfer, a TransferStats.
+
+    If an AdaptiveLimiter is given, every request waits for a slot from it
+    and reports its latency and outcome back to it.
+
+    Idempotent calls (GET, DELETE and read-only relevance queries) are
+    retried according to retry_policy, and all calls wait while the shared
+    CircuitBreaker, if any, is open.
+
+    If metrics is given (see runmetrics.RunMetrics), every request attempt
+    is reported to its observe_request(endpoint, seconds, status).
+
+    With a Cassette in "record" mode all traffic is also written to it; in
+    "replay" mode requests are answered from it and the server is never
+    contacted.
     """
 
-    def __init__(self, bfserver, bfport, bfuser, bfpass):
+    def __init__(self, bfserver, bfport, bfuser, bfpass, limiter=None,
+                 retry_policy=None, breaker=None, pool_size=10, transfer=None, metrics=None,
+                 cassette=None):
         self.bfserver = bfserver
         self.bfport = bfport
         self.bfuser = bfuser
         self.bfpass = bfpass
+        self.limiter = limiter  # Optional AdaptiveLimiter shared by all threads
+        self.retry_policy = retry_policy or RetryPolicy(max_retries=0)
+        self.breaker = breaker  # Optional CircuitBreaker shared by all threads
+        self.transfer = transfer or TransferStats()
+        self.metrics = metrics
         self._thread_local = threading.local()  # Each thread gets its own Session
+        self.cassette = cassette
+        # One connection pool for all threads; pool_block=False lets a burst
+        # above pool_size through instead of deadlocking, the extra
+        # connections are just not kept
+        if cassette is None:
+            self._adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        elif cassette.mode == "record":
+            self._adapter = cassette.recording_adapter(pool_size)
+        else:
+            self._adapter = cassette.replay_adapter()
+        self.transfer.attach_adapter(self._adapter)
         self.url = "https://" + self.bfserver + ":" + str(self.bfport)
         self.initialized = 0
 
-        # Verify authentication works (using a temporary session)
-        test_sess = requests.Session()
-        test_sess.auth = (self.bfuser, self.bfpass)
+        # Verify authentication works. This uses the calling thread's session,
+        # so the connection stays in the pool for the requests that follow.
         try:
-            resp = test_sess.get(self.url + "/api/login", verify=False, timeout=30)
+            resp = self._get_session().get(self.url + "/api/login", verify=False, timeout=30)
             if resp.ok:
                 self.initialized = 1
             else:
@@ -130,11 +592,83 @@ class BigfixRESTConnection:
     def _get_session(self):
         """Get or create a requests.Session for the current thread"""
         if not hasattr(self._thread_local, 'session'):
-            # Create a new session for this thread
-            self._thread_local.session = requests.Session()
-            self._thread_local.session.auth = (self.bfuser, self.bfpass)
+            # Create a new session for this thread on the shared pool
+            sess = requests.Session()
+            sess.auth = (self.bfuser, self.bfpass)
+            sess.headers["Accept-Encoding"] = ACCEPT_ENCODING
+            sess.mount("https://", self._adapter)
+            self._thread_local.session = sess
         return self._thread_local.session
 
+    def _count_transfer(self, res, body_bytes):
+        """Record a consumed response body in the transfer counters"""
+        self.transfer.add_response(res.raw.tell(), body_bytes)
+
+    def _send(self, method, url, timeout, stream=False, idempotent=True, **kwargs):
+        """Send a request, retrying transient failures, and return the Response
+
+        All API calls go through here. Network errors and timeouts that are
+        not retried are raised; a retryable HTTP status that is out of
+        retries is returned for the caller to report."""
+        policy = self.retry_policy
+        attempt = 0
+        while True:
+            if self.breaker is not None:
+                self.breaker.wait()
+
+            retry_after = None
+            try:
+                res = self._send_once(method, url, timeout, stream, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                if self.breaker is not None:
+                    self.breaker.failure()
+                if not idempotent or attempt >= policy.max_retries:
+                    raise
+            else:
+                if res.status_code not in RetryPolicy.RETRY_STATUSES:
+                    if self.breaker is not None:
+                        self.breaker.success()
+                    return res
+
+                retry_after = RetryPolicy.parse_retry_after(res.headers.get("Retry-After"))
+                if self.breaker is not None:
+                    self.breaker.failure(retry_after)
+                if not idempotent or attempt >= policy.max_retries:
+                    return res
+                res.close()
+
+            policy.count_retry()
+            time.sleep(policy.delay(attempt, retry_after))
+            attempt += 1
+
+    def _send_once(self, method, url, timeout, stream, **kwargs):
+        """Send one request on this thread's session and return the Response
+
+        The limiter and metrics see every attempt. Latency is measured up to
+        the response headers."""
+        sess = self._get_session()
+        prepped = sess.prepare_request(requests.Request(method, self.url + url, **kwargs))
+
+        if self.limiter is not None:
+            self.limiter.acquire()
+        start = time.monotonic()
+        status = None
+        try:
+            res = sess.send(prepped, verify=False, timeout=timeout, stream=stream)
+            status = res.status_code
+        finally:
+            elapsed = time.monotonic() - start
+            if self.limiter is not None:
+                self.limiter.release()
+                self.limiter.record(elapsed, status is not None and status < 500)
+            if self.metrics is not None:
+                self.metrics.observe_request(endpoint_type(method, url), elapsed, status)
+
+        # Streamed bodies are counted by the caller once consumed
+        if not stream:
+            self._count_transfer(res, len(res.content))
+        return res
+
     def _check_initialized(self):
         """Check if connection is initialized before making API calls"""
         if not self.initialized:
@@ -149,7 +683,7 @@ class BigfixRESTConnection:
 
         return False
 
-    def relevance_query_json(self, srquery):
+    def relevance_query_json(self, srquery, timeout=120):
         """Takes a session relevance query and returns a JSON dict
         Raises BigfixAPIError on failure"""
         self._check_initialized()
@@ -158,12 +692,9 @@ class BigfixRESTConnection:
         qquery = {"relevance": srquery, "output": "json"}
 
         try:
-            sess = self._get_session()
-            req = requests.Request(
-                "POST", self.url + "/api/query", headers=qheader, data=qquery
+            result = self._send(
+                "POST", "/api/query", timeout, headers=qheader, data=qquery
             )
-            prepped = sess.prepare_request(req)
-            result = sess.send(prepped, verify=False, timeout=120)
 
             if result.status_code == 200:
                 retval = json.loads(result.text)
@@ -189,9 +720,7 @@ class BigfixRESTConnection:
         self._check_initialized()
 
         try:
-            sess = self._get_session()
-            req = requests.Request("GET", self.url + url)
-            res = sess.send(sess.prepare_request(req), verify=False, timeout=60)
+            res = self._send("GET", url, 60)
 
             if not self._is_success(res.status_code):
                 raise BigfixAPIError(
@@ -208,6 +737,40 @@ class BigfixRESTConnection:
                 url=self.url + url
             )
 
+    ## Streaming GET
+    def api_get_stream(self, url, chunk_size=STREAM_CHUNK_SIZE):
+        """Does an http GET on a URL and yields the body as bytes chunks
+
+        The body is never held in memory as a whole, so this is the call to
+        use for large documents such as /api/action/{id}/status results.
+        The request is sent when iteration starts.
+        Raises BigfixAPIError on failure"""
+        self._check_initialized()
+
+        try:
+            res = self._send("GET", url, 60, stream=True)
+            try:
+                if not self._is_success(res.status_code):
+                    raise BigfixAPIError(
+                        "API GET request failed",
+                        url=self.url + url,
+                        status_code=res.status_code,
+                        reason=res.reason
+                    )
+
+                body_bytes = 0
+                for chunk in res.iter_content(chunk_size=chunk_size):
+                    body_bytes += len(chunk)
+                    yield chunk
+                self._count_transfer(res, body_bytes)
+            finally:
+                res.close()
+        except requests.exceptions.RequestException as e:
+            raise BigfixAPIError(
+                f"Network error during GET request: {str(e)}",
+                url=self.url + url
+            )
+
     ## Rawest possible DELETE
     def api_delete(self, url):
         """Calls an http DELETE on a URL and returns the decoded content
@@ -215,9 +778,7 @@ class BigfixRESTConnection:
         self._check_initialized()
 
         try:
-            sess = self._get_session()
-            req = requests.Request("DELETE", self.url + url)
-            res = sess.send(sess.prepare_request(req), verify=False, timeout=60)
+            res = self._send("DELETE", url, 60)
 
             if self._is_success(res.status_code):
                 return res.content
@@ -298,3 +859,379 @@ class BigfixRESTConnection:
             return BigfixActionResult(result.content)
         else:
             return None
+
+
+class _RequestTiming:
+    """Latency and outcome of one async request, for the AdaptiveLimiter"""
+
+    def __init__(self):
+        self.start = time.monotonic()
+        self.elapsed = None
+        self.ok = False
+
+    def response(self, status):
+        """Mark the arrival of the response headers"""
+        self.elapsed = time.monotonic() - self.start
+        self.ok = status < 500
+
+    def latency(self):
+        if self.elapsed is None:
+            return time.monotonic() - self.start
+        return self.elapsed
+
+
+class _BodyDecoder:
+    """Decodes a response body incrementally according to its Content-Encoding
+
+    The async connection decodes bodies itself (aiohttp's auto_decompress is
+    off) so that the bytes received can be counted before decompression."""
+
+    def __init__(self, headers):
+        encoding = headers.get("Content-Encoding", "").strip().lower()
+        if encoding in ("gzip", "x-gzip", "deflate"):
+            # 32 + MAX_WBITS accepts both gzip and zlib headers
+            self._zlib = zlib.decompressobj(32 + zlib.MAX_WBITS)
+        else:
+            self._zlib = None
+
+    def feed(self, data):
+        if self._zlib is None:
+            return data
+        return self._zlib.decompress(data)
+
+    def flush(self):
+        if self._zlib is None:
+            return b""
+        return self._zlib.flush()
+
+
+## bigfixRESTAsyncConnection class
+class BigfixRESTAsyncConnection:
+    """An asyncio counterpart of BigfixRESTConnection
+
+    Offers the same relevance_query_json(), api_get() and api_delete() calls
+    as coroutines. All requests share one aiohttp.ClientSession, and at most
+    max_in_flight requests are outstanding at any time, so a single thread
+    can keep many requests in flight against a high-latency server.
+
+    With an AdaptiveLimiter, the number of requests in flight follows the
+    limiter's current limit (never above max_in_flight). Retries and the
+    circuit breaker work as in BigfixRESTConnection.
+
+    Up to max_in_flight connections are kept alive for reuse, responses are
+    requested gzip-encoded, and connections opened and bytes received are
+    counted in transfer, a TransferStats that may be shared with a
+    BigfixRESTConnection. Request attempts are reported to metrics, as in
+    BigfixRESTConnection.
+
+    Usage:
+        async with BigfixRESTAsyncConnection(server, port, user, pw, 20) as bf:
+            xml = await bf.api_get("/api/action/123")
+
+    Requires the aiohttp package.
+    """
+
+    def __init__(self, bfserver, bfport, bfuser, bfpass, max_in_flight=10, limiter=None,
+                 retry_policy=None, breaker=None, transfer=None, metrics=None):
+        if aiohttp is None:
+            raise BigfixConnectionError(
+                "The aiohttp package is required for the async engine (pip install aiohttp)"
+            )
+        self.bfserver = bfserver
+        self.bfport = bfport
+        self.bfuser = bfuser
+        self.bfpass = bfpass
+        self.max_in_flight = max_in_flight
+        self.limiter = limiter  # Optional AdaptiveLimiter, caps below max_in_flight
+        self.retry_policy = retry_policy or RetryPolicy(max_retries=0)
+        self.breaker = breaker  # Optional CircuitBreaker, shared with other connections
+        self.transfer = transfer or TransferStats()
+        self.metrics = metrics
+        self.url = "https://" + self.bfserver + ":" + str(self.bfport)
+        self.initialized = 0
+        self._session = None
+        self._slots = None
+        self._in_flight = 0
+
+    async def open(self):
+        """Create the shared session and verify authentication works"""
+        self._slots = asyncio.Condition()
+
+        async def on_connection_create_end(session, context, params):
+            self.transfer.connection_opened()
+
+        trace = aiohttp.TraceConfig()
+        trace.on_connection_create_end.append(on_connection_create_end)
+        self._session = aiohttp.ClientSession(
+            auth=aiohttp.BasicAuth(self.bfuser, self.bfpass),
+            connector=aiohttp.TCPConnector(
+                ssl=False, limit=self.max_in_flight, keepalive_timeout=KEEPALIVE_SECONDS
+            ),
+            headers={"Accept-Encoding": ACCEPT_ENCODING},
+            auto_decompress=False,
+            trace_configs=[trace],
+        )
+
+        try:
+            async with self._session.get(
+                self.url + "/api/login", timeout=aiohttp.ClientTimeout(total=30)
+            ) as resp:
+                if resp.status == 401:
+                    raise BigfixAuthenticationError(
+                        "Authentication failed - invalid username or password",
+                        url=self.url + "/api/login",
+                        status_code=resp.status,
+                        reason=resp.reason
+                    )
+                if not self._is_success(resp.status):
+                    raise BigfixConnectionError(
+                        "Failed to connect to BigFix server",
+                        url=self.url + "/api/login",
+                        status_code=resp.status,
+                        reason=resp.reason
+                    )
+                self.initialized = 1
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            await self.close()
+            raise BigfixConnectionError(
+                f"Network error connecting to BigFix server: {str(e)}",
+                url=self.url + "/api/login"
+            )
+        except BigfixRESTError:
+            await self.close()
+            raise
+
+        return self
+
+    async def close(self):
+        """Close the shared session"""
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def __aenter__(self):
+        return await self.open()
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+        return False
+
+    def _slot_cap(self):
+        if self.limiter is None:
+            return self.max_in_flight
+        return min(self.max_in_flight, self.limiter.limit)
+
+    @contextlib.asynccontextmanager
+    async def _slot(self):
+        """Hold one in-flight request slot for the duration of a request
+
+        Yields a timing object; callers call its response(status) method when
+        the response headers arrive, which is what the limiter is told."""
+        async with self._slots:
+            await self._slots.wait_for(lambda: self._in_flight < self._slot_cap())
+            self._in_flight += 1
+
+        timing = _RequestTiming()
+        try:
+            yield timing
+        finally:
+            async with self._slots:
+                self._in_flight -= 1
+                self._slots.notify_all()
+            if self.limiter is not None:
+                self.limiter.record(timing.latency(), timing.ok)
+
+    @contextlib.asynccontextmanager
+    async def _request(self, method, url, timeout, idempotent=True, **kwargs):
+        """Send a request, retrying transient failures, and yield the response
+
+        The in-flight slot is held until the caller is done with the body.
+        Network errors and timeouts that are not retried are raised; a
+        retryable HTTP status that is out of retries is yielded for the
+        caller to report."""
+        policy = self.retry_policy
+        attempt = 0
+        while True:
+            if self.breaker is not None:
+                while (remaining := self.breaker.wait_time()) > 0:
+                    await asyncio.sleep(remaining)
+
+            retry_after = None
+            async with self._slot() as timing:
+                try:
+                    res = await self._session.request(
+                        method, self.url + url, timeout=timeout, **kwargs
+                    )
+                except (aiohttp.ClientError, asyncio.TimeoutError):
+                    if self.metrics is not None:
+                        self.metrics.observe_request(
+                            endpoint_type(method, url), timing.latency(), None
+                        )
+                    if self.breaker is not None:
+                        self.breaker.failure()
+                    if not idempotent or attempt >= policy.max_retries:
+                        raise
+                else:
+                    timing.response(res.status)
+                    if self.metrics is not None:
+                        self.metrics.observe_request(
+                            endpoint_type(method, url), timing.latency(), res.status
+                        )
+                    retryable = res.status in RetryPolicy.RETRY_STATUSES
+                    if retryable:
+                        retry_after = RetryPolicy.parse_retry_after(res.headers.get("Retry-After"))
+                        if self.breaker is not None:
+                            self.breaker.failure(retry_after)
+                    elif self.breaker is not None:
+                        self.breaker.success()
+
+                    if not retryable or not idempotent or attempt >= policy.max_retries:
+                        try:
+                            yield res
+                        finally:
+                            res.release()
+                        return
+                    res.release()
+
+            policy.count_retry()
+            await asyncio.sleep(policy.delay(attempt, retry_after))
+            attempt += 1
+
+    async def _read_body(self, res):
+        """Read and decode a whole response body, counting the transfer"""
+        data = await res.read()
+        decoder = _BodyDecoder(res.headers)
+        body = decoder.feed(data) + decoder.flush()
+        self.transfer.add_response(len(data), len(body))
+        return body
+
+    def _check_initialized(self):
+        """Check if connection is initialized before making API calls"""
+        if not self.initialized or self._session is None:
+            raise BigfixConnectionError(
+                "BigFix connection not initialized - authentication may have failed"
+            )
+
+    def _is_success(self, http_return_value):
+        rv_diff = http_return_value - 200
+        if rv_diff >= 0 and rv_diff < 100:
+            return True
+
+        return False
+
+    async def relevance_query_json(self, srquery, timeout=120):
+        """Takes a session relevance query and returns a JSON dict
+        Raises BigfixAPIError on failure"""
+        self._check_initialized()
+
+        qheader = {"Content-Type": "application/x-www-form-urlencoded"}
+        qquery = {"relevance": srquery, "output": "json"}
+
+        try:
+            async with self._request(
+                "POST",
+                "/api/query",
+                aiohttp.ClientTimeout(total=timeout),
+                headers=qheader,
+                data=qquery,
+            ) as result:
+                if result.status != 200:
+                    raise BigfixAPIError(
+                        "Session relevance query failed",
+                        url=self.url + "/api/query",
+                        status_code=result.status,
+                        reason=result.reason
+                    )
+                retval = json.loads(await self._read_body(result))
+                retval["query"] = srquery
+                return retval
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise BigfixAPIError(
+                f"Network error during relevance query: {str(e)}",
+                url=self.url + "/api/query"
+            )
+
+    ## Rawest possible GET
+    async def api_get(self, url):
+        """Does an http GET on a URL and returns the decoded result
+        Raises BigfixAPIError on failure"""
+        self._check_initialized()
+
+        try:
+            async with self._request(
+                "GET", url, aiohttp.ClientTimeout(total=60)
+            ) as res:
+                if not self._is_success(res.status):
+                    raise BigfixAPIError(
+                        "API GET request failed",
+                        url=self.url + url,
+                        status_code=res.status,
+                        reason=res.reason
+                    )
+                body = await self._read_body(res)
+                return body.decode(res.charset or "utf-8")
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise BigfixAPIError(
+                f"Network error during GET request: {str(e)}",
+                url=self.url + url
+            )
+
+    ## Streaming GET
+    async def api_get_stream(self, url, chunk_size=STREAM_CHUNK_SIZE):
+        """Does an http GET on a URL and yields the body as bytes chunks
+        (async generator). Raises BigfixAPIError on failure"""
+        self._check_initialized()
+
+        try:
+            async with self._request(
+                "GET", url, aiohttp.ClientTimeout(total=None, sock_read=60)
+            ) as res:
+                if not self._is_success(res.status):
+                    raise BigfixAPIError(
+                        "API GET request failed",
+                        url=self.url + url,
+                        status_code=res.status,
+                        reason=res.reason
+                    )
+                decoder = _BodyDecoder(res.headers)
+                wire_bytes = body_bytes = 0
+                async for data in res.content.iter_chunked(chunk_size):
+                    wire_bytes += len(data)
+                    chunk = decoder.feed(data)
+                    if chunk:
+                        body_bytes += len(chunk)
+                        yield chunk
+                chunk = decoder.flush()
+                if chunk:
+                    body_bytes += len(chunk)
+                    yield chunk
+                self.transfer.add_response(wire_bytes, body_bytes)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise BigfixAPIError(
+                f"Network error during GET request: {str(e)}",
+                url=self.url + url
+            )
+
+    ## Rawest possible DELETE
+    async def api_delete(self, url):
+        """Calls an http DELETE on a URL and returns the decoded content
+        Raises BigfixAPIError on failure"""
+        self._check_initialized()
+
+        try:
+            async with self._request(
+                "DELETE", url, aiohttp.ClientTimeout(total=60)
+            ) as res:
+                if not self._is_success(res.status):
+                    raise BigfixAPIError(
+                        "API DELETE request failed",
+                        url=self.url + url,
+                        status_code=res.status,
+                        reason=res.reason
+                    )
+                return await self._read_body(res)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise BigfixAPIError(
+                f"Network error during DELETE request: {str(e)}",
+                url=self.url + url
+            )
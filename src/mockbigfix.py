@@ -0,0 +1,478 @@
+"""
+mockbigfix.py -- a local stand-in for a BigFix root server's REST API
+
+Serves the endpoints actionarchive.py uses, over HTTPS:
+  GET    /api/login
+  POST   /api/query               (the session relevance queries actionarchive.py sends)
+  GET    /api/action/{id}
+  GET    /api/action/{id}/status
+  DELETE /api/action/{id}
+
+Actions are synthetic and generated from a seed, so every run sees the
+same data: a configurable number of expired actions, a share of them
+multiple action groups (MAGs) with member actions, and result documents
+with a configurable number of endpoints. Latency and errors can be
+injected. Responses are gzip-encoded when the client asks for it, like
+the real server.
+
+Run standalone:
+    python mockbigfix.py --actions 5000 --latency 0.02
+    python actionarchive.py -b 127.0.0.1 -u admin -P password -f ./archive
+
+or start MockBigFixServer from Python (see benchmark.py). Without --cert
+and --key a self-signed certificate is made with the openssl command.
+"""
+
+import argparse
+import functools
+import gzip
+import json
+import os
+import random
+import re
+import shutil
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from base64 import b64decode
+from email.utils import format_datetime
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+DEFAULT_PORT = 52311
+DEFAULT_USER = "admin"
+DEFAULT_PASSWORD = "password"
+
+# Responses at least this large are gzip-encoded for clients that accept it
+GZIP_MIN_BYTES = 1024
+
+# Generated response bodies kept for reuse
+BODY_CACHE_SIZE = 4096
+
+# Distinct action XML documents; actions cycle through them, as repeated
+# fixlet actions do on a real server
+ACTION_TEMPLATES = 50
+
+FIRST_ACTION_ID = 1000
+ISSUERS = ("admin", "patch_operator", "helpdesk", "audit", "_DeletedOperator")
+
+
+class MockData:
+    """The synthetic actions of one mock server
+
+    actions maps action ID to its selection row (id, state, name, time
+    issued, issuer, multiple flag); members maps MAG IDs to the rows
+    (id, state, name) of their member actions. Every action has endpoints
+    results, except large_actions randomly chosen top-level actions, which
+    have large_endpoints.
+    """
+
+    def __init__(self, actions=1000, mag_ratio=0.1, mag_members=3, endpoints=20,
+                 action_bytes=2048, seed=1, large_actions=0, large_endpoints=2000):
+        rng = random.Random(seed)
+        now = datetime.now(timezone.utc)
+        self.endpoints = endpoints
+        self.action_bytes = action_bytes
+        self.actions = {}
+        self.members = {}
+        self.member_ids = {}  # member action ID -> MAG ID
+        self.endpoint_counts = {}  # action ID -> results, where not endpoints
+
+        next_member = FIRST_ACTION_ID + actions
+        for i in range(actions):
+            action_id = FIRST_ACTION_ID + i
+            is_mag = rng.random() < mag_ratio
+            issued = now - timedelta(days=rng.randint(31, 900), seconds=rng.randint(0, 86399))
+            self.actions[action_id] = [
+                action_id,
+                rng.choice(("Expired", "Stopped")),
+                f"{'Baseline' if is_mag else 'Fixlet'} action {i % ACTION_TEMPLATES}",
+                format_datetime(issued),
+                rng.choice(ISSUERS),
+                is_mag,
+            ]
+            if is_mag:
+                rows = []
+                for j in range(mag_members):
+                    rows.append([next_member, "Expired", f"Component {j} of action {action_id}"])
+                    self.member_ids[next_member] = action_id
+                    next_member += 1
+                self.members[action_id] = rows
+
+        for action_id in rng.sample(sorted(self.actions), min(large_actions, actions)):
+            self.endpoint_counts[action_id] = large_endpoints
+
+        self.deleted = set()
+        self.lock = threading.Lock()
+
+    def reset(self):
+        """Bring back deleted actions"""
+        with self.lock:
+            self.deleted.clear()
+
+    def live_actions(self):
+        with self.lock:
+            return [row for action_id, row in self.actions.items() if action_id not in self.deleted]
+
+    def exists(self, action_id):
+        """True for live actions and the members of live MAGs"""
+        parent = self.member_ids.get(action_id, action_id)
+        with self.lock:
+            return parent in self.actions and parent not in self.deleted
+
+    def delete(self, action_id):
+        if action_id not in self.actions:
+            return False
+        with self.lock:
+            self.deleted.add(action_id)
+        return True
+
+    def row(self, action_id):
+        if action_id in self.actions:
+            return self.actions[action_id]
+        parent = self.member_ids[action_id]
+        for row in self.members[parent]:
+            if row[0] == action_id:
+                return [row[0], row[1], row[2], self.actions[parent][3], self.actions[parent][4], False]
+        raise KeyError(action_id)
+
+    def action_xml(self, action_id):
+        """The action definition; identical for actions with the same name"""
+        title = self.row(action_id)[2]
+        padding = "x" * max(0, self.action_bytes - 400)
+        return f"""<?xml version="1.0" encoding="UTF-8"?>
+<BES xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xsi:noNamespaceSchemaLocation="BES.xsd">
+<SingleAction>
+<Title>{title}</Title>
+<Relevance>true</Relevance>
+<ActionScript MIMEType="application/x-Fixlet-Windows-Shell">// {padding}</ActionScript>
+<SuccessCriteria />
+</SingleAction>
+</BES>
+"""
+
+    def results(self, action_id):
+        return self.endpoint_counts.get(action_id, self.endpoints)
+
+    def status_xml(self, action_id):
+        """The action results: one Computer element per endpoint"""
+        row = self.row(action_id)
+        computers = []
+        for k in range(self.results(action_id)):
+            computer_id = 10000000 + k
+            computers.append(
+                f'<Computer ID="{computer_id}" Name="endpoint{k:05d}">'
+                f'<State IsError="{int(k % 17 == 0)}">{"Failed" if k % 17 == 0 else "Fixed"}</State>'
+                f"<ApplyCount>1</ApplyCount><RetryCount>0</RetryCount><LineNumber>1</LineNumber>"
+                f"<StartTime>{row[3]}</StartTime><EndTime>{row[3]}</EndTime></Computer>"
+            )
+        return (
+            '<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<BESAPI xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xsi:noNamespaceSchemaLocation="BESAPI.xsd">'
+            f'<ActionResults Resource="https://localhost/api/action/{action_id}/status">'
+            f"<ActionID>{action_id}</ActionID><Status>{row[1]}</Status>"
+            f"<DateIssued>{row[3]}</DateIssued>{''.join(computers)}</ActionResults></BESAPI>\n"
+        )
+
+    def query(self, relevance):
+        """Evaluate the session relevance actionarchive.py sends
+
+        Returns the result list, or None for a query this mock does not know.
+        """
+        id_set = re.search(r"id of it is contained by set of \(([\d;\s]*)\)", relevance)
+        ids = [int(i) for i in id_set.group(1).split(";") if i.strip()] if id_set else None
+        if "(id of it, state of it, name of it) of member actions of it" in relevance and ids:
+            rows = []
+            for parent in ids:
+                for member in self.members.get(parent, []):
+                    rows.append([parent] + member)
+            return rows
+
+        if "minimum of ids of bes actions" in relevance:
+            ids = [row[0] for row in self.live_actions()]
+            return [[min(ids), max(ids)]] if ids else []
+
+        rows = self.live_actions()
+        if ids is not None:
+            wanted = set(ids)
+            rows = [row for row in rows if row[0] in wanted]
+        window = re.search(r"id of it >= (\d+) and id of it < (\d+)", relevance)
+        if window:
+            low, high = int(window.group(1)), int(window.group(2))
+            rows = [row for row in rows if low <= row[0] < high]
+        shard = re.search(r"id of it mod (\d+) = (\d+)", relevance)
+        if shard:
+            count, remainder = int(shard.group(1)), int(shard.group(2))
+            rows = [row for row in rows if row[0] % count == remainder]
+
+        if relevance.startswith("number of bes actions"):
+            return [len(rows)]
+        if relevance.startswith("minimum of (ids of bes actions"):
+            low = int(re.search(r"id of it >= (\d+)", relevance).group(1))
+            none = int(re.search(r"; (\d+)\)$", relevance).group(1))
+            return [min((row[0] for row in rows if row[0] >= low), default=none)]
+        if relevance.startswith("(id of it, state of it, name of it, time issued of it"):
+            return rows
+        if relevance.startswith("(id of it, number of results of it, number of member actions of it"):
+            counts = []
+            for row in rows:
+                members = len(self.members.get(row[0], []))
+                counts.append([row[0], self.results(row[0]), members, members * self.endpoints])
+            return counts
+        return None
+
+
+class MockBigFixHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "MockBigFix/1.0"
+    # Headers and body are written separately; without this, Nagle's
+    # algorithm and delayed ACKs add about 40 ms to every response
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def _send(self, status, body, content_type="application/xml", headers=None):
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        if len(body) >= GZIP_MIN_BYTES and "gzip" in self.headers.get("Accept-Encoding", ""):
+            body = self.server.gzip(body)
+            self.send_header("Content-Encoding", "gzip")
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _begin(self):
+        """Count the request, apply latency and errors; False if answered"""
+        self.server.count(self.command)
+        if self.server.latency or self.server.jitter:
+            time.sleep(self.server.latency + random.uniform(0, self.server.jitter))
+
+        expected = f"{self.server.user}:{self.server.password}"
+        auth = self.headers.get("Authorization", "")
+        if not auth.startswith("Basic ") or b64decode(auth[6:]).decode("utf-8", "replace") != expected:
+            self._send(401, "Unauthorized", "text/plain")
+            return False
+
+        if self.path != "/api/login" and random.random() < self.server.error_rate:
+            self._send(503, "Service Unavailable", "text/plain", {"Retry-After": "0"})
+            return False
+        return True
+
+    def do_GET(self):
+        if not self._begin():
+            return
+        if self.path == "/api/login":
+            return self._send(200, "ok", "text/plain")
+
+        match = re.fullmatch(r"/api/action/(\d+)(/status)?", self.path)
+        data = self.server.data
+        if not match or not data.exists(int(match.group(1))):
+            return self._send(404, "Not Found", "text/plain")
+
+        action_id = int(match.group(1))
+        if match.group(2):
+            # Large results take the server longer to gather
+            if self.server.result_latency:
+                time.sleep(self.server.result_latency * data.results(action_id))
+            return self._send(200, self.server.body("status", action_id))
+        return self._send(200, self.server.body("action", action_id))
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        form = parse_qs(self.rfile.read(length).decode("utf-8"))
+        if not self._begin():
+            return
+        if self.path != "/api/query" or "relevance" not in form:
+            return self._send(404, "Not Found", "text/plain")
+
+        relevance = form["relevance"][0].strip()
+        result = self.server.data.query(relevance)
+        if result is None:
+            return self._send(400, f"Unsupported relevance: {relevance}", "text/plain")
+        document = {"result": result, "plural": True, "type": "mock", "evaltime_ms": 1}
+        self._send(200, json.dumps(document), "application/json")
+
+    def do_DELETE(self):
+        if not self._begin():
+            return
+        match = re.fullmatch(r"/api/action/(\d+)", self.path)
+        if not match or not self.server.data.delete(int(match.group(1))):
+            return self._send(404, "Not Found", "text/plain")
+        self._send(200, "ok", "text/plain")
+
+
+class MockBigFixServer(ThreadingHTTPServer):
+    """HTTPS server for MockData; start() serves from a daemon thread
+
+    requests counts the requests served by HTTP method.
+    """
+
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, data, host="127.0.0.1", port=DEFAULT_PORT, user=DEFAULT_USER,
+                 password=DEFAULT_PASSWORD, latency=0.0, jitter=0.0, error_rate=0.0,
+                 certfile=None, keyfile=None, verbose=False, result_latency=0.0):
+        super().__init__((host, port), MockBigFixHandler)
+        self.data = data
+        self.user = user
+        self.password = password
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.result_latency = result_latency
+        self.verbose = verbose
+        self.requests = {}
+        self._count_lock = threading.Lock()
+        self._thread = None
+        self._cert_dir = None
+
+        if certfile is None:
+            self._cert_dir = tempfile.mkdtemp(prefix="mockbigfix-")
+            certfile, keyfile = make_self_signed_cert(self._cert_dir)
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(certfile, keyfile)
+        self.socket = context.wrap_socket(self.socket, server_side=True)
+
+        # Bodies depend only on the action, so they are generated once
+        self.body = functools.lru_cache(maxsize=BODY_CACHE_SIZE)(self._body)
+        self.gzip = functools.lru_cache(maxsize=BODY_CACHE_SIZE)(
+            functools.partial(gzip.compress, compresslevel=6, mtime=0)
+        )
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def _body(self, kind, action_id):
+        if kind == "status":
+            return self.data.status_xml(action_id).encode("utf-8")
+        return self.data.action_xml(action_id).encode("utf-8")
+
+    def count(self, method):
+        with self._count_lock:
+            self.requests[method] = self.requests.get(method, 0) + 1
+
+    def reset(self):
+        """Restore deleted actions and clear the request counts"""
+        self.data.reset()
+        with self._count_lock:
+            self.requests.clear()
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, name="mockbigfix", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if self._thread is not None:
+            self._thread.join()
+        if self._cert_dir is not None:
+            shutil.rmtree(self._cert_dir, ignore_errors=True)
+
+
+def make_self_signed_cert(directory):
+    """Create a self-signed certificate for localhost with openssl
+
+    Returns:
+        tuple: (certfile, keyfile)
+    """
+    certfile = os.path.join(directory, "cert.pem")
+    keyfile = os.path.join(directory, "key.pem")
+    if shutil.which("openssl") is None:
+        raise RuntimeError("openssl was not found; pass --cert and --key instead")
+    subprocess.run(
+        ["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "7",
+         "-subj", "/CN=localhost", "-keyout", keyfile, "-out", certfile],
+        check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    return certfile, keyfile
+
+
+def add_data_arguments(parser):
+    """Options shaping the synthetic data, shared with benchmark.py"""
+    group = parser.add_argument_group("Mock data")
+    group.add_argument("--actions", type=int, default=1000, help="Top-level actions (default: 1000)")
+    group.add_argument("--mag-ratio", type=float, default=0.1,
+                       help="Share of actions that are MAGs (default: 0.1)")
+    group.add_argument("--mag-members", type=int, default=3,
+                       help="Member actions per MAG (default: 3)")
+    group.add_argument("--endpoints", type=int, default=20,
+                       help="Endpoints in each action's results (default: 20)")
+    group.add_argument("--large-actions", type=int, default=0,
+                       help="Actions with --large-endpoints results instead (default: 0)")
+    group.add_argument("--large-endpoints", type=int, default=2000,
+                       help="Endpoints in the results of large actions (default: 2000)")
+    group.add_argument("--action-bytes", type=int, default=2048,
+                       help="Approximate size of each action XML (default: 2048)")
+    group.add_argument("--seed", type=int, default=1, help="Random seed for the data (default: 1)")
+    group.add_argument("--latency", type=float, default=0.0,
+                       help="Seconds added to every response (default: 0)")
+    group.add_argument("--jitter", type=float, default=0.0,
+                       help="Up to this many more seconds, at random (default: 0)")
+    group.add_argument("--result-latency", type=float, default=0.0,
+                       help="Seconds added to a status response per endpoint result (default: 0)")
+    group.add_argument("--error-rate", type=float, default=0.0,
+                       help="Share of requests answered with HTTP 503 (default: 0)")
+
+
+def data_from_args(conf):
+    return MockData(conf.actions, conf.mag_ratio, conf.mag_members, conf.endpoints,
+                    conf.action_bytes, conf.seed, conf.large_actions, conf.large_endpoints)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local mock of the BigFix REST API for actionarchive.py")
+    parser.add_argument("--host", default="127.0.0.1", help="Address to listen on (default: 127.0.0.1)")
+    parser.add_argument("-p", "--port", type=int, default=DEFAULT_PORT,
+                        help=f"Port to listen on (default: {DEFAULT_PORT})")
+    parser.add_argument("-u", "--user", default=DEFAULT_USER, help=f"Accepted user (default: {DEFAULT_USER})")
+    parser.add_argument("-P", "--password", default=DEFAULT_PASSWORD,
+                        help=f"Accepted password (default: {DEFAULT_PASSWORD})")
+    parser.add_argument("--cert", help="TLS certificate (PEM); default: a new self-signed one")
+    parser.add_argument("--key", help="TLS private key (PEM) for --cert")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Log every request")
+    add_data_arguments(parser)
+    conf = parser.parse_args()
+
+    if bool(conf.cert) != bool(conf.key):
+        print("ERROR: --cert and --key must be given together")
+        sys.exit(1)
+
+    try:
+        server = MockBigFixServer(
+            data_from_args(conf), conf.host, conf.port, conf.user, conf.password,
+            conf.latency, conf.jitter, conf.error_rate, conf.cert, conf.key, conf.verbose,
+            conf.result_latency,
+        )
+    except (OSError, RuntimeError, subprocess.CalledProcessError) as e:
+        print(f"ERROR: Could not start the mock server: {e}")
+        sys.exit(1)
+
+    members = sum(len(rows) for rows in server.data.members.values())
+    print(f"Serving {len(server.data.actions)} action(s) and {members} MAG member action(s) "
+          f"on https://{conf.host}:{server.port} (user {conf.user}). Press Ctrl+C to stop.")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if server._cert_dir is not None:
+            shutil.rmtree(server._cert_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,227 @@
+"""
+runmetrics.py -- run metrics for actionarchive.py (--metrics-file)
+
+A small thread-safe registry of counters, gauges and histograms, written
+out as a Prometheus textfile (for node_exporter's textfile collector) or as
+JSON, at the end of the run and periodically while it runs. No client
+library is needed.
+"""
+
+import json
+import math
+import os
+import threading
+import time
+
+PREFIX = "bigfix_archive_"
+
+# Request latency buckets, in seconds
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+# Lock wait buckets, in seconds
+LOCK_WAIT_BUCKETS = (0.0001, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+
+# name: (type, help, histogram buckets)
+METRICS = {
+    "request_duration_seconds": (
+        "histogram", "Time to the response headers of BigFix REST requests", LATENCY_BUCKETS),
+    "requests_total": (
+        "counter", "BigFix REST requests by endpoint and outcome (HTTP status class or error)", None),
+    "request_retries_total": ("counter", "Requests retried after a transient failure", None),
+    "circuit_breaker_trips_total": ("counter", "Times the circuit breaker opened", None),
+    "connections_opened_total": ("counter", "HTTPS connections opened", None),
+    "response_bytes_total": (
+        "counter", "Response body bytes received, on the wire and after decoding", None),
+    "writer_content_bytes_total": ("counter", "File content bytes written to the output", None),
+    "writer_encode_seconds_total": (
+        "counter", "Time workers spent reading and encoding archive members outside the writer lock", None),
+    "writer_lock_wait_seconds": (
+        "histogram", "Time spent waiting for the archive writer lock (zip and tar output)",
+        LOCK_WAIT_BUCKETS),
+    "writer_append_seconds_total": (
+        "counter", "Time spent holding the writer lock to append to the archive (zip and tar output)",
+        None),
+    "compress_wait_seconds_total": (
+        "counter", "Time the writer waited for compressed tar.gz/tar.xz blocks", None),
+    "actions_processed_total": ("counter", "Actions archived", None),
+    "action_errors_total": ("counter", "Actions that failed to archive or delete", None),
+    "actions_deleted_total": ("counter", "Actions deleted from the server", None),
+    "concurrency_limit": ("gauge", "Current adaptive request concurrency limit", None),
+    "start_time_seconds": ("gauge", "Unix time the run started", None),
+    "last_update_seconds": ("gauge", "Unix time these metrics were written", None),
+}
+
+
+class _Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+
+
+class RunMetrics:
+    """Counters, gauges and histograms of one run, keyed by name and labels
+
+    inc(), set() and observe() take the metric name (without the
+    bigfix_archive_ prefix) and labels as keyword arguments. Callbacks
+    given to add_refresh() run before each export, to copy in values kept
+    elsewhere (TransferStats, RetryPolicy, ...).
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self._values = {}  # (name, labels) -> float or _Histogram
+        self._refresh = []
+        self.set("start_time_seconds", time.time())
+
+    @staticmethod
+    def _key(name, labels):
+        if name not in METRICS:
+            raise KeyError(f"Unknown metric {name}")
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            self._values[key] = value
+
+    def observe(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            histogram = self._values.get(key)
+            if histogram is None:
+                histogram = self._values[key] = _Histogram(METRICS[name][2])
+            histogram.observe(value)
+
+    def observe_request(self, endpoint, seconds, status):
+        """Record one REST request; status is None for a network error or timeout"""
+        outcome = "error" if status is None else f"{status // 100}xx"
+        self.observe("request_duration_seconds", seconds, endpoint=endpoint)
+        self.inc("requests_total", endpoint=endpoint, outcome=outcome)
+
+    def add_refresh(self, callback):
+        self._refresh.append(callback)
+
+    def _snapshot(self):
+        for callback in self._refresh:
+            callback(self)
+        self.set("last_update_seconds", time.time())
+        with self.lock:
+            snapshot = {}
+            for (name, labels), value in sorted(self._values.items()):
+                if isinstance(value, _Histogram):
+                    value = {
+                        "buckets": dict(zip(value.buckets, value.counts)),
+                        "count": value.count,
+                        "sum": value.sum,
+                    }
+                snapshot.setdefault(name, []).append((dict(labels), value))
+            return snapshot
+
+    def render_prometheus(self):
+        """Prometheus text exposition format"""
+        lines = []
+        for name, samples in self._snapshot().items():
+            kind, help_text, _buckets = METRICS[name]
+            full_name = PREFIX + name
+            lines.append(f"# HELP {full_name} {help_text}")
+            lines.append(f"# TYPE {full_name} {kind}")
+            for labels, value in samples:
+                if kind != "histogram":
+                    lines.append(f"{full_name}{_labels(labels)} {_number(value)}")
+                    continue
+                for bound, count in value["buckets"].items():
+                    bucket_labels = dict(labels, le=_number(bound))
+                    lines.append(f"{full_name}_bucket{_labels(bucket_labels)} {count}")
+                lines.append(f"{full_name}_bucket{_labels(dict(labels, le='+Inf'))} {value['count']}")
+                lines.append(f"{full_name}_sum{_labels(labels)} {_number(value['sum'])}")
+                lines.append(f"{full_name}_count{_labels(labels)} {value['count']}")
+        return "\n".join(lines) + "\n"
+
+    def render_json(self):
+        """The same metrics as a JSON document"""
+        document = {}
+        for name, samples in self._snapshot().items():
+            document[PREFIX + name] = [
+                {"labels": labels, "value": value} for labels, value in samples
+            ]
+        return json.dumps(document, indent=2, default=str) + "\n"
+
+    def write(self, path):
+        """Write the metrics to path, as JSON if it ends in .json
+
+        The file is replaced atomically, so a collector never reads a
+        partial file."""
+        content = self.render_json() if path.lower().endswith(".json") else self.render_prometheus()
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            f.write(content)
+        os.replace(temp_path, path)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in labels.items()) + "}"
+
+
+def _number(value):
+    if isinstance(value, float) and math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    if isinstance(value, float) and value.is_integer() and abs(value) < 1e15:
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class MetricsExporter:
+    """Writes RunMetrics to a file every interval seconds from a daemon thread
+
+    stop() writes the final values. With interval 0 only stop() writes."""
+
+    def __init__(self, metrics, path, interval):
+        self.metrics = metrics
+        self.path = path
+        self.interval = interval
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self.interval > 0:
+            self._thread = threading.Thread(target=self._run, name="metrics-exporter", daemon=True)
+            self._thread.start()
+        return self
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self._write()
+
+    def _write(self):
+        try:
+            self.metrics.write(self.path)
+        except OSError as e:
+            print(f"WARNING: Could not write metrics to {self.path}: {e}")
+
+    def stop(self):
+        if self._stopped.is_set():
+            return
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._write()
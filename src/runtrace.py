@@ -0,0 +1,254 @@
+"""
+runtrace.py -- profiling hooks for actionarchive.py (--profile)
+
+Timed spans for every phase and action, written as a Chrome trace (JSON
+trace event format) that chrome://tracing and https://ui.perfetto.dev
+open directly. Spans opened in threads record wall and thread CPU time;
+spans of asyncio tasks record wall time only, since tasks share a thread.
+
+Optionally the Python code itself is profiled as well:
+  - cprofile: deterministic profile of the main thread and of every call
+    run through profiled() (the worker pools), merged into one pstats file.
+    From Python 3.12 cProfile is built on sys.monitoring, so one profile
+    sees every thread and a second one cannot be enabled alongside it;
+    there the main thread's profile alone covers the whole process
+  - sample: a thread samples the stacks of all threads every few
+    milliseconds and writes them in the collapsed format read by
+    flamegraph.pl and speedscope
+
+Spans are no-ops until start() is called, so the hooks cost next to
+nothing in a normal run.
+"""
+
+import contextlib
+import cProfile
+import itertools
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+
+PROFILERS = ("cprofile", "sample")
+PROFILE_SUFFIXES = {"cprofile": ".pstats", "sample": ".collapsed"}
+
+# Seconds between stack samples with the sample profiler
+SAMPLE_INTERVAL = 0.005
+
+# Trace events held in memory before they are appended to the trace file
+EVENT_BUFFER = 1000
+
+# cProfile profiles every thread of the process (Python 3.12 and later)
+PROCESS_WIDE_CPROFILE = sys.version_info >= (3, 12)
+
+_NULL_SPAN = contextlib.nullcontext()
+_tracer = None
+
+
+class RunTracer:
+    """Collects trace events and runs the optional profiler
+
+    Events are appended to the trace file every EVENT_BUFFER events, so a
+    long run holds only a small buffer in memory; finish() writes the rest
+    and closes the JSON document.
+    """
+
+    def __init__(self, path, profiler=None, sample_interval=SAMPLE_INTERVAL):
+        self.path = path
+        self.profiler = profiler
+        self.profile_path = profile_path(path, profiler) if profiler else None
+        self.sample_interval = sample_interval
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+        self.start_time = time.perf_counter()
+        self._events = []
+        self._written = 0  # events already in the trace file
+        self._file_lock = threading.Lock()
+        self._file = open(path, "w", encoding="utf-8")
+        self._file.write('{"displayTimeUnit": "ms", "traceEvents": [\n')
+        self._threads = {}  # thread id -> name
+        self._async_ids = itertools.count(1)
+        self._local = threading.local()
+        self._profiles = []  # one cProfile.Profile per profiled thread
+        self._samples = {}  # collapsed stack -> count
+        self._sampler = None
+        self._stopped = threading.Event()
+        self._finished = False
+
+    def _now(self):
+        return (time.perf_counter() - self.start_time) * 1e6
+
+    def _tid(self):
+        tid = threading.get_ident()
+        if tid not in self._threads:
+            with self.lock:
+                self._threads[tid] = threading.current_thread().name
+        return tid
+
+    def _add(self, *events):
+        with self.lock:
+            self._events.extend(events)
+            if len(self._events) < EVENT_BUFFER:
+                return
+            events, self._events = self._events, []
+        self._write_events(events)
+
+    def _write_events(self, events):
+        with self._file_lock:
+            for event in events:
+                self._file.write((",\n" if self._written else "") + json.dumps(event))
+                self._written += 1
+
+    @contextlib.contextmanager
+    def span(self, name, cat, **args):
+        """Time a block of code running in the current thread"""
+        tid = self._tid()
+        start, cpu_start = self._now(), time.thread_time()
+        try:
+            yield
+        finally:
+            event = {
+                "name": name, "cat": cat, "ph": "X", "pid": self.pid, "tid": tid,
+                "ts": start, "dur": self._now() - start,
+                "tts": cpu_start * 1e6, "tdur": (time.thread_time() - cpu_start) * 1e6,
+            }
+            if args:
+                event["args"] = args
+            self._add(event)
+
+    @contextlib.contextmanager
+    def task_span(self, name, cat, **args):
+        """Time an asyncio task (wall time only)"""
+        span_id = next(self._async_ids)
+        tid = self._tid()
+        begin = {"name": name, "cat": cat, "ph": "b", "id": span_id,
+                 "pid": self.pid, "tid": tid, "ts": self._now()}
+        if args:
+            begin["args"] = args
+        try:
+            yield
+        finally:
+            end = {"name": name, "cat": cat, "ph": "e", "id": span_id,
+                   "pid": self.pid, "tid": tid, "ts": self._now()}
+            self._add(begin, end)
+
+    def _thread_profile(self):
+        profile = getattr(self._local, "profile", None)
+        if profile is None:
+            profile = self._local.profile = cProfile.Profile()
+            with self.lock:
+                self._profiles.append(profile)
+        return profile
+
+    def profiled(self, func):
+        """Wrap func so calls run under this thread's cProfile profile"""
+        if self.profiler != "cprofile" or PROCESS_WIDE_CPROFILE:
+            return func
+
+        def run(*args, **kwargs):
+            profile = self._thread_profile()
+            profile.enable()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                profile.disable()
+
+        return run
+
+    def start_profiler(self):
+        if self.profiler == "cprofile":
+            self._thread_profile().enable()
+        elif self.profiler == "sample":
+            self._sampler = threading.Thread(target=self._sample, name="profile-sampler", daemon=True)
+            self._sampler.start()
+
+    def _sample(self):
+        own = threading.get_ident()
+        while not self._stopped.wait(self.sample_interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for tid, frame in sys._current_frames().items():
+                if tid == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append(names.get(tid, str(tid)))
+                key = ";".join(reversed(stack))
+                self._samples[key] = self._samples.get(key, 0) + 1
+
+    def finish(self):
+        """Stop the profiler and write the trace (and profile) files
+
+        Must be called from the main thread. Returns the paths written."""
+        if self._finished:
+            return []
+        self._finished = True
+        self._stopped.set()
+        written = []
+
+        if self.profiler == "cprofile":
+            self._thread_profile().disable()
+            with self.lock:
+                profiles = list(self._profiles)
+            stats = pstats.Stats(profiles[0])
+            for profile in profiles[1:]:
+                stats.add(profile)
+            stats.dump_stats(self.profile_path)
+            written.append(self.profile_path)
+        elif self.profiler == "sample":
+            self._sampler.join()
+            with open(self.profile_path, "w", encoding="utf-8") as f:
+                for stack, count in sorted(self._samples.items()):
+                    f.write(f"{stack} {count}\n")
+            written.append(self.profile_path)
+
+        with self.lock:
+            events, self._events = self._events, []
+            events.extend(
+                {"name": "thread_name", "ph": "M", "pid": self.pid, "tid": tid, "args": {"name": name}}
+                for tid, name in self._threads.items()
+            )
+        self._write_events(events)
+        with self._file_lock:
+            self._file.write("\n]}\n")
+            self._file.close()
+        written.insert(0, self.path)
+        return written
+
+
+def profile_path(path, profiler):
+    """Profile output written next to the trace: run.json -> run.pstats"""
+    root, ext = os.path.splitext(path)
+    return (root if ext.lower() == ".json" else path) + PROFILE_SUFFIXES[profiler]
+
+
+def start(path, profiler=None):
+    """Enable tracing for this process, returning the RunTracer"""
+    global _tracer
+    _tracer = RunTracer(path, profiler)
+    _tracer.start_profiler()
+    return _tracer
+
+
+def span(name, cat="run", **args):
+    """Context manager timing a block in a thread; a no-op unless tracing"""
+    if _tracer is None:
+        return _NULL_SPAN
+    return _tracer.span(name, cat, **args)
+
+
+def task_span(name, cat="run", **args):
+    """Context manager timing an asyncio task; a no-op unless tracing"""
+    if _tracer is None:
+        return _NULL_SPAN
+    return _tracer.task_span(name, cat, **args)
+
+
+def profiled(func):
+    """func, run under the thread's profiler with --profiler cprofile"""
+    if _tracer is None:
+        return func
+    return _tracer.profiled(func)
@@ -0,0 +1,124 @@
+"""
+Tests for ArchiveWriter's zip output: raw appends of deflated members,
+the ZipFile.open() fallback and the offsets in the index sidecar
+
+Run from the repository root with: python -m unittest discover tests
+"""
+
+import os
+import struct
+import sys
+import tempfile
+import unittest
+import zipfile
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import actionarchive
+
+# Small enough that most members, their offsets and the central directory
+# need zip64 records
+SMALL_ZIP64_LIMIT = 1024
+
+MEMBERS = {
+    "empty.xml": b"",
+    "site/1001_action.xml": b"<BES><Action>small</Action></BES>",
+    "site/1001_result.xml": b"<Computer>endpoint</Computer>\n" * 2000,
+    "site/1002_action.xml": os.urandom(5000),  # Stored larger than the limit, too
+    "site/1002_result.xml": os.urandom(300000),
+}
+
+
+class ZipWriterTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "archive.zip")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write_archive(self, members=MEMBERS):
+        writer = actionarchive.ArchiveWriter(self.path, index=True)
+        for name, content in members.items():
+            # Several chunks, as status documents are streamed
+            writer.write_stream(name, [content[i:i + 4096] for i in range(0, len(content), 4096)])
+        raw_append = writer._zip_raw_append
+        writer.close()
+        return raw_append
+
+    def check_archive(self, members=MEMBERS):
+        with zipfile.ZipFile(self.path) as zf:
+            self.assertIsNone(zf.testzip())
+            self.assertEqual(sorted(zf.namelist()), sorted(members))
+            for name, content in members.items():
+                self.assertEqual(zf.read(name), content)
+            data_offsets = {info.filename: self.data_offset(zf, info) for info in zf.infolist()}
+
+        archive = actionarchive.IndexedArchive(self.path)
+        try:
+            indexed = dict(archive.db.execute("SELECT name, offset FROM members"))
+            self.assertEqual(indexed, data_offsets)
+            for name, content in members.items():
+                self.assertEqual(b"".join(archive.iter_member(name)), content)
+        finally:
+            archive.close()
+
+    @staticmethod
+    def data_offset(zf, info):
+        """Offset of a member's data, from its local header"""
+        zf.fp.seek(info.header_offset)
+        header = zf.fp.read(zipfile.sizeFileHeader)
+        name_length, extra_length = struct.unpack("<HH", header[26:30])
+        return info.header_offset + zipfile.sizeFileHeader + name_length + extra_length
+
+    def test_raw_append(self):
+        self.assertTrue(self.write_archive())
+        self.check_archive()
+
+    def test_raw_append_zip64(self):
+        with mock.patch.object(zipfile, "ZIP64_LIMIT", SMALL_ZIP64_LIMIT):
+            self.assertTrue(self.write_archive())
+
+        with zipfile.ZipFile(self.path) as zf:
+            info = zf.getinfo("site/1002_result.xml")
+            self.assertGreater(info.compress_size, SMALL_ZIP64_LIMIT)
+            self.assertGreater(info.header_offset, SMALL_ZIP64_LIMIT)
+            # The local header carries the zip64 extra field (ID 0x0001)
+            zf.fp.seek(info.header_offset)
+            header = zf.fp.read(zipfile.sizeFileHeader)
+            name_length, extra_length = struct.unpack("<HH", header[26:30])
+            zf.fp.seek(name_length, os.SEEK_CUR)
+            extra = zf.fp.read(extra_length)
+            self.assertEqual(struct.unpack("<H", extra[:2])[0], 1)
+        self.check_archive()
+
+    def test_fallback_without_zipfile_internals(self):
+        self.assertFalse(actionarchive.zip_raw_append_supported(object()))
+
+        with mock.patch.object(actionarchive, "zip_raw_append_supported", return_value=False), \
+                mock.patch.object(actionarchive.ArchiveWriter, "_append_zip_member",
+                                  side_effect=AssertionError("raw append used")):
+            self.assertFalse(self.write_archive())
+        self.check_archive()
+
+    def test_fallback_zip64(self):
+        with mock.patch.object(actionarchive, "zip_raw_append_supported", return_value=False), \
+                mock.patch.object(zipfile, "ZIP64_LIMIT", SMALL_ZIP64_LIMIT):
+            self.assertFalse(self.write_archive())
+        self.check_archive()
+
+    def test_copy_zip_member(self):
+        self.write_archive()
+        source_path, self.path = self.path, os.path.join(self.tmp.name, "copy.zip")
+
+        writer = actionarchive.ArchiveWriter(self.path, index=True)
+        with zipfile.ZipFile(source_path) as source:
+            for info in source.infolist():
+                writer.copy_zip_member(source, info, "copy/" + info.filename)
+        writer.close()
+        self.check_archive({"copy/" + name: content for name, content in MEMBERS.items()})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,60 @@
+"""
+Tests for the archive index sidecar (query --since/--until)
+
+Run from the repository root with: python -m unittest discover tests
+"""
+
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import actionarchive
+
+# Selection rows: (id, state, name, time issued, issuer, multiple flag)
+ACTIONS = [
+    (1, "Expired", "Late on the 31st in New York", "Wed, 31 Jan 2024 23:30:00 -0500", "jsmith", False),
+    (2, "Expired", "Early on the 1st in Berlin", "Thu, 01 Feb 2024 00:30:00 +0100", "jsmith", False),
+    (3, "Stopped", "Noon on the 1st in UTC", "Thu, 01 Feb 2024 12:00:00 +0000", "jsmith", False),
+]
+
+
+class IssuedTimeTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        path = os.path.join(self.tmp.name, "archive.zip")
+        open(path, "wb").close()
+        index = actionarchive.ArchiveIndex(path, "zip")
+        for actid in ACTIONS:
+            index.add_action(actid, {})
+        index.close()
+        self.archive = actionarchive.IndexedArchive(path)
+
+    def tearDown(self):
+        self.archive.close()
+        self.tmp.cleanup()
+
+    def ids(self, **filters):
+        return [row[0] for row in self.archive.find_actions(**filters)]
+
+    def test_offsets_compared_in_utc(self):
+        # 23:30 -05:00 on the 31st is 04:30 UTC on the 1st; 00:30 +01:00 is 23:30 UTC on the 31st
+        self.assertEqual(self.ids(since="2024-02-01"), [1, 3])
+        self.assertEqual(self.ids(until="2024-02-01"), [2])
+        self.assertEqual(self.ids(since="2024-02-01T05:00:00+00:00", until="2024-02-01T13:00:00Z"), [3])
+
+    def test_since_with_offset(self):
+        self.assertEqual(self.ids(since="2024-02-01T00:00:00+01:00"), [1, 2, 3])
+        self.assertEqual(self.ids(since="2024-01-31T18:00:00-05:00", until="2024-02-01"), [2])
+
+    def test_time_arg(self):
+        self.assertEqual(actionarchive.utc_time("2024-01-31T19:00:00-05:00"), "2024-02-01T00:00:00.000000")
+        self.assertIsNone(actionarchive.utc_time("31/01/2024"))
+        with self.assertRaises(actionarchive.argparse.ArgumentTypeError):
+            actionarchive.time_arg("yesterday")
+
+
+if __name__ == "__main__":
+    unittest.main()
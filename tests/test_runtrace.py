@@ -0,0 +1,86 @@
+"""
+Tests for runtrace.py (--profile)
+
+Run from the repository root with: python -m unittest discover tests
+"""
+
+import concurrent.futures
+import json
+import os
+import pstats
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import runtrace
+
+
+def busy_work(count):
+    total = 0
+    for i in range(count):
+        total += i
+    return total
+
+
+class ProfiledWorkerTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "run.json")
+
+    def tearDown(self):
+        runtrace._tracer = None
+        self.tmp.cleanup()
+
+    def test_cprofile_worker_threads(self):
+        # On Python 3.12+ a second enabled cProfile raised ValueError in
+        # every worker; profiled() must leave the work items running
+        tracer = runtrace.start(self.path, "cprofile")
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+                futures = [executor.submit(runtrace.profiled(busy_work), 10000) for _ in range(8)]
+                results = [future.result() for future in futures]
+        finally:
+            written = tracer.finish()
+
+        self.assertEqual(results, [busy_work(10000)] * 8)
+        self.assertEqual(written, [self.path, tracer.profile_path])
+        functions = {key[2] for key in pstats.Stats(tracer.profile_path).stats}
+        self.assertIn("busy_work", functions)
+
+    def test_spans_in_worker_threads(self):
+        tracer = runtrace.start(self.path)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+            for future in [executor.submit(runtrace.profiled(self._span), i) for i in range(4)]:
+                future.result()
+        tracer.finish()
+
+        with open(self.path, encoding="utf-8") as f:
+            events = json.load(f)["traceEvents"]
+        spans = [event for event in events if event["ph"] == "X"]
+        self.assertEqual(sorted(event["args"]["id"] for event in spans), [0, 1, 2, 3])
+
+    def test_events_streamed_to_file(self):
+        tracer = runtrace.start(self.path)
+        for i in range(runtrace.EVENT_BUFFER + 10):
+            with runtrace.span("step", id=i):
+                pass
+        self.assertLess(len(tracer._events), runtrace.EVENT_BUFFER)
+        self.assertGreater(os.path.getsize(self.path), 0)
+        tracer.finish()
+
+        with open(self.path, encoding="utf-8") as f:
+            trace = json.load(f)
+        spans = [event for event in trace["traceEvents"] if event["ph"] == "X"]
+        self.assertEqual(len(spans), runtrace.EVENT_BUFFER + 10)
+        self.assertEqual(trace["displayTimeUnit"], "ms")
+
+    @staticmethod
+    def _span(action_id):
+        with runtrace.span("action", "action", id=action_id):
+            busy_work(100)
+
+
+if __name__ == "__main__":
+    unittest.main()